@@ -0,0 +1,338 @@
+'''
+Deterministic generators of synthetic inputs for the benchmarks.  Everything is
+derived from a single seed, so a given scale always produces identical files.
+
+The file formats mimic those produced (or consumed) in the workflow:
+  - gzipped single-end FASTQ, named <sample>_R1.fastq.gz
+  - featureCounts count and summary files, named <sample>.<tag>.feature_counts.tsv(.summary)
+  - DESeq2 result tables and normalized count matrices (with the binary sidecar),
+    as written by deseq2.R
+  - tab-delimited sample annotation sheets
+  - a coordinate-sorted, indexed BAM and a BED12 of the gene models (requires pysam)
+'''
+
+import gzip
+import os
+import sys
+
+import numpy as np
+
+DOCKER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'docker')
+sys.path.insert(0, DOCKER_DIR)
+
+from count_matrix_sidecar import write_sidecar
+
+FASTQ_SUFFIX = '_R1.fastq.gz'
+FEATURE_COUNTS_TAG = 'primary'
+FEATURE_COUNTS_SUFFIX = 'feature_counts.tsv'
+VERSUS_SEP = '_versus_'
+DESEQ2_SUFFIX = 'deseq2_results.tsv'
+NORMALIZED_COUNTS_SUFFIX = 'normalized_counts.tsv'
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+MIN_QUALITY = ord('#')
+MAX_QUALITY = ord('J')
+
+# the synthetic genome: genes are laid out one after another along CHROM_COUNT
+# chromosomes, each with EXONS_PER_GENE exons of EXON_LENGTH separated by INTRON_LENGTH.
+CHROM_COUNT = 4
+EXONS_PER_GENE = 3
+EXON_LENGTH = 200
+INTRON_LENGTH = 300
+INTERGENIC_LENGTH = 1000
+GENE_SPAN = EXONS_PER_GENE * EXON_LENGTH + (EXONS_PER_GENE - 1) * INTRON_LENGTH
+
+FEATURE_COUNTS_SUMMARY_CATEGORIES = ['Assigned', 'Unassigned_Unmapped', 'Unassigned_MappingQuality',
+    'Unassigned_Chimera', 'Unassigned_FragmentLength', 'Unassigned_Duplicate',
+    'Unassigned_MultiMapping', 'Unassigned_Secondary', 'Unassigned_Nonjunction',
+    'Unassigned_NoFeatures', 'Unassigned_Overlapping_Length', 'Unassigned_Ambiguity']
+
+
+class BenchmarkScale(object):
+    '''
+    The size of a synthetic dataset
+    '''
+    def __init__(self, samples, genes, contrasts, reads, read_length=75, seed=0):
+        self.samples = samples
+        self.genes = genes
+        self.contrasts = contrasts
+        self.reads = reads
+        self.read_length = read_length
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+def sample_names(scale):
+    return ['sample_%03d' % i for i in range(scale.samples)]
+
+
+def gene_names(scale):
+    return ['GENE%06d' % i for i in range(scale.genes)]
+
+
+def condition_names(scale):
+    '''
+    There is one more condition than contrasts; every contrast compares
+    a condition against the first.
+    '''
+    return ['cond_%d' % i for i in range(scale.contrasts + 1)]
+
+
+def contrast_pairs(scale):
+    '''
+    Returns a list of (base, experimental) conditions
+    '''
+    conditions = condition_names(scale)
+    return [(conditions[0], c) for c in conditions[1:]]
+
+
+def assign_conditions(scale):
+    '''
+    Assigns the samples to the conditions round-robin
+    '''
+    conditions = condition_names(scale)
+    return [(s, conditions[i % len(conditions)]) for i, s in enumerate(sample_names(scale))]
+
+
+def gene_models(scale):
+    '''
+    Returns a list of (gene, chrom, start, strand, exon starts) with
+    0-based coordinates.  Strands alternate.
+    '''
+    models = []
+    genes_per_chrom = int(np.ceil(scale.genes / CHROM_COUNT))
+    for i, gene in enumerate(gene_names(scale)):
+        chrom = 'chr%d' % (i // genes_per_chrom + 1)
+        start = INTERGENIC_LENGTH + (i % genes_per_chrom) * (GENE_SPAN + INTERGENIC_LENGTH)
+        exon_starts = [start + k * (EXON_LENGTH + INTRON_LENGTH) for k in range(EXONS_PER_GENE)]
+        models.append((gene, chrom, start, '+' if i % 2 == 0 else '-', exon_starts))
+    return models
+
+
+def chromosome_lengths(scale):
+    lengths = {}
+    for gene, chrom, start, strand, exon_starts in gene_models(scale):
+        lengths[chrom] = max(lengths.get(chrom, 0), start + GENE_SPAN + INTERGENIC_LENGTH)
+    return lengths
+
+
+def simulate_counts(scale):
+    '''
+    Returns a (genes x samples) integer count matrix drawn from a negative binomial
+    with gene-specific means, with a fraction of the genes changed in each condition
+    '''
+    rng = np.random.RandomState(scale.seed)
+    means = np.exp(rng.normal(4.0, 2.0, size=scale.genes))
+    conditions = condition_names(scale)
+    fold_changes = np.ones((scale.genes, len(conditions)))
+    for j in range(1, len(conditions)):
+        changed = rng.rand(scale.genes) < 0.1
+        fold_changes[changed, j] = np.exp(rng.normal(0, 1.5, size=changed.sum()))
+    condition_index = dict((c, j) for j, c in enumerate(conditions))
+    counts = np.empty((scale.genes, scale.samples), dtype=np.int64)
+    dispersion = 0.1
+    for j, (sample, condition) in enumerate(assign_conditions(scale)):
+        mu = means * fold_changes[:, condition_index[condition]]
+        p = 1.0 / (1.0 + mu * dispersion)
+        counts[:, j] = rng.negative_binomial(1.0 / dispersion, p)
+    return counts
+
+
+def write_fastq(path, scale, sample_index=0):
+    '''
+    Writes a gzipped FASTQ of scale.reads reads
+    '''
+    rng = np.random.RandomState(scale.seed + 1000 + sample_index)
+    chunk_size = 10000
+    with gzip.open(path, 'wb', compresslevel=6) as fout:
+        n = 0
+        while n < scale.reads:
+            m = min(chunk_size, scale.reads - n)
+            seqs = BASES[rng.randint(0, 4, size=(m, scale.read_length))]
+            quals = rng.randint(MIN_QUALITY, MAX_QUALITY + 1, size=(m, scale.read_length)).astype(np.uint8)
+            lines = []
+            for i in range(m):
+                lines.append(b'@read_%d\n%s\n+\n%s\n' % (n + i, seqs[i].tobytes(), quals[i].tobytes()))
+            fout.write(b''.join(lines))
+            n += m
+    return path
+
+
+def write_feature_counts(path, gene_order, models, counts, bam_name):
+    '''
+    Writes a featureCounts output file (and its summary) for a single sample.
+    `gene_order` gives the order of the rows, as featureCounts follows the annotation.
+    '''
+    with open(path, 'w') as fout:
+        fout.write('# Program:featureCounts v1.6.4; Command:"featureCounts" "-t" "exon" "-g" "gene_name"\n')
+        fout.write('\t'.join(['Geneid', 'Chr', 'Start', 'End', 'Strand', 'Length', bam_name]) + '\n')
+        for i in gene_order:
+            gene, chrom, start, strand, exon_starts = models[i]
+            fout.write('%s\t%s\t%s\t%s\t%s\t%d\t%d\n' % (gene,
+                ';'.join([chrom] * len(exon_starts)),
+                ';'.join(str(x + 1) for x in exon_starts),
+                ';'.join(str(x + EXON_LENGTH) for x in exon_starts),
+                ';'.join([strand] * len(exon_starts)),
+                EXON_LENGTH * len(exon_starts),
+                counts[i]))
+    assigned = int(counts.sum())
+    with open(path + '.summary', 'w') as fout:
+        fout.write('Status\t%s\n' % bam_name)
+        for category in FEATURE_COUNTS_SUMMARY_CATEGORIES:
+            value = assigned if category == 'Assigned' else assigned // 20
+            fout.write('%s\t%d\n' % (category, value))
+    return path
+
+
+def write_all_feature_counts(output_dir, scale):
+    '''
+    Writes the featureCounts files for every sample.  Returns the list of paths.
+    '''
+    counts = simulate_counts(scale)
+    models = gene_models(scale)
+    # featureCounts reports genes in annotation order, which is not sorted by name
+    gene_order = np.random.RandomState(scale.seed + 1).permutation(scale.genes)
+    paths = []
+    for j, sample in enumerate(sample_names(scale)):
+        path = os.path.join(output_dir, '%s.%s.%s' % (sample, FEATURE_COUNTS_TAG, FEATURE_COUNTS_SUFFIX))
+        write_feature_counts(path, gene_order, models, counts[:, j], '%s.bam' % sample)
+        paths.append(path)
+    return paths
+
+
+def write_annotations(path, scale):
+    '''
+    Writes a tab-delimited sample annotation sheet without a header
+    '''
+    with open(path, 'w') as fout:
+        for sample, condition in assign_conditions(scale):
+            fout.write('%s\t%s\n' % (sample, condition))
+    return path
+
+
+def write_normalized_counts(path, scale, samples):
+    '''
+    Writes a normalized count matrix (and its binary sidecar) for the
+    given samples, as deseq2.R does
+    '''
+    counts = simulate_counts(scale)
+    columns = [sample_names(scale).index(s) for s in samples]
+    values = counts[:, columns].astype(np.float64)
+    size_factors = values.sum(axis=0) / max(values.sum(axis=0).mean(), 1.0)
+    size_factors[size_factors == 0] = 1.0
+    values = values / size_factors
+    genes = gene_names(scale)
+    with open(path, 'w') as fout:
+        fout.write('\t'.join(['gene'] + samples) + '\n')
+        for i, gene in enumerate(genes):
+            fout.write(gene + '\t' + '\t'.join('%.6g' % x for x in values[i]) + '\n')
+    write_sidecar(path, genes, samples, values, 'gene')
+    return path
+
+
+def write_deseq2_results(path, scale, base, experimental, contrast_index):
+    '''
+    Writes a DESeq2 results table (as written by deseq2.R), sorted by adjusted p-value
+    '''
+    rng = np.random.RandomState(scale.seed + 2000 + contrast_index)
+    n = scale.genes
+    overall_mean = np.exp(rng.normal(4.0, 2.0, size=n))
+    lfc = rng.normal(0, 0.5, size=n)
+    changed = rng.rand(n) < 0.1
+    lfc[changed] += rng.normal(0, 2.5, size=changed.sum())
+    lfc_se = rng.uniform(0.1, 1.0, size=n)
+    stat = lfc / lfc_se
+    pvalue = np.clip(np.exp(-np.abs(stat) * rng.uniform(0.5, 2.0, size=n)), 1e-300, 1.0)
+    order = np.argsort(pvalue)
+    padj = np.empty(n)
+    padj[order] = np.minimum(1.0, np.minimum.accumulate((pvalue[order] * n / np.arange(1, n + 1))[::-1])[::-1])
+    # DESeq2 sets padj to NA for genes removed by independent filtering
+    filtered = overall_mean < 1.0
+    base_mean = overall_mean * np.exp2(-lfc / 2)
+    exp_mean = overall_mean * np.exp2(lfc / 2)
+    genes = gene_names(scale)
+    with open(path, 'w') as fout:
+        fout.write('\t'.join(['Gene', 'overall_mean', base, experimental,
+            'log2FoldChange', 'lfcSE', 'stat', 'pvalue', 'padj']) + '\n')
+        for i in np.argsort(np.where(filtered, np.inf, padj), kind='mergesort'):
+            fout.write('%s\t%.6g\t%.6g\t%.6g\t%.6g\t%.6g\t%.6g\t%.6g\t%s\n' % (genes[i],
+                overall_mean[i], base_mean[i], exp_mean[i], lfc[i], lfc_se[i], stat[i], pvalue[i],
+                'NA' if filtered[i] else '%.6g' % padj[i]))
+    return path
+
+
+def write_contrast_outputs(output_dir, scale):
+    '''
+    Writes the DESeq2 results and normalized counts for each contrast.  Returns a list
+    of (base, experimental, deseq2 results path, normalized counts path)
+    '''
+    assignments = assign_conditions(scale)
+    outputs = []
+    for k, (base, experimental) in enumerate(contrast_pairs(scale)):
+        contrast_name = '%s%s%s' % (experimental, VERSUS_SEP, base)
+        samples = [s for s, c in assignments if c in (base, experimental)]
+        deseq_path = os.path.join(output_dir, '%s.%s' % (contrast_name, DESEQ2_SUFFIX))
+        nc_path = os.path.join(output_dir, '%s.%s' % (contrast_name, NORMALIZED_COUNTS_SUFFIX))
+        write_deseq2_results(deseq_path, scale, base, experimental, k)
+        write_normalized_counts(nc_path, scale, samples)
+        outputs.append((base, experimental, deseq_path, nc_path))
+    return outputs
+
+
+def write_bed12(path, scale):
+    '''
+    Writes the gene models as BED12
+    '''
+    with open(path, 'w') as fout:
+        for gene, chrom, start, strand, exon_starts in gene_models(scale):
+            fout.write('%s\t%d\t%d\t%s\t0\t%s\t%d\t%d\t0\t%d\t%s,\t%s,\n' % (chrom, start, start + GENE_SPAN,
+                gene, strand, start, start + GENE_SPAN, len(exon_starts),
+                ','.join([str(EXON_LENGTH)] * len(exon_starts)),
+                ','.join(str(x - start) for x in exon_starts)))
+    return path
+
+
+def write_bam(path, scale, reverse_stranded_fraction=0.95):
+    '''
+    Writes a coordinate-sorted and indexed BAM of scale.reads single-end reads falling
+    in the exons of the gene models.  The reads mimic a reverse-stranded (e.g. dUTP) library.
+    '''
+    import pysam
+
+    rng = np.random.RandomState(scale.seed + 3000)
+    models = gene_models(scale)
+    lengths = chromosome_lengths(scale)
+    chroms = sorted(lengths, key=lambda c: int(c[3:]))
+    tids = dict((c, i) for i, c in enumerate(chroms))
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+        'SQ': [{'SN': c, 'LN': lengths[c]} for c in chroms]}
+
+    gene_idx = rng.randint(0, len(models), size=scale.reads)
+    exon_idx = rng.randint(0, EXONS_PER_GENE, size=scale.reads)
+    offsets = rng.randint(0, EXON_LENGTH - scale.read_length + 1, size=scale.reads) \
+        if EXON_LENGTH > scale.read_length else np.zeros(scale.reads, dtype=int)
+    agree = rng.rand(scale.reads) >= reverse_stranded_fraction
+    positions = np.array([models[g][4][e] for g, e in zip(gene_idx, exon_idx)]) + offsets
+    chrom_ids = np.array([tids[models[g][1]] for g in gene_idx])
+    minus_gene = np.array([models[g][3] == '-' for g in gene_idx])
+    order = np.lexsort((positions, chrom_ids))
+
+    sequence = 'A' * scale.read_length
+    qualities = pysam.qualitystring_to_array('I' * scale.read_length)
+    cigar = '%dM' % scale.read_length
+    with pysam.AlignmentFile(path, 'wb', header=header) as fout:
+        for i in order:
+            a = pysam.AlignedSegment()
+            a.query_name = 'read_%d' % i
+            a.query_sequence = sequence
+            a.flag = 16 if (minus_gene[i] == agree[i]) else 0
+            a.reference_id = int(chrom_ids[i])
+            a.reference_start = int(positions[i])
+            a.mapping_quality = 255
+            a.cigarstring = cigar
+            a.query_qualities = qualities
+            fout.write(a)
+    pysam.index(path)
+    return path
@@ -0,0 +1,390 @@
+#!/usr/bin/python3
+'''
+Benchmarks the python stages of the pipeline against synthetic data.
+
+Each stage is run as a separate process, as in the workflow, and we record its wall
+time, CPU time, peak resident memory (of the stage and any processes it spawns) and
+throughput.  The results are written to a JSON file.  Given a previous results file
+as a baseline, stages that became slower (or use more memory) by more than the
+tolerance are reported as regressions and the exit code is non-zero.
+
+Examples:
+    python3 benchmarks/run_benchmarks.py --scale small -o results.json
+    python3 benchmarks/run_benchmarks.py --scale small -o new.json --baseline results.json
+
+The scripts import the shared modules in docker/ (in the image these live in
+/opt/software/pylib), so their dependencies (pandas, matplotlib, bokeh, jinja2,
+pysam, scipy, ...) need to be installed.  Stages whose dependencies are missing are
+reported as failed rather than aborting the run.
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import time
+
+import generators
+
+RESULTS_FORMAT_VERSION = 1
+DOCKER_DIR = os.path.abspath(generators.DOCKER_DIR)
+DEFAULT_OUTPUT = 'benchmark_results.json'
+DEFAULT_TOLERANCE = 0.25
+
+# times below this (in seconds) are dominated by noise, so are not flagged as regressions
+MIN_COMPARED_TIME = 0.5
+
+# the compared metrics; larger is worse for each
+COMPARED_METRICS = ['wall_time', 'peak_rss_mb']
+
+SCALES = {
+    'tiny': generators.BenchmarkScale(samples=4, genes=500, contrasts=1, reads=5000),
+    'small': generators.BenchmarkScale(samples=6, genes=5000, contrasts=2, reads=100000),
+    'medium': generators.BenchmarkScale(samples=12, genes=30000, contrasts=3, reads=1000000),
+    'large': generators.BenchmarkScale(samples=48, genes=60000, contrasts=6, reads=5000000)
+}
+
+ALL_STAGES = ['check_fastq', 'perform_precheck', 'reformat_annotations', 'concatenate_featurecounts',
+    'make_dge_plots', 'generate_report', 'alternate_infer_experiment']
+
+
+# The stages are started from this small launcher rather than directly from the harness.
+# On Linux a process' peak RSS starts from that of the process it was forked from, so
+# forking from the harness (which has numpy loaded) would inflate the measurements.
+MEASURE_SCRIPT = '''
+import json, os, subprocess, sys, time
+start = time.time()
+p = subprocess.Popen(sys.argv[2:])
+_, status, usage = os.wait4(p.pid, 0)
+p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+with open(sys.argv[1], 'w') as fout:
+    json.dump({'returncode': p.returncode,
+        'wall_time': time.time() - start,
+        'cpu_time': usage.ru_utime + usage.ru_stime,
+        'maxrss': usage.ru_maxrss}, fout)
+'''
+
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+
+
+class Stage(object):
+    '''
+    A benchmarked command.  `throughput_items` is the number of
+    `throughput_unit` processed by a single run.
+    '''
+    def __init__(self, name, cmd, throughput_items, throughput_unit):
+        self.name = name
+        self.cmd = cmd
+        self.throughput_items = throughput_items
+        self.throughput_unit = throughput_unit
+
+
+class StageResult(object):
+    def __init__(self, stage):
+        self.stage = stage
+        self.status = STATUS_OK
+        self.returncode = 0
+        self.wall_time = None
+        self.cpu_time = None
+        self.peak_rss_mb = None
+        self.throughput = None
+        self.error = None
+
+    def to_dict(self):
+        return {
+            'status': self.status,
+            'returncode': self.returncode,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'peak_rss_mb': self.peak_rss_mb,
+            'throughput': self.throughput,
+            'throughput_unit': self.stage.throughput_unit,
+            'error': self.error
+        }
+
+
+def stage_environment(workdir):
+    '''
+    The environment for the stages.  The caches of tool versions and the
+    R session are kept in the work directory so they do not touch the image's copies.
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([DOCKER_DIR] + [x for x in [env.get('PYTHONPATH')] if x])
+    env['TOOL_VERSION_CACHE'] = os.path.join(workdir, 'tool_versions.json')
+    env['R_SESSION_INFO_CACHE'] = os.path.join(workdir, 'r_session_info.json')
+    env['MPLBACKEND'] = 'Agg'
+    return env
+
+
+def run_stage(stage, workdir, env):
+    '''
+    Runs the stage once, via MEASURE_SCRIPT.  The resource usage is that of the
+    stage process, which (on Linux) includes the peak memory of any child processes
+    it waited for.
+    '''
+    result = StageResult(stage)
+    stderr_path = os.path.join(workdir, '%s.stderr' % stage.name)
+    usage_path = os.path.join(workdir, '%s.usage.json' % stage.name)
+    with open(stderr_path, 'w') as stderr, open(os.devnull, 'w') as devnull:
+        p = sp.Popen([sys.executable, '-c', MEASURE_SCRIPT, usage_path] + stage.cmd,
+            cwd=workdir, env=env, stdout=devnull, stderr=stderr)
+        p.wait()
+    with open(usage_path) as fin:
+        usage = json.load(fin)
+    result.returncode = usage['returncode']
+    result.wall_time = usage['wall_time']
+    result.cpu_time = usage['cpu_time']
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    scale = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0
+    result.peak_rss_mb = usage['maxrss'] / scale
+    if result.returncode != 0:
+        result.status = STATUS_FAILED
+        with open(stderr_path) as fin:
+            result.error = fin.read()[-2000:]
+    elif result.wall_time > 0:
+        result.throughput = stage.throughput_items / result.wall_time
+    return result
+
+
+def best_of(results):
+    '''
+    Of repeated runs, keeps the fastest (or the first failure)
+    '''
+    failed = [r for r in results if r.status != STATUS_OK]
+    if failed:
+        return failed[0]
+    return min(results, key=lambda r: r.wall_time)
+
+
+def python_script(name):
+    return [sys.executable, os.path.join(DOCKER_DIR, name)]
+
+
+def prepare_stages(data_dir, scale, stage_names):
+    '''
+    Generates the synthetic inputs needed by the selected stages and returns
+    the list of Stages
+    '''
+    samples = generators.sample_names(scale)
+    annotations = generators.write_annotations(os.path.join(data_dir, 'annotations.tsv'), scale)
+    r1_files = [os.path.join(data_dir, '%s%s' % (s, generators.FASTQ_SUFFIX)) for s in samples]
+    pairs = generators.contrast_pairs(scale)
+    stages = []
+
+    if 'check_fastq' in stage_names:
+        generators.write_fastq(r1_files[0], scale)
+        stages.append(Stage('check_fastq', python_script('check_fastq.py') + ['-r1', r1_files[0]],
+            scale.reads, 'reads/s'))
+
+    if 'perform_precheck' in stage_names:
+        stages.append(Stage('perform_precheck', python_script('perform_precheck.py') +
+            ['-a', annotations, '-r1'] + r1_files +
+            ['-x'] + [b for b, e in pairs] +
+            ['-y'] + [e for b, e in pairs],
+            scale.samples, 'samples/s'))
+
+    if 'reformat_annotations' in stage_names:
+        stages.append(Stage('reformat_annotations', python_script('reformat_annotations.py') +
+            ['-a', annotations, '-o', os.path.join(data_dir, 'reformatted_annotations.tsv')],
+            scale.samples, 'samples/s'))
+
+    if 'concatenate_featurecounts' in stage_names:
+        count_files = generators.write_all_feature_counts(data_dir, scale)
+        stages.append(Stage('concatenate_featurecounts', python_script('concatenate_featurecounts.py') +
+            ['-o', os.path.join(data_dir, 'raw_primary_counts.tsv')] + count_files,
+            scale.samples * scale.genes, 'counts/s'))
+
+    contrast_outputs = []
+    if ('make_dge_plots' in stage_names) or ('generate_report' in stage_names):
+        contrast_outputs = generators.write_contrast_outputs(data_dir, scale)
+
+    if 'make_dge_plots' in stage_names:
+        base, experimental, deseq_path, nc_path = contrast_outputs[0]
+        figures_dir = os.path.join(data_dir, 'figures')
+        os.makedirs(figures_dir, exist_ok=True)
+        stages.append(Stage('make_dge_plots', python_script('make_dge_plots.py') +
+            ['-i', deseq_path, '-c', nc_path, '-s', annotations,
+            '-x', '%s%s%s' % (experimental, generators.VERSUS_SEP, base),
+            '-o', figures_dir, '-a', base, '-b', experimental],
+            scale.genes, 'genes/s'))
+
+    if 'generate_report' in stage_names:
+        config_path = os.path.join(data_dir, 'config.json')
+        with open(config_path, 'w') as fout:
+            json.dump(report_config(), fout)
+        stages.append(Stage('generate_report', python_script('generate_report.py') +
+            ['-r1'] + r1_files +
+            ['-a', annotations, '-d'] + [x[2] for x in contrast_outputs] +
+            ['-j', config_path,
+            '-t', os.path.join(DOCKER_DIR, 'report.md'),
+            '-o', os.path.join(data_dir, 'completed_report.md')],
+            scale.contrasts * scale.genes, 'genes/s'))
+
+    if 'alternate_infer_experiment' in stage_names:
+        bed = generators.write_bed12(os.path.join(data_dir, 'genes.bed'), scale)
+        try:
+            bam = generators.write_bam(os.path.join(data_dir, 'sample.bam'), scale)
+        except ImportError:
+            print('pysam is not installed; skipping alternate_infer_experiment')
+        else:
+            stages.append(Stage('alternate_infer_experiment', python_script('alternate_infer_experiment.py') +
+                ['-i', bam, '-r', bed, '-s', str(scale.reads), '-o', os.path.join(data_dir, 'infer_experiment.csv')],
+                scale.reads, 'reads/s'))
+    return stages
+
+
+def report_config():
+    '''
+    Mirrors the config.json written by the generate_report task in report.wdl
+    '''
+    return {
+        'genome': 'Synthetic',
+        'pca_plot': 'pca.png',
+        'hcl_plot': 'hctree.png',
+        'adj_pval': '0.01',
+        'lfc_threshold': '1.5',
+        'deseq2_output_file_suffix': generators.DESEQ2_SUFFIX,
+        'normalized_counts_file_suffix': generators.NORMALIZED_COUNTS_SUFFIX,
+        'versus_sep': generators.VERSUS_SEP,
+        'git_repo': 'https://example.org/benchmark',
+        'git_commit': 'benchmark',
+        'sig_heatmap_file_suffix': 'significant_genes_heatmap.png',
+        'top_heatmap_file_suffix': 'top_genes_heatmap.png',
+        'dynamic_volcano_file_suffix': 'volcano.html'
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    '''
+    Returns a list of messages describing regressions relative to the baseline
+    '''
+    regressions = []
+    if baseline.get('scale') != results['scale']:
+        print('Warning: the baseline was run at a different scale (%s) than this run (%s).'
+            % (baseline.get('scale'), results['scale']))
+    for name, current in results['stages'].items():
+        previous = baseline.get('stages', {}).get(name)
+        if previous is None:
+            continue
+        if current['status'] != STATUS_OK:
+            if previous['status'] == STATUS_OK:
+                regressions.append('%s: failed, but succeeded in the baseline' % name)
+            continue
+        if previous['status'] != STATUS_OK:
+            continue
+        for metric in COMPARED_METRICS:
+            old = previous.get(metric)
+            new = current.get(metric)
+            if (old is None) or (new is None) or (old <= 0):
+                continue
+            if (metric == 'wall_time') and (max(old, new) < MIN_COMPARED_TIME):
+                continue
+            change = (new - old) / old
+            if change > tolerance:
+                regressions.append('%s: %s increased by %.0f%% (%.3g -> %.3g)'
+                    % (name, metric, 100 * change, old, new))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks the python stages of the pipeline.')
+    parser.add_argument('--scale',
+        choices=sorted(SCALES),
+        default='small',
+        help='A preset size for the synthetic data (default: %(default)s)'
+    )
+    parser.add_argument('--samples', type=int, help='Override the number of samples.')
+    parser.add_argument('--genes', type=int, help='Override the number of genes.')
+    parser.add_argument('--contrasts', type=int, help='Override the number of contrasts.')
+    parser.add_argument('--reads', type=int, help='Override the number of reads (FASTQ and BAM).')
+    parser.add_argument('--seed', type=int, help='Override the seed of the generators.')
+    parser.add_argument('--stages',
+        nargs='+',
+        choices=ALL_STAGES,
+        default=ALL_STAGES,
+        help='The stages to run (default: all)'
+    )
+    parser.add_argument('-n', '--repeat',
+        type=int,
+        default=1,
+        help='Run each stage this many times and keep the fastest (default: %(default)s)'
+    )
+    parser.add_argument('-o', '--output',
+        default=DEFAULT_OUTPUT,
+        help='Path for the JSON results (default: %(default)s)'
+    )
+    parser.add_argument('-b', '--baseline',
+        help='A results file from a previous run to compare against.'
+    )
+    parser.add_argument('-t', '--tolerance',
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help='Relative increase in wall time or peak memory flagged as a regression (default: %(default)s)'
+    )
+    parser.add_argument('-w', '--workdir',
+        help='Directory for the synthetic data.  By default a temporary directory is used and removed.'
+    )
+    return parser.parse_args()
+
+
+def get_scale(args):
+    preset = SCALES[args.scale]
+    params = preset.to_dict()
+    for key in ['samples', 'genes', 'contrasts', 'reads', 'seed']:
+        value = getattr(args, key)
+        if value is not None:
+            params[key] = value
+    return generators.BenchmarkScale(**params)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    scale = get_scale(args)
+    workdir = args.workdir if args.workdir else tempfile.mkdtemp(prefix='rnaseq_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        print('Generating synthetic data in %s' % workdir)
+        stages = prepare_stages(workdir, scale, args.stages)
+        env = stage_environment(workdir)
+        stage_results = {}
+        for stage in stages:
+            result = best_of([run_stage(stage, workdir, env) for i in range(args.repeat)])
+            stage_results[stage.name] = result.to_dict()
+            if result.status == STATUS_OK:
+                print('%-28s %8.2f s  %8.1f MB  %12.1f %s' % (stage.name, result.wall_time,
+                    result.peak_rss_mb, result.throughput, stage.throughput_unit))
+            else:
+                last_line = result.error.strip().split('\n')[-1] if result.error else ''
+                print('%-28s FAILED (exit code %d): %s' % (stage.name, result.returncode, last_line))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    results = {
+        'format_version': RESULTS_FORMAT_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count()
+        },
+        'scale': scale.to_dict(),
+        'stages': stage_results
+    }
+    with open(args.output, 'w') as fout:
+        json.dump(results, fout, indent=2, sort_keys=True)
+    print('Wrote the results to %s' % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            sys.stderr.write('Regressions relative to %s:\n%s\n' % (args.baseline, '\n'.join(regressions)))
+            sys.exit(1)
+        print('No regressions relative to %s' % args.baseline)
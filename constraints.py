@@ -1,8 +1,117 @@
 import json
-import analysis.models
-from analysis.models import AnalysisProject, ProjectConstraint
+import os
 
-def check_constraints(implemented_constraint, inputs_json_path):
+from resource_planner import estimate_core_hours, estimate_reads, load_models, ResourcePlanException
+
+WORKFLOW_NAME = 'SingleEndRnaSeqAndDgeWorkflow'
+R1_FILES_KEY = WORKFLOW_NAME + '.r1_files'
+GENOME_KEY = WORKFLOW_NAME + '.genome'
+
+# the names of the constraints, as in constraints.json
+SAMPLE_LIMIT = 'sample_limit'
+COMPUTE_BUDGET = 'compute_budget'
+
+# the outcomes of the compute budget check:
+ACCEPT = 'accept'
+DEFER = 'defer'
+REJECT = 'reject'
+
+
+def get_constraint_name(implemented_constraint):
+    '''
+    The name of the constraint (a key in constraints.json).  If it cannot be
+    determined, we assume the sample limit, which was historically the only
+    constraint for this workflow.
+    '''
+    try:
+        return implemented_constraint.workflow_constraint.name
+    except AttributeError:
+        return SAMPLE_LIMIT
+
+
+def get_fastq_sizes(fastq_list, resource_model=None):
+    '''
+    Returns a dict mapping the paths of the fastq files to their size in bytes,
+    as recorded on the Resource instances.  Paths without a (known) size are omitted.
+
+    `resource_model` is the Resource model class, or anything with a compatible
+    `objects.filter(path__in=...)`, e.g. an in-memory stand-in for testing.
+    '''
+    if resource_model is None:
+        from base.models import Resource
+        resource_model = Resource
+    sizes = {}
+    for r in resource_model.objects.filter(path__in=fastq_list):
+        if r.size:
+            sizes[r.path] = r.size
+    return sizes
+
+
+class ComputeBudgetDecision(object):
+    '''
+    The result of comparing the estimated work of a submission with the budget.
+    The outcome is one of ACCEPT, DEFER or REJECT:
+      - ACCEPT: the whole submission fits within the budget
+      - DEFER: the submission exceeds the budget, but every sample fits on its
+               own, so the samples may be submitted in smaller batches
+      - REJECT: at least one sample exceeds the budget by itself
+    '''
+    def __init__(self, outcome, total_core_hours, budget, total_reads, num_samples, num_admissible=None, too_large=None):
+        self.outcome = outcome
+        self.total_core_hours = total_core_hours
+        self.budget = budget
+        self.total_reads = total_reads
+        self.num_samples = num_samples
+        self.num_admissible = num_admissible
+        self.too_large = too_large if too_large else []
+
+    @property
+    def satisfied(self):
+        return self.outcome == ACCEPT
+
+    def get_message(self):
+        if self.outcome == ACCEPT:
+            return ''
+        summary = 'The %d fastq files submitted for analysis contain roughly %.1f million reads, estimated to need %.1f core-hours of compute, ' \
+            'but a maximum of %.1f core-hours is permitted per analysis.' % (self.num_samples, self.total_reads / 1e6, self.total_core_hours, self.budget)
+        if self.outcome == REJECT:
+            return summary + ' The following files exceed that limit on their own and cannot be processed: %s' % ', '.join(self.too_large)
+        return summary + ' Please submit them in smaller batches; at most %d of these files fit within the limit at once.' % self.num_admissible
+
+
+def evaluate_compute_budget(fastq_sizes, genome, budget, models=None):
+    '''
+    `fastq_sizes` maps the fastq paths to their sizes in bytes, `genome` is the
+    chosen genome and `budget` is the maximum number of core-hours.
+
+    Returns a ComputeBudgetDecision
+    '''
+    if models is None:
+        models = load_models()
+    core_hours = dict([(p, estimate_core_hours(s, genome, models)) for p, s in fastq_sizes.items()])
+    total_core_hours = sum(core_hours.values())
+    total_reads = sum([estimate_reads(s, models) for s in fastq_sizes.values()])
+    num_samples = len(fastq_sizes)
+
+    if total_core_hours <= budget:
+        return ComputeBudgetDecision(ACCEPT, total_core_hours, budget, total_reads, num_samples)
+
+    too_large = sorted([os.path.basename(p) for p, h in core_hours.items() if h > budget])
+    if len(too_large) > 0:
+        return ComputeBudgetDecision(REJECT, total_core_hours, budget, total_reads, num_samples, too_large=too_large)
+
+    # greedily count how many of the smallest samples fit in a single batch
+    num_admissible = 0
+    running_total = 0.0
+    for h in sorted(core_hours.values()):
+        running_total += h
+        if running_total > budget:
+            break
+        num_admissible += 1
+    return ComputeBudgetDecision(DEFER, total_core_hours, budget, total_reads, num_samples, num_admissible=num_admissible)
+
+
+def check_sample_limit(implemented_constraint, inputs_json, resource_model=None):
     '''
     For this workflow, we can impose a constraint on the number of samples we will
     allow for processing.
@@ -10,15 +119,7 @@ def check_constraints(implemented_constraint, inputs_json_path):
     The length of the SingleEndRnaSeqAndDgeWorkflow.r1_files key will be used as the
     determinant of that number
     '''
-
-    # load the inputs json:
-    j = json.load(open(inputs_json_path))
-    try:
-        fastq_list = j['SingleEndRnaSeqAndDgeWorkflow.r1_files']
-    except KeyError:
-        # The chances of reaching this are very unlikely, but we are being extra careful here
-        print('This should not happen-- the SingleEndRnaSeqAndDgeWorkflow.r1_files key should be present in your inputs JSON file')
-        return False
+    fastq_list = inputs_json[R1_FILES_KEY]
 
     # implemented_constraint is of type ImplementedConstraint and represents the base class for the actual constraint types
     # which hold the *value* of the constraint.  Since we know we are applying an AnalysisUnitConstraint, we can access it
@@ -33,3 +134,56 @@ def check_constraints(implemented_constraint, inputs_json_path):
         message = '%d fastq files were submitted for analysis, but only a maximum of %d are permitted.' % (len(fastq_list), constraint_value)
 
     return (constraint_satisfied, message)
+
+
+def check_compute_budget(implemented_constraint, inputs_json, resource_model=None):
+    '''
+    Limits the total work of an analysis, which is estimated from the sizes
+    of the fastq files and the genome (see resource_planner.estimate_core_hours).
+    The value of the constraint is the budget, in core-hours.
+    '''
+    fastq_list = inputs_json[R1_FILES_KEY]
+    genome = inputs_json.get(GENOME_KEY)
+    budget = implemented_constraint.analysisunitconstraint.value
+
+    fastq_sizes = get_fastq_sizes(fastq_list, resource_model)
+    missing = [p for p in fastq_list if p not in fastq_sizes]
+    if len(missing) > 0:
+        # without the sizes we cannot estimate the work, so we do not block the analysis
+        print('Could not determine the size of %d fastq files.  Skipping the compute budget check.' % len(missing))
+        return (True, '')
+
+    try:
+        decision = evaluate_compute_budget(fastq_sizes, genome, budget)
+    except ResourcePlanException as ex:
+        print('Could not estimate the compute needed: %s.  Skipping the compute budget check.' % ex)
+        return (True, '')
+    return (decision.satisfied, decision.get_message())
+
+
+CONSTRAINT_HANDLERS = {
+    SAMPLE_LIMIT: check_sample_limit,
+    COMPUTE_BUDGET: check_compute_budget
+}
+
+
+def check_constraints(implemented_constraint, inputs_json_path, resource_model=None):
+    '''
+    Checks the constraint against the inputs of the analysis.  Returns a tuple of
+    (bool, str) giving whether the constraint is satisfied and, if not, a message
+    explaining why.
+
+    `resource_model` replaces the Resource model when looking up the sizes of
+    the fastq files, e.g. with an in-memory stand-in for testing.
+    '''
+
+    # load the inputs json:
+    j = json.load(open(inputs_json_path))
+    if R1_FILES_KEY not in j:
+        # The chances of reaching this are very unlikely, but we are being extra careful here
+        message = 'This should not happen-- the %s key should be present in your inputs JSON file' % R1_FILES_KEY
+        print(message)
+        return (False, message)
+
+    handler = CONSTRAINT_HANDLERS.get(get_constraint_name(implemented_constraint), check_sample_limit)
+    return handler(implemented_constraint, j, resource_model)
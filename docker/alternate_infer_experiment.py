@@ -1,12 +1,14 @@
 #!/usr/bin/python3
 '''=================================================================================================
-This script is a "hack" on the original infer_experiment.py script provided by RSeQC.  
+This script started as a "hack" on the original infer_experiment.py script provided by RSeQC.  
 The output format is not very easy to parse, so we create an alternate version that directly reports
 the findings.
 
 Note that it uses a threshold value for determining strandedness.
 
-Everything up to the end is the same as the original script.
+Rather than RSeQC's ParseBAM, the reads are now sampled and classified by the native engine
+in strandedness.py, which indexes the exons of the BED12 once, samples reads from across the genome
+(using the BAM index) and classifies them in vectorized batches.
 ================================================================================================='''
 
 #import built-in modules
@@ -15,26 +17,17 @@ if sys.version_info[0] != 3:
 	print("\nYou are using python" + str(sys.version_info[0]) + '.' + str(sys.version_info[1]) + " This verion of RSeQC needs python3!\n", file=sys.stderr)
 	sys.exit()	
 
-import re
-import string
 from optparse import OptionParser
-import warnings
-import string
-import collections
-import math
 from time import strftime
 
 #import third-party modules
-from bx.bitset import *
-from bx.bitset_builders import *
-from bx.intervals import *
 from scipy.stats import binom_test
 
 #import my own modules
-from qcmodule import SAM
-#changes to the paths
-
-#changing history to this module
+from strandedness import ExonIndex, StrandednessSPRT, infer_strandedness, infer_strandedness_sequential
+from strandedness import DEFAULT_NUM_WINDOWS, DEFAULT_SEED, DEFAULT_SPRT_ALPHA, DEFAULT_SPRT_BETA, \
+    DEFAULT_STRANDED_FRACTION, SPRT_BATCH_SIZE
+from instrumentation import Instrumentation
 
 
 __author__ = "Liguo Wang"
@@ -59,12 +52,20 @@ def main():
     usage="%prog [options]" + "\n"
     parser = OptionParser(usage,version="%prog " + __version__)
     parser.add_option("-i","--input-file",action="store",type="string",dest="input_file",help="Input alignment file in SAM or BAM format")
-    parser.add_option("-r","--refgene",action="store",type="string",dest="refgene_bed",help="Reference gene model in bed fomat.")
+    parser.add_option("-x","--index",action="store",type="string",dest="index_file",default=None,help="Index (BAI) of the BAM file, if it is not alongside the BAM (e.g. <input>.bai). default=%default")
+    parser.add_option("-r","--refgene",action="store",type="string",dest="refgene_bed",help="Reference gene model in bed fomat, or a precompiled annotation index (see annotation_index.py).")
     parser.add_option("-s","--sample-size",action="store",type="int",dest="sample_size",default=200000, help="Number of reads sampled from SAM/BAM file. default=%default")	
     parser.add_option("-q","--mapq",action="store",type="int",dest="map_qual",default=30,help="Minimum mapping quality (phred scaled) for an alignment to be considered as \"uniquely mapped\". default=%default")
     # extra options added by me:
     parser.add_option("-p", "--pval", action="store", type="float", dest="pval_threshold", default=1e-5, help="Binomial p-value for rejecting null hypothesis that experiment was unstranded. default=%default")
     parser.add_option("-o", "--outfile", action="store", type="string", dest="output_file", help="Name of the output file to write the result to.")
+    parser.add_option("-w", "--windows", action="store", type="int", dest="num_windows", default=DEFAULT_NUM_WINDOWS, help="Number of genomic windows the reads are sampled from. default=%default")
+    parser.add_option("--seed", action="store", type="int", dest="seed", default=DEFAULT_SEED, help="Seed for choosing the sampled windows. default=%default")
+    parser.add_option("-a", "--adaptive", action="store_true", dest="adaptive", default=False, help="Sample reads in batches and stop as soon as a sequential probability ratio test (SPRT) settles the decision. The sample size then becomes the maximum number of reads sampled.")
+    parser.add_option("--alpha", action="store", type="float", dest="sprt_alpha", default=DEFAULT_SPRT_ALPHA, help="SPRT probability of calling an unstranded experiment stranded. default=%default")
+    parser.add_option("--beta", action="store", type="float", dest="sprt_beta", default=DEFAULT_SPRT_BETA, help="SPRT probability of calling a stranded experiment unstranded. default=%default")
+    parser.add_option("--stranded-fraction", action="store", type="float", dest="stranded_fraction", default=DEFAULT_STRANDED_FRACTION, help="Fraction of reads in the majority orientation assumed by the SPRT for a stranded experiment. default=%default")
+    parser.add_option("--batch-size", action="store", type="int", dest="batch_size", default=SPRT_BATCH_SIZE, help="Number of reads sampled between successive SPRT evaluations. default=%default")
 
     (options,args)=parser.parse_args()
 
@@ -72,59 +73,72 @@ def main():
         parser.print_help()
         print('\n\n' + __doc__, file=sys.stderr)
         sys.exit(0)
-    for f in (options.input_file,options.refgene_bed):
+    for f in [options.input_file,options.refgene_bed] + ([options.index_file] if options.index_file else []):
         if not os.path.exists(f):
             print('\n\n' + f + " does NOT exists." + '\n', file=sys.stderr)
             sys.exit(0)
     if options.sample_size <1000:
         print("Warn: Sample Size too small to give a accurate estimation", file=sys.stderr)
-    obj = SAM.ParseBAM(options.input_file)
-    (protocol,sp1,sp2,other)=obj.configure_experiment(refbed=options.refgene_bed, sample_size = options.sample_size, q_cut = options.map_qual)
-    if other <0: 
-        other=0.0
-    '''
-    #Below is original "status" message that gets printed to the console
-	if protocol == "PairEnd":
-		print("\n\nThis is PairEnd Data")
-		print("Fraction of reads failed to determine: %.4f" % other)
-		print("Fraction of reads explained by \"1++,1--,2+-,2-+\": %.4f" % sp1)
-		print("Fraction of reads explained by \"1+-,1-+,2++,2--\": %.4f" % sp2)
-		
-	elif protocol == "SingleEnd":
-		print("\n\nThis is SingleEnd Data")
-		print("Fraction of reads failed to determine: %.4f" % other)
-		print("Fraction of reads explained by \"++,--\": %.4f" % sp1)
-		print("Fraction of reads explained by \"+-,-+\": %.4f" % sp2)
-		
-	else:
-		print("Unknown Data type")
-	#print mesg
-    '''
+    perf = Instrumentation('alternate_infer_experiment.py', label=os.path.basename(options.input_file))
+    with perf.phase('load annotations'):
+        exon_index = ExonIndex.load(options.refgene_bed)
+    with perf.phase('sample reads'):
+        if options.adaptive:
+            sprt = StrandednessSPRT(options.sprt_alpha, options.sprt_beta, options.stranded_fraction)
+            counts, decision = infer_strandedness_sequential(options.input_file,
+                exon_index,
+                options.sample_size,
+                options.map_qual,
+                sprt,
+                batch_size=options.batch_size,
+                num_windows=options.num_windows,
+                seed=options.seed,
+                index_path=options.index_file)
+        else:
+            counts = infer_strandedness(options.input_file, 
+                exon_index, 
+                options.sample_size, 
+                options.map_qual,
+                num_windows=options.num_windows,
+                seed=options.seed,
+                index_path=options.index_file)
+            decision = None
+    sp1, sp2, other = counts.fractions()
 
     '''
-    sp1 and sp2 are floats giving the fraction of reads.
+    sp1 and sp2 are floats giving the fraction of reads (among those overlapping exons) 
+    explained by "++,--" and "+-,-+", respectively.
     The "safest" option is to assume that the experiment is NOT stranded, which then makes tools like 
     featureCounts skip the ambiguous areas.  However, if we have strong enough evidence to support a stranded
     protocol, that would likely be more accurate for quantification.
 
-    To that end, we perform a binomial test.  We know the number of trials (m) and the three fractions: other, sp1, sp2
-    From those, we can get rough estimates on the number of reads assigned to each group ( floor(m*other), floor(m*sp1), floor(m*sp2))
-    Then, we will ignore the unassigned reads and use N=floor(m*sp1) + floor(m*sp2) as an estimate of the total trials.  From there, 
-    a binomial test with N trials and m*sp1 successes will give us a p-value for the null hypothesis that it is unstranded, which assumes
+    To that end, we perform a binomial test.  We ignore the ambiguous reads and use N=n1 + n2 as the total
+    number of trials, where n1 and n2 are the numbers of reads assigned to each "style".  A binomial test with 
+    N trials and n1 successes gives us a p-value for the null hypothesis that it is unstranded, which assumes
     reads have an equal probability from each strand. (p=0.5).  It is usually very obvious if the protocol is stranded, e.g. sp1=0.05, sp2=0.95
     so the p-value will be VERY stringent
+
+    In adaptive mode, the reads are instead sampled in batches and a sequential probability ratio test
+    (see strandedness.StrandednessSPRT) is applied after each, stopping once it reaches a decision.  If the
+    test is still undecided after the maximum number of reads, we fall back to the binomial test.
+    The test that decided is recorded in the output.  As sampling stops at the SPRT's decision, the
+    number of reads it needed is total_sampled.
     '''
     fout = open(options.output_file, 'w')
-    m = options.sample_size
-    n1 = int(m*sp1)
-    n2 = int(m*sp2)
+    m = counts.sampled
+    n1 = counts.agree
+    n2 = counts.disagree
     N = n1 + n2 # total reads that were assigned to one "style" or the other
-    pval = binom_test(n1, N, p=0.5)
+    pval = binom_test(n1, N, p=0.5) if N > 0 else 1.0
 
-    header = 'sp1_fraction,sp2_fraction,total_sampled,total_assigned,n1,n2,pval_threshold,pval,strand_option\n'
+    header = 'sp1_fraction,sp2_fraction,total_sampled,total_assigned,n1,n2,pval_threshold,pval,strand_option,test\n'
     fout.write(header)
+    test = 'binomial'
+    if decision is not None:
+        strand_option = decision
+        test = 'sprt'
     # if we reject the null hypothesis by the chosen threshold:
-    if pval < options.pval_threshold:
+    elif pval < options.pval_threshold:
         if sp2 > sp1:
             # this corresponds to "reverse stranded" in featureCounts parlance.  Created by dUTP, for instance.
             # The option for featurecounts is -s2
@@ -135,9 +149,10 @@ def main():
     else:
         # not rejecting null hypothesis of unstranded
             strand_option = 0
-    data='%.4f,%4f,%d,%d,%d,%d,%.4E,%.4E,%d' % (sp1,sp2,m,N,n1,n2,options.pval_threshold, pval, strand_option)
+    data='%.4f,%4f,%d,%d,%d,%d,%.4E,%.4E,%d,%s' % (sp1,sp2,m,N,n1,n2,options.pval_threshold, pval, strand_option, test)
     fout.write(data)
     fout.close()
+    perf.write()
 
 
 if __name__ == '__main__':
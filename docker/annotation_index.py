@@ -0,0 +1,450 @@
+#!/usr/bin/python3
+'''
+Compiles the annotations for a genome (a GTF and a BED12 file) into a single
+binary, memory-mappable index, and loads it.
+
+Each sample would otherwise re-parse the same (multi-hundred MB) GTF and BED12 files.
+The index is compiled once per genome and holds:
+  - for each gene: its id, name, chromosome, strand and its (merged) exon intervals
+  - for each chromosome and strand: the merged exon intervals of the BED12 transcript
+    models, as used for inferring strandedness (see strandedness.py)
+A featureCounts SAF file can be written alongside it.
+
+File layout:
+  - 8 bytes of magic, followed by the length of the header as a little-endian uint64
+  - a JSON header giving the content hashes of the source files, the chromosome
+    names and the dtype, shape and offset of each array
+  - the arrays, each aligned to ARRAY_ALIGNMENT bytes
+
+Loading only parses the header; the arrays are memory-mapped.  Strings (gene ids and names)
+are stored as a concatenated utf-8 blob with offsets and decoded on first use.
+
+The index is content-hashed: `index_id` is derived from the sha256 of both sources, and
+compiling is skipped if the output already exists and was built from identical sources.
+Usage:
+    annotation_index.py -g genes.gtf -b genes.bed12 -o genes.annidx -s genes.saf
+'''
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+MAGIC = b'ANNIDX01'
+FORMAT_VERSION = 1
+ARRAY_ALIGNMENT = 64
+HASH_CHUNK_SIZE = 1024 * 1024
+INDEX_SUFFIX = '.annidx'
+
+GTF_EXON_FEATURE = 'exon'
+GENE_ID_ATTRIBUTE = 'gene_id'
+GENE_NAME_ATTRIBUTE = 'gene_name'
+
+SAF_HEADER = ['GeneID', 'Chr', 'Start', 'End', 'Strand']
+
+# strands are stored as int8
+STRAND_CODES = {'+': 1, '-': -1, '.': 0}
+STRAND_SYMBOLS = dict((v, k) for k, v in STRAND_CODES.items())
+
+COORDINATE_DTYPE = np.dtype('<i8')
+
+
+class AnnotationIndexException(Exception):
+    pass
+
+
+def open_text(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+def fingerprint_file(path):
+    '''
+    Returns the sha256 hex digest of the file's contents
+    '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def compute_index_id(gtf_sha256, bed_sha256):
+    h = hashlib.sha256()
+    h.update(('%d\t%s\t%s' % (FORMAT_VERSION, gtf_sha256, bed_sha256)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def merge_intervals(starts, ends):
+    '''
+    Merges overlapping (or abutting) half-open intervals.  Returns sorted arrays
+    of the starts and ends of the merged, disjoint intervals.
+    '''
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if starts.shape[0] == 0:
+        return (starts, ends)
+    order = np.argsort(starts, kind='mergesort')
+    starts = starts[order]
+    ends = ends[order]
+    running_end = np.maximum.accumulate(ends)
+    new_group = np.ones(starts.shape[0], dtype=bool)
+    new_group[1:] = starts[1:] > running_end[:-1]
+    group_starts = np.flatnonzero(new_group)
+    return (starts[group_starts], np.maximum.reduceat(ends, group_starts))
+
+
+def parse_gtf_attributes(attributes):
+    '''
+    Parses the attribute column of a GTF line, e.g.
+    gene_id "ENSG00000223972"; gene_version "5"; gene_name "DDX11L1";
+    into a dict
+    '''
+    d = {}
+    for item in attributes.split(';'):
+        item = item.strip()
+        if not item:
+            continue
+        key, _, value = item.partition(' ')
+        d[key] = value.strip().strip('"')
+    return d
+
+
+def read_gtf_genes(gtf_path):
+    '''
+    Collects the exons of each gene in the GTF.  Genes are keyed on their
+    (gene_id, chromosome, strand) and kept in order of first appearance.
+
+    Returns a list of dicts with keys gene_id, gene_name, chrom, strand, starts, ends.
+    Coordinates are 0-based, half-open.
+    '''
+    genes = {}
+    order = []
+    with open_text(gtf_path) as fin:
+        for line in fin:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9 or fields[2] != GTF_EXON_FEATURE:
+                continue
+            attributes = parse_gtf_attributes(fields[8])
+            gene_id = attributes.get(GENE_ID_ATTRIBUTE)
+            if gene_id is None:
+                raise AnnotationIndexException('An exon in %s is missing the %s attribute:\n%s'
+                    % (gtf_path, GENE_ID_ATTRIBUTE, line))
+            key = (gene_id, fields[0], fields[6])
+            gene = genes.get(key)
+            if gene is None:
+                gene = {
+                    'gene_id': gene_id,
+                    'gene_name': attributes.get(GENE_NAME_ATTRIBUTE, gene_id),
+                    'chrom': fields[0],
+                    'strand': fields[6],
+                    'starts': [],
+                    'ends': []
+                }
+                genes[key] = gene
+                order.append(key)
+            gene['starts'].append(int(fields[3]) - 1)
+            gene['ends'].append(int(fields[4]))
+    return [genes[key] for key in order]
+
+
+def read_bed12_intervals(bed_path):
+    '''
+    Reads the exons (blocks) of the BED12 transcript models and merges them
+    per chromosome and strand.  Returns a dict mapping (chrom, strand) to a
+    tuple of the sorted starts and ends.
+    '''
+    raw = {}
+    with open_text(bed_path) as fin:
+        for line in fin:
+            if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            chrom = fields[0]
+            tx_start = int(fields[1])
+            strand = fields[5]
+            block_sizes = [int(x) for x in fields[10].rstrip(',').split(',')]
+            block_starts = [int(x) for x in fields[11].rstrip(',').split(',')]
+            starts, ends = raw.setdefault((chrom, strand), ([], []))
+            for size, offset in zip(block_sizes, block_starts):
+                starts.append(tx_start + offset)
+                ends.append(tx_start + offset + size)
+    intervals = {}
+    for key, (starts, ends) in raw.items():
+        intervals[key] = merge_intervals(starts, ends)
+    return intervals
+
+
+def encode_strings(strings):
+    '''
+    Encodes a list of strings as a utf-8 blob and an array of offsets
+    (string i is blob[offsets[i]:offsets[i+1]])
+    '''
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=COORDINATE_DTYPE)
+    offsets[1:] = np.cumsum([len(x) for x in encoded])
+    return (np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+
+def decode_strings(blob, offsets):
+    data = blob.tobytes()
+    return [data[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def build_arrays(genes, bed_intervals):
+    '''
+    Lays out the genes and BED12 intervals as flat arrays.  Returns a tuple of
+    (dict of arrays, chromosome names, dict of BED12 interval ranges)
+    '''
+    chromosomes = []
+    chrom_codes = {}
+    for chrom in [g['chrom'] for g in genes] + sorted(set(c for c, s in bed_intervals)):
+        if chrom not in chrom_codes:
+            chrom_codes[chrom] = len(chromosomes)
+            chromosomes.append(chrom)
+
+    exon_offsets = np.zeros(len(genes) + 1, dtype=COORDINATE_DTYPE)
+    exon_starts = []
+    exon_ends = []
+    for i, g in enumerate(genes):
+        starts, ends = merge_intervals(g['starts'], g['ends'])
+        exon_starts.append(starts)
+        exon_ends.append(ends)
+        exon_offsets[i+1] = exon_offsets[i] + starts.shape[0]
+
+    gene_id_blob, gene_id_offsets = encode_strings([g['gene_id'] for g in genes])
+    gene_name_blob, gene_name_offsets = encode_strings([g['gene_name'] for g in genes])
+
+    bed_ranges = {}
+    bed_starts = []
+    bed_ends = []
+    n = 0
+    for chrom, strand in sorted(bed_intervals):
+        starts, ends = bed_intervals[(chrom, strand)]
+        bed_ranges['%s\t%s' % (chrom, strand)] = [n, n + starts.shape[0]]
+        bed_starts.append(starts)
+        bed_ends.append(ends)
+        n += starts.shape[0]
+
+    def concat(arrays):
+        if arrays:
+            return np.concatenate(arrays).astype(COORDINATE_DTYPE)
+        return np.zeros(0, dtype=COORDINATE_DTYPE)
+
+    arrays = {
+        'gene_id_blob': gene_id_blob,
+        'gene_id_offsets': gene_id_offsets,
+        'gene_name_blob': gene_name_blob,
+        'gene_name_offsets': gene_name_offsets,
+        'gene_chrom': np.array([chrom_codes[g['chrom']] for g in genes], dtype='<i4'),
+        'gene_strand': np.array([STRAND_CODES.get(g['strand'], 0) for g in genes], dtype='i1'),
+        'exon_offsets': exon_offsets,
+        'exon_starts': concat(exon_starts),
+        'exon_ends': concat(exon_ends),
+        'bed_starts': concat(bed_starts),
+        'bed_ends': concat(bed_ends)
+    }
+    return (arrays, chromosomes, bed_ranges)
+
+
+def aligned(n):
+    return (n + ARRAY_ALIGNMENT - 1) // ARRAY_ALIGNMENT * ARRAY_ALIGNMENT
+
+
+def write_index(output_path, arrays, header):
+    '''
+    Writes the header and arrays.  The file is written to a temporary path and
+    moved into place, so a partially written index is never picked up.
+    '''
+    names = sorted(arrays)
+    # the offsets depend on the header length, which depends on the offsets.  Reserve
+    # a fixed-width field for each offset so the length does not change.
+    header['arrays'] = dict((name, {'dtype': arrays[name].dtype.str,
+        'shape': list(arrays[name].shape), 'offset': 0}) for name in names)
+    header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+    header_length = len(header_bytes) + 20 * len(names)
+    position = aligned(len(MAGIC) + 8 + header_length)
+    for name in names:
+        header['arrays'][name]['offset'] = position
+        position = aligned(position + arrays[name].nbytes)
+    header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+    header_bytes += b' ' * (header_length - len(header_bytes))
+
+    tmp_path = output_path + '.tmp.%d' % os.getpid()
+    with open(tmp_path, 'wb') as fout:
+        fout.write(MAGIC)
+        fout.write(struct.pack('<Q', header_length))
+        fout.write(header_bytes)
+        for name in names:
+            fout.seek(header['arrays'][name]['offset'])
+            fout.write(np.ascontiguousarray(arrays[name]).tobytes())
+        fout.truncate(position)
+    os.rename(tmp_path, output_path)
+
+
+def read_header(path):
+    '''
+    Returns the parsed header, or None if the file is not an annotation index
+    '''
+    with open(path, 'rb') as fin:
+        if fin.read(len(MAGIC)) != MAGIC:
+            return None
+        header_length, = struct.unpack('<Q', fin.read(8))
+        header = json.loads(fin.read(header_length).decode('utf-8'))
+    if header.get('format_version') != FORMAT_VERSION:
+        return None
+    return header
+
+
+def is_annotation_index(path):
+    with open(path, 'rb') as fin:
+        return fin.read(len(MAGIC)) == MAGIC
+
+
+class AnnotationIndex(object):
+    '''
+    A loaded (memory-mapped) annotation index
+    '''
+    def __init__(self, path, header, arrays):
+        self.path = path
+        self.header = header
+        self.arrays = arrays
+        self.chromosomes = header['chromosomes']
+        self._gene_ids = None
+        self._gene_names = None
+
+    @classmethod
+    def load(cls, path):
+        header = read_header(path)
+        if header is None:
+            raise AnnotationIndexException('%s is not a (current) annotation index.' % path)
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            shape = tuple(spec['shape'])
+            if 0 in shape:
+                arrays[name] = np.zeros(shape, dtype=spec['dtype'])
+            else:
+                arrays[name] = np.memmap(path, dtype=spec['dtype'], mode='r', offset=spec['offset'], shape=shape)
+        return cls(path, header, arrays)
+
+    @property
+    def index_id(self):
+        return self.header['index_id']
+
+    @property
+    def num_genes(self):
+        return self.arrays['gene_chrom'].shape[0]
+
+    @property
+    def gene_ids(self):
+        if self._gene_ids is None:
+            self._gene_ids = decode_strings(self.arrays['gene_id_blob'], self.arrays['gene_id_offsets'])
+        return self._gene_ids
+
+    @property
+    def gene_names(self):
+        if self._gene_names is None:
+            self._gene_names = decode_strings(self.arrays['gene_name_blob'], self.arrays['gene_name_offsets'])
+        return self._gene_names
+
+    def gene_chrom(self, i):
+        return self.chromosomes[self.arrays['gene_chrom'][i]]
+
+    def gene_strand(self, i):
+        return STRAND_SYMBOLS[int(self.arrays['gene_strand'][i])]
+
+    def gene_exons(self, i):
+        '''
+        Returns the (merged, sorted) exon starts and ends of gene i, 0-based half-open
+        '''
+        lo, hi = self.arrays['exon_offsets'][i], self.arrays['exon_offsets'][i+1]
+        return (self.arrays['exon_starts'][lo:hi], self.arrays['exon_ends'][lo:hi])
+
+    def bed_intervals(self):
+        '''
+        Returns a dict mapping (chrom, strand) to the merged BED12 exon
+        starts and ends, as used by strandedness.ExonIndex
+        '''
+        intervals = {}
+        for key, (lo, hi) in self.header['bed_ranges'].items():
+            chrom, strand = key.split('\t')
+            intervals[(chrom, strand)] = (self.arrays['bed_starts'][lo:hi], self.arrays['bed_ends'][lo:hi])
+        return intervals
+
+    def write_saf(self, saf_path):
+        '''
+        Writes the gene exons in featureCounts' SAF format (1-based, inclusive).  As in the
+        pipeline's featureCounts calls on the GTF (-g gene_name), the meta-feature is the gene name.
+        '''
+        names = self.gene_names
+        with open(saf_path, 'w') as fout:
+            fout.write('\t'.join(SAF_HEADER) + '\n')
+            for i in range(self.num_genes):
+                chrom = self.gene_chrom(i)
+                strand = self.gene_strand(i)
+                starts, ends = self.gene_exons(i)
+                for start, end in zip(starts, ends):
+                    fout.write('%s\t%s\t%d\t%d\t%s\n' % (names[i], chrom, start + 1, end, strand))
+
+
+def compile_index(gtf_path, bed_path, output_path, force=False):
+    '''
+    Compiles the index, unless `output_path` already holds an index
+    built from identical sources.  Returns the loaded AnnotationIndex.
+    '''
+    gtf_sha256 = fingerprint_file(gtf_path)
+    bed_sha256 = fingerprint_file(bed_path)
+    index_id = compute_index_id(gtf_sha256, bed_sha256)
+    if (not force) and os.path.isfile(output_path):
+        header = read_header(output_path)
+        if (header is not None) and (header.get('index_id') == index_id):
+            print('%s is up to date.' % output_path)
+            return AnnotationIndex.load(output_path)
+
+    genes = read_gtf_genes(gtf_path)
+    bed_intervals = read_bed12_intervals(bed_path)
+    arrays, chromosomes, bed_ranges = build_arrays(genes, bed_intervals)
+    header = {
+        'format_version': FORMAT_VERSION,
+        'index_id': index_id,
+        'sources': {
+            'gtf': {'name': os.path.basename(gtf_path), 'sha256': gtf_sha256},
+            'bed12': {'name': os.path.basename(bed_path), 'sha256': bed_sha256}
+        },
+        'chromosomes': chromosomes,
+        'bed_ranges': bed_ranges
+    }
+    write_index(output_path, arrays, header)
+    print('Compiled %d genes into %s' % (len(genes), output_path))
+    return AnnotationIndex.load(output_path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compiles a GTF and BED12 file into a binary annotation index.')
+    parser.add_argument('-g', '--gtf', required=True, dest='gtf', help='The GTF-format annotations.')
+    parser.add_argument('-b', '--bed', required=True, dest='bed', help='The BED12-format transcript models.')
+    parser.add_argument('-o', '--output', required=True, dest='output_path',
+        help='Path for the compiled index (conventionally ending in %s)' % INDEX_SUFFIX)
+    parser.add_argument('-s', '--saf', required=False, dest='saf_path', help='Optional path for a featureCounts SAF file.')
+    parser.add_argument('-f', '--force', action='store_true', dest='force',
+        help='Recompile even if the index is up to date.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    try:
+        index = compile_index(args.gtf, args.bed, args.output_path, args.force)
+    except AnnotationIndexException as ex:
+        sys.stderr.write(str(ex))
+        sys.exit(1)
+    if args.saf_path:
+        index.write_saf(args.saf_path)
@@ -0,0 +1,156 @@
+'''
+Helpers for tools which stream through a coordinate-sorted BAM once and write
+a filtered copy, so that no separate pass is needed to index either file:
+
+  - BaiBuilder builds the BAI of the BAM being *read*, from the virtual file
+    offsets of its records.
+  - IndexedBamWriter writes a BAM with multi-threaded compression and its
+    index on the fly, by streaming uncompressed records to
+    `samtools view --write-index` (samtools >= 1.10).
+'''
+
+import struct
+import subprocess
+
+import pysam
+
+# the BAI binning scheme (see the SAM specification, section 5.3)
+LINEAR_SHIFT = 14
+PSEUDO_BIN = 37450
+
+
+def reg2bin(beg, end):
+    '''
+    The bin of the zero-based, half-open interval [beg, end)
+    '''
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+class ReferenceIndex(object):
+    '''
+    The bins, linear index and statistics of a single reference
+    '''
+    def __init__(self):
+        self.bins = {}
+        self.linear = []
+        self.first_offset = None
+        self.last_offset = None
+        self.n_mapped = 0
+        self.n_unmapped = 0
+
+    def add(self, beg, end, start_offset, end_offset, is_unmapped):
+        chunks = self.bins.setdefault(reg2bin(beg, end), [])
+        if len(chunks) > 0 and chunks[-1][1] == start_offset:
+            # contiguous with the previous record of this bin
+            chunks[-1][1] = end_offset
+        else:
+            chunks.append([start_offset, end_offset])
+
+        first_window = beg >> LINEAR_SHIFT
+        last_window = (end - 1) >> LINEAR_SHIFT
+        if len(self.linear) <= last_window:
+            self.linear.extend([None] * (last_window + 1 - len(self.linear)))
+        for w in range(first_window, last_window + 1):
+            if self.linear[w] is None:
+                self.linear[w] = start_offset
+
+        if self.first_offset is None:
+            self.first_offset = start_offset
+        self.last_offset = end_offset
+        if is_unmapped:
+            self.n_unmapped += 1
+        else:
+            self.n_mapped += 1
+
+    def to_bytes(self):
+        parts = []
+        n_bin = len(self.bins) + (1 if self.first_offset is not None else 0)
+        parts.append(struct.pack('<i', n_bin))
+        for bin_id in sorted(self.bins):
+            chunks = self.bins[bin_id]
+            parts.append(struct.pack('<Ii', bin_id, len(chunks)))
+            for beg, end in chunks:
+                parts.append(struct.pack('<QQ', beg, end))
+        if self.first_offset is not None:
+            parts.append(struct.pack('<Ii', PSEUDO_BIN, 2))
+            parts.append(struct.pack('<QQQQ', self.first_offset, self.last_offset, self.n_mapped, self.n_unmapped))
+
+        # windows without any record point at the previous window's offset
+        linear = []
+        previous = 0
+        for offset in self.linear:
+            if offset is None:
+                offset = previous
+            linear.append(offset)
+            previous = offset
+        parts.append(struct.pack('<i', len(linear)))
+        parts.append(struct.pack('<%dQ' % len(linear), *linear))
+        return b''.join(parts)
+
+
+class BaiBuilder(object):
+    '''
+    Builds the BAI of a coordinate-sorted BAM from its records, as they are
+    read.  For each record, pass the virtual offsets (AlignmentFile.tell())
+    from immediately before and after reading it.
+    '''
+    def __init__(self, num_references):
+        self.references = [ReferenceIndex() for i in range(num_references)]
+        self.n_no_coordinate = 0
+
+    def add(self, read, start_offset, end_offset):
+        if read.reference_id < 0:
+            self.n_no_coordinate += 1
+            return
+        beg = read.reference_start
+        end = read.reference_end if (not read.is_unmapped and read.reference_end is not None) else beg + 1
+        if end <= beg:
+            end = beg + 1
+        self.references[read.reference_id].add(beg, end, start_offset, end_offset, read.is_unmapped)
+
+    def write(self, path):
+        with open(path, 'wb') as fout:
+            fout.write(b'BAI\x01')
+            fout.write(struct.pack('<i', len(self.references)))
+            for ref in self.references:
+                fout.write(ref.to_bytes())
+            fout.write(struct.pack('<Q', self.n_no_coordinate))
+
+
+class IndexedBamWriter(object):
+    '''
+    Writes a BAM, compressed by `threads` threads and indexed on the fly by samtools.
+    The records are passed to samtools uncompressed, so compression only happens once.
+    '''
+    def __init__(self, output_bam, index_path, template, threads=1):
+        self.process = subprocess.Popen([
+            'samtools', 'view',
+            '-@', str(threads),
+            '-b',
+            '--write-index',
+            '-o', '%s##idx##%s' % (output_bam, index_path),
+            '-'
+        ], stdin=subprocess.PIPE)
+        self.bam = pysam.AlignmentFile(self.process.stdin, 'wbu', template=template)
+
+    def write(self, read):
+        self.bam.write(read)
+
+    def close(self):
+        '''
+        Returns the exit code of samtools
+        '''
+        self.bam.close()
+        self.process.stdin.close()
+        return self.process.wait()
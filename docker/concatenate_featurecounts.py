@@ -1,9 +1,24 @@
 #! /usr/bin/python3
 
+import numpy as np
 import pandas as pd
 import argparse
+import hashlib
+import json
 import os
 
+from count_matrix_sidecar import write_sidecar_from_dataframe, read_count_matrix
+from instrumentation import Instrumentation
+
+INDEX_LABEL = 'Gene'
+COUNT_DTYPE = np.int64
+MANIFEST_SUFFIX = '.manifest.json'
+# version 1 hashed the bytes of the count files, whose header lines hold run-specific paths
+MANIFEST_VERSION = 2
+
+class GeneOrderException(Exception):
+    pass
+
 def parse_args():
     '''
     Responsible for parsing the input args
@@ -16,26 +31,238 @@ def parse_args():
         dest = 'output_path',
         help='Path for the concatenated output matrix.'
     )
+    parser.add_argument('-z', '--compress', \
+        action='store_true', \
+        dest = 'compress',
+        help='Gzip-compress the output matrix.'
+    )
+    parser.add_argument('--previous-matrix', \
+        required=False, \
+        dest = 'previous_matrix',
+        help='A count matrix from a previous run.  Columns for samples whose count files are'
+            ' unchanged are copied from this matrix instead of being re-read.'
+    )
+    parser.add_argument('--previous-manifest', \
+        required=False, \
+        dest = 'previous_manifest',
+        help='The fingerprint manifest written alongside the previous count matrix.'
+            ' Defaults to <previous matrix>%s' % MANIFEST_SUFFIX
+    )
     parser.add_argument('input_files', nargs='+')
     args = parser.parse_args()
     return args
 
-def cat_tables(input_files):
+def get_sample_name(f):
+    '''
+    Extracts the sample name from the featureCounts filename,
+    e.g. <sample>.<tag>.feature_counts.tsv
+    '''
+    return '.'.join(os.path.basename(f).split('.')[:-3])
+
+def read_count_file(f):
+    '''
+    Reads only the gene identifier (first column) and the count (last column)
+    from a featureCounts output file.  The Chr/Start/End columns can be very long
+    (semicolon-joined per exon), so we never split them.
+
+    Returns a tuple of (list of gene names, integer numpy array of counts)
+    '''
+    genes = []
+    counts = []
+    header_seen = False
+    with open(f) as fin:
+        for line in fin:
+            if line.startswith('#'):
+                continue
+            if not header_seen:
+                # the column header line, e.g. "Geneid  Chr  Start ..."
+                header_seen = True
+                continue
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            genes.append(line[:line.index('\t')])
+            counts.append(int(line[line.rindex('\t') + 1:]))
+    return (genes, np.array(counts, dtype=COUNT_DTYPE))
+
+def get_gene_order(genes):
+    '''
+    Returns the indices which sort the genes by name, and the sorted names
+    '''
+    order = np.argsort(np.array(genes, dtype=object), kind='mergesort')
+    return (order, [genes[i] for i in order])
+
+def iter_count_columns(input_files):
+    '''
+    Reads the count files one at a time so that only a single file is held
+    in memory.  All files are required to have identical gene order, as is
+    the case for featureCounts run against the same annotation.
+
+    Yields a tuple of (gene names sorted by name, counts in that order,
+    fingerprint of the counts) for each file.
+    '''
+    genes = None
+    for f in input_files:
+        these_genes, counts = read_count_file(f)
+        if genes is None:
+            genes = these_genes
+            order, sorted_genes = get_gene_order(genes)
+        elif these_genes != genes:
+            raise GeneOrderException('The genes in %s did not match those in %s.  '
+                'All count files should be produced with the same annotation.' % (f, input_files[0]))
+        yield (sorted_genes, counts[order], fingerprint_counts(these_genes, counts))
+
+def build_count_matrix(input_files):
+    '''
+    Fills a preallocated integer array with the counts from each file
+    in a single pass.
+
+    Returns a tuple of (gene names, sample names, counts array, fingerprints).
+    The genes are sorted by name.
+    '''
+    samples = [get_sample_name(f) for f in input_files]
+    count_matrix = None
+    fingerprints = []
+    for j, (sorted_genes, counts, fingerprint) in enumerate(iter_count_columns(input_files)):
+        if count_matrix is None:
+            count_matrix = np.empty((len(sorted_genes), len(input_files)), dtype=COUNT_DTYPE)
+        count_matrix[:,j] = counts
+        fingerprints.append(fingerprint)
+    return (sorted_genes, samples, count_matrix, fingerprints)
+
+def fingerprint_counts(genes, counts):
+    '''
+    Returns the sha256 hex digest of the genes and counts of a count file.  Only
+    the parsed values are hashed: the comment line and column header of a featureCounts
+    file hold the paths of the run (e.g. the BAM), which change between runs.
+    '''
+    h = hashlib.sha256()
+    h.update('\n'.join(genes).encode('utf-8'))
+    h.update(b'\0')
+    h.update(np.ascontiguousarray(counts, dtype='<i8').tobytes())
+    return h.hexdigest()
+
+def get_manifest_path(matrix_path):
+    return matrix_path + MANIFEST_SUFFIX
+
+def write_manifest(manifest_path, samples, fingerprints):
+    '''
+    Records the fingerprint of the counts used for each sample (column)
+    of the matrix
+    '''
+    manifest = {
+        'format_version': MANIFEST_VERSION,
+        'samples': [{'sample': s, 'sha256': fp} for s, fp in zip(samples, fingerprints)]
+    }
+    with open(manifest_path, 'w') as fout:
+        json.dump(manifest, fout, indent=2)
+
+def load_manifest(manifest_path):
+    '''
+    Returns a dict mapping the sample name to the fingerprint of its counts,
+    or None if the manifest is missing or unreadable.
+    '''
+    if (manifest_path is None) or (not os.path.isfile(manifest_path)):
+        return None
+    try:
+        with open(manifest_path) as fin:
+            manifest = json.load(fin)
+    except ValueError:
+        return None
+    if manifest.get('format_version') != MANIFEST_VERSION:
+        return None
+    return dict((item['sample'], item['sha256']) for item in manifest['samples'])
+
+def build_count_matrix_incremental(input_files, previous_matrix, previous_fingerprints):
+    '''
+    Builds the count matrix, copying the columns of `previous_matrix` for
+    any sample whose counts have the same fingerprint as before.  New or changed
+    samples are taken from their count files.  Samples that are no longer among
+    the inputs are dropped.  As the fingerprints are of the parsed counts, each
+    file is still read once.
+
+    The result is identical to that of build_count_matrix.  If the previous matrix cannot
+    be reused (e.g. a different annotation was used), no columns are copied.
+
+    Returns a tuple of (gene names, sample names, counts array, fingerprints,
+    number of reused columns).
+    '''
+    samples = [get_sample_name(f) for f in input_files]
+    count_matrix = None
+    fingerprints = []
+    n_reused = 0
+    for j, (sorted_genes, counts, fingerprint) in enumerate(iter_count_columns(input_files)):
+        if count_matrix is None:
+            count_matrix = np.empty((len(sorted_genes), len(input_files)), dtype=COUNT_DTYPE)
+            can_reuse = (sorted_genes == previous_matrix.index.tolist())
+            if not can_reuse:
+                print('The genes in %s did not match those in the previous matrix.  Rebuilding.' % input_files[0])
+        s = samples[j]
+        if can_reuse and (previous_fingerprints.get(s) == fingerprint) and (s in previous_matrix.columns):
+            count_matrix[:,j] = previous_matrix[s].values
+            n_reused += 1
+        else:
+            count_matrix[:,j] = counts
+        fingerprints.append(fingerprint)
+    return (sorted_genes, samples, count_matrix, fingerprints, n_reused)
+
+def cat_tables(input_files, previous_matrix_path=None, previous_manifest_path=None):
     '''
     Concatenates the count files into a raw count matrix.
     Logic is specific to the format of the featureCounts output
     files.
+
+    If a previous matrix (and its manifest) is given, the columns of
+    unchanged samples are taken from it.
+
+    Returns a tuple of the matrix (a pandas DataFrame) and the
+    fingerprints of the input files' counts.
     '''
-    count_matrix = pd.DataFrame()
-    for f in input_files:
-        samplename = '.'.join(os.path.basename(f).split('.')[:-3])
-        df = pd.read_csv(f, sep='\t', comment='#', index_col=0)
-        s = df.iloc[:,-1]
-        s.name = samplename
-        count_matrix = pd.concat([count_matrix, s], axis=1, sort=True)
-    return count_matrix
+    previous_fingerprints = None
+    if previous_matrix_path is not None:
+        if previous_manifest_path is None:
+            previous_manifest_path = get_manifest_path(previous_matrix_path)
+        previous_fingerprints = load_manifest(previous_manifest_path)
+        if previous_fingerprints is None:
+            print('Could not read a manifest for %s.  Performing a full rebuild.' % previous_matrix_path)
+
+    if previous_fingerprints is None:
+        genes, samples, count_matrix, fingerprints = build_count_matrix(input_files)
+    else:
+        # keep gene names such as "NA" as-is so the result matches a full rebuild
+        previous_matrix = read_count_matrix(previous_matrix_path, 
+            keep_default_na=False,
+            dtype={INDEX_LABEL: str}
+        )
+        genes, samples, count_matrix, fingerprints, n_reused = build_count_matrix_incremental(
+            input_files, previous_matrix, previous_fingerprints)
+        print('Reused %d of %d samples from %s.' % (n_reused, len(samples), previous_matrix_path))
+    return (pd.DataFrame(count_matrix, index=genes, columns=samples), fingerprints)
+
+def write_count_matrix(count_matrix, output_path, compress=False):
+    '''
+    Writes the count matrix as a tab-delimited file, preserving the integer dtype
+    '''
+    count_matrix.to_csv(output_path,
+        sep='\t',
+        index_label=INDEX_LABEL,
+        compression='gzip' if compress else None
+    )
 
 if __name__ == '__main__':
     args = parse_args()
-    count_matrix = cat_tables(args.input_files)
-    count_matrix.to_csv(args.output_path, sep='\t', index_label='Gene')
+    perf = Instrumentation('concatenate_featurecounts.py', label=os.path.basename(args.output_path))
+    with perf.phase('merge'):
+        count_matrix, fingerprints = cat_tables(args.input_files, 
+            args.previous_matrix, 
+            args.previous_manifest
+        )
+    with perf.phase('write'):
+        write_count_matrix(count_matrix, args.output_path, args.compress)
+
+        # the binary sidecar lets downstream python scripts skip the text parsing:
+        write_sidecar_from_dataframe(args.output_path, count_matrix, INDEX_LABEL)
+
+        # the manifest allows a later run to only merge new or changed samples:
+        write_manifest(get_manifest_path(args.output_path), count_matrix.columns.tolist(), fingerprints)
+    perf.write()
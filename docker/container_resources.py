@@ -0,0 +1,124 @@
+'''
+Detects the CPU and memory actually available to this process, which within a
+container is set by its cgroup rather than by the size of the host.
+
+Both cgroup v2 (cpu.max, memory.max) and v1 (cpu.cfs_quota_us, memory.limit_in_bytes)
+are supported.  Without a limit, we fall back to the CPUs this process may run on
+and the memory of the host.
+'''
+
+import math
+import os
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+MEMINFO = '/proc/meminfo'
+
+# cgroup v1 reports "no limit" as a very large number (a multiple of the page size
+# close to 2^63), so any limit beyond this is treated as unlimited
+UNLIMITED_MEMORY = 2 ** 60
+
+
+class ContainerResources(object):
+    '''
+    `cpus` is the (integer) number of CPUs available, `memory_bytes` the memory
+    limit.  `cpu_source`/`memory_source` say where each came from.
+    '''
+    def __init__(self, cpus, memory_bytes, cpu_source, memory_source):
+        self.cpus = cpus
+        self.memory_bytes = memory_bytes
+        self.cpu_source = cpu_source
+        self.memory_source = memory_source
+
+    def to_dict(self):
+        return {
+            'cpus': self.cpus,
+            'memory_bytes': self.memory_bytes,
+            'cpu_source': self.cpu_source,
+            'memory_source': self.memory_source
+        }
+
+
+def read_first_line(path):
+    try:
+        with open(path) as fin:
+            return fin.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def get_cgroup_cpu_limit(cgroup_root=CGROUP_ROOT):
+    '''
+    Returns the CPU quota as a (fractional) number of CPUs, or None if unlimited
+    '''
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    line = read_first_line(os.path.join(cgroup_root, 'cpu.max'))
+    if line is not None:
+        fields = line.split()
+        if len(fields) == 2 and fields[0] != 'max':
+            return int(fields[0]) / float(fields[1])
+        return None
+
+    # cgroup v1: a quota of -1 means unlimited
+    for cpu_dir in ('cpu', 'cpu,cpuacct', 'cpuacct,cpu'):
+        quota = read_first_line(os.path.join(cgroup_root, cpu_dir, 'cpu.cfs_quota_us'))
+        period = read_first_line(os.path.join(cgroup_root, cpu_dir, 'cpu.cfs_period_us'))
+        if quota is not None and period is not None:
+            if int(quota) > 0:
+                return int(quota) / float(period)
+            return None
+    return None
+
+
+def get_cgroup_memory_limit(cgroup_root=CGROUP_ROOT):
+    '''
+    Returns the memory limit in bytes, or None if unlimited
+    '''
+    for path in (os.path.join(cgroup_root, 'memory.max'), os.path.join(cgroup_root, 'memory', 'memory.limit_in_bytes')):
+        line = read_first_line(path)
+        if line is not None:
+            if line == 'max' or int(line) >= UNLIMITED_MEMORY:
+                return None
+            return int(line)
+    return None
+
+
+def get_host_memory():
+    try:
+        with open(MEMINFO) as fin:
+            for line in fin:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def get_available_cpus():
+    '''
+    The CPUs this process may be scheduled on
+    '''
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
+
+def detect_resources(cgroup_root=CGROUP_ROOT):
+    '''
+    Returns a ContainerResources
+    '''
+    cpus = get_available_cpus()
+    cpu_source = 'affinity'
+    quota = get_cgroup_cpu_limit(cgroup_root)
+    if quota is not None and quota < cpus:
+        # a fractional quota still gets at least one thread
+        cpus = max(1, int(math.floor(quota)))
+        cpu_source = 'cgroup'
+
+    memory = get_cgroup_memory_limit(cgroup_root)
+    memory_source = 'cgroup'
+    host_memory = get_host_memory()
+    if memory is None or (host_memory is not None and host_memory < memory):
+        memory = host_memory
+        memory_source = 'host'
+    return ContainerResources(cpus, memory, cpu_source, memory_source)
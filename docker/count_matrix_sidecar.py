@@ -0,0 +1,136 @@
+'''
+Reads and writes a binary "sidecar" for the tab-delimited count matrices.
+
+Parsing a 60k x N text table dominates the startup of the downstream python
+scripts, so alongside each count matrix we also write:
+  - <matrix path>.bin: the raw values, little-endian, in column-major order
+    (i.e. one sample after another), which is memory-mapped on reading.
+  - <matrix path>.index.json: the gene and sample names, the dtype and the shape.
+    We also record the size and md5 of the text matrix so that a stale sidecar
+    (e.g. one left over after the matrix was re-written) is ignored.  The md5
+    catches a re-written matrix of the same size; it is far cheaper than parsing
+    the text, and unlike the mtime it survives the files being copied (e.g. when
+    Cromwell localizes them).
+
+The index is written last, so a sidecar is only considered valid once it exists.
+deseq2.R writes the same format for the normalized counts.
+'''
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 2
+DATA_SUFFIX = '.bin'
+INDEX_SUFFIX = '.index.json'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def sidecar_paths(matrix_path):
+    '''
+    Returns the paths of the binary data and index files for the matrix
+    '''
+    return (matrix_path + DATA_SUFFIX, matrix_path + INDEX_SUFFIX)
+
+
+def md5_file(path):
+    '''
+    Returns the md5 hex digest of the file's contents (as R's tools::md5sum)
+    '''
+    h = hashlib.md5()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_sidecar(matrix_path, genes, samples, values, index_label):
+    '''
+    Writes the sidecar for the text matrix at `matrix_path`, which must already
+    exist.  `values` is a 2-d array with shape (len(genes), len(samples)).
+    '''
+    values = np.asarray(values)
+    dtype = values.dtype.newbyteorder('<')
+    data_path, index_path = sidecar_paths(matrix_path)
+
+    # writing the transpose in C-order gives a column-major layout
+    np.ascontiguousarray(values.T, dtype=dtype).tofile(data_path)
+
+    index = {
+        'format_version': FORMAT_VERSION,
+        'dtype': dtype.str,
+        'order': 'F',
+        'shape': [len(genes), len(samples)],
+        'genes': list(genes),
+        'samples': list(samples),
+        'index_label': index_label,
+        'source_size': os.path.getsize(matrix_path),
+        'source_md5': md5_file(matrix_path)
+    }
+    with open(index_path, 'w') as fout:
+        json.dump(index, fout)
+
+
+def write_sidecar_from_dataframe(matrix_path, df, index_label):
+    write_sidecar(matrix_path, df.index.tolist(), df.columns.tolist(), df.values, index_label)
+
+
+def load_sidecar_index(matrix_path):
+    '''
+    Returns the parsed index for the matrix, or None if there is no valid,
+    up-to-date sidecar.
+    '''
+    data_path, index_path = sidecar_paths(matrix_path)
+    if not (os.path.isfile(data_path) and os.path.isfile(index_path)):
+        return None
+    try:
+        with open(index_path) as fin:
+            index = json.load(fin)
+    except ValueError:
+        return None
+    if index.get('format_version') != FORMAT_VERSION:
+        return None
+    if int(index['source_size']) != os.path.getsize(matrix_path):
+        return None
+    n_genes, n_samples = [int(x) for x in index['shape']]
+    expected_bytes = n_genes * n_samples * np.dtype(index['dtype']).itemsize
+    if os.path.getsize(data_path) != expected_bytes:
+        return None
+    # checked last, as it reads the whole text matrix
+    if index.get('source_md5') != md5_file(matrix_path):
+        return None
+    return index
+
+
+def load_sidecar(matrix_path):
+    '''
+    Returns a pandas DataFrame backed by a read-only memory map of the
+    sidecar data, or None if there is no valid sidecar.
+    '''
+    index = load_sidecar_index(matrix_path)
+    if index is None:
+        return None
+    data_path, _ = sidecar_paths(matrix_path)
+    shape = tuple(int(x) for x in index['shape'])
+    if 0 in shape:
+        values = np.empty(shape, dtype=index['dtype'])
+    else:
+        values = np.memmap(data_path, dtype=index['dtype'], mode='r', shape=shape, order=index['order'])
+    df = pd.DataFrame(values, index=index['genes'], columns=index['samples'], copy=False)
+    df.index.name = index['index_label']
+    return df
+
+
+def read_count_matrix(matrix_path, **kwargs):
+    '''
+    Reads the count matrix, using the binary sidecar if it exists.
+    Otherwise falls back to parsing the text matrix, in which case any
+    keyword args are passed to pandas.read_table
+    '''
+    df = load_sidecar(matrix_path)
+    if df is None:
+        df = pd.read_table(matrix_path, index_col=0, **kwargs)
+    return df
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+'''
+Counts the reads of a duplicate-marked, single-end BAM per gene in a single pass,
+writing two featureCounts-compatible count files (and their .summary files):
+
+  - "primary": all the reads, as featureCounts on the primary-filtered BAM
+  - "primary_and_dedup": the reads not flagged as duplicates (0x400), as
+    featureCounts on the BAM with the duplicates removed
+
+which replaces parsing the annotations and reading (nearly) the same BAM twice.
+
+Reads are assigned as featureCounts does by default (-t exon -g gene_name, no -O,
+-M or --fraction): the aligned blocks of a uniquely mapped read must overlap (by at
+least one base) the exons of exactly one gene, on the strand given by -s.  Genes
+sharing a name are a single meta-feature, as with -g gene_name.
+
+The annotations may be a GTF, a SAF file or a compiled annotation index (see
+annotation_index.py), which is recognized by its contents.
+
+    dual_quantify.py -i sample.duplicates_marked.bam -a genes.gtf -s 2 \\
+        -p sample.primary.feature_counts.tsv -d sample.primary_and_dedup.feature_counts.tsv
+'''
+
+import argparse
+import bisect
+import os
+import sys
+
+import pysam
+
+from annotation_index import AnnotationIndex, is_annotation_index, merge_intervals, read_gtf_genes, open_text
+from instrumentation import Instrumentation
+
+INPUT_BAM = 'input_bam'
+ANNOTATION = 'annotation'
+ANNOTATION_FORMAT = 'annotation_format'
+STRAND_OPTION = 'strand_option'
+PRIMARY_OUTPUT = 'primary_output'
+DEDUP_OUTPUT = 'dedup_output'
+LABEL = 'label'
+
+GTF = 'GTF'
+SAF = 'SAF'
+
+SUMMARY_SUFFIX = '.summary'
+COUNT_COLUMNS = ['Geneid', 'Chr', 'Start', 'End', 'Strand', 'Length']
+
+# the version of featureCounts whose output is reproduced
+FEATURECOUNTS_VERSION = 'v2.0.0'
+
+DUPLICATE_FLAG = 0x400
+SECONDARY_FLAG = 0x100
+
+ASSIGNED = 'Assigned'
+UNMAPPED = 'Unassigned_Unmapped'
+MULTIMAPPING = 'Unassigned_MultiMapping'
+NO_FEATURES = 'Unassigned_NoFeatures'
+AMBIGUITY = 'Unassigned_Ambiguity'
+
+# the rows of featureCounts' summary, in its order.  The others are never
+# used for single-end reads with the default options, so they remain zero.
+SUMMARY_ROWS = [
+    ASSIGNED,
+    UNMAPPED,
+    'Unassigned_Read_Type',
+    'Unassigned_Singleton',
+    'Unassigned_MappingQuality',
+    'Unassigned_Chimera',
+    'Unassigned_FragmentLength',
+    'Unassigned_Duplicate',
+    MULTIMAPPING,
+    'Unassigned_Secondary',
+    'Unassigned_NonSplit',
+    NO_FEATURES,
+    'Unassigned_Overlapping_Length',
+    AMBIGUITY
+]
+
+
+class Gene(object):
+    '''
+    The merged exons of a gene on a single chromosome and strand
+    '''
+    def __init__(self, name, chrom, strand, starts, ends):
+        self.name = name
+        self.chrom = chrom
+        self.strand = strand
+        self.starts = starts
+        self.ends = ends
+
+
+class FeatureIndex(object):
+    '''
+    The exons of all genes, by chromosome, for overlap queries.  The meta-features
+    (gene names) are numbered in order of their first appearance.
+
+    For each chromosome, the exons are sorted by start, and `max_ends[i]` is the
+    largest end among the first i+1 exons.  So the exons overlapping [b, e) are
+    found by scanning back from the last exon starting before e, until max_ends
+    shows that no earlier exon reaches b.
+    '''
+    def __init__(self, genes):
+        self.genes = genes
+        self.meta_names = []
+        meta_ids = {}
+        exons = {}
+        for g in genes:
+            meta = meta_ids.get(g.name)
+            if meta is None:
+                meta = len(self.meta_names)
+                meta_ids[g.name] = meta
+                self.meta_names.append(g.name)
+            for start, end in zip(g.starts, g.ends):
+                exons.setdefault(g.chrom, []).append((int(start), int(end), meta, g.strand))
+        self.meta_ids = meta_ids
+
+        self.starts = {}
+        self.ends = {}
+        self.max_ends = {}
+        self.metas = {}
+        self.strands = {}
+        for chrom, chrom_exons in exons.items():
+            chrom_exons.sort()
+            self.starts[chrom] = [x[0] for x in chrom_exons]
+            self.ends[chrom] = [x[1] for x in chrom_exons]
+            self.metas[chrom] = [x[2] for x in chrom_exons]
+            self.strands[chrom] = [x[3] for x in chrom_exons]
+            max_ends = []
+            running = 0
+            for x in chrom_exons:
+                running = max(running, x[1])
+                max_ends.append(running)
+            self.max_ends[chrom] = max_ends
+
+    def overlapping(self, chrom, blocks, read_strand, found):
+        '''
+        Adds the meta-features with an exon overlapping any of the blocks (and on
+        `read_strand`, unless it is None) to the set `found`
+        '''
+        starts = self.starts.get(chrom)
+        if starts is None:
+            return
+        ends = self.ends[chrom]
+        max_ends = self.max_ends[chrom]
+        metas = self.metas[chrom]
+        strands = self.strands[chrom]
+        for b, e in blocks:
+            i = bisect.bisect_left(starts, e) - 1
+            while i >= 0 and max_ends[i] > b:
+                if ends[i] > b and (read_strand is None or strands[i] == read_strand or strands[i] == '.'):
+                    found.add(metas[i])
+                i -= 1
+
+    def meta_features(self):
+        '''
+        Yields (name, chroms, starts, ends, strands, length) for each meta-feature, as in
+        featureCounts' output: the exons are 1-based and inclusive, and the length counts
+        each base covered by the exons once.
+        '''
+        features = [[] for name in self.meta_names]
+        for g in self.genes:
+            meta = self.meta_ids[g.name]
+            for start, end in zip(g.starts, g.ends):
+                features[meta].append((g.chrom, int(start), int(end), g.strand))
+        for name, exons in zip(self.meta_names, features):
+            length = 0
+            for chrom in set([x[0] for x in exons]):
+                merged_starts, merged_ends = merge_intervals(
+                    [x[1] for x in exons if x[0] == chrom], [x[2] for x in exons if x[0] == chrom])
+                length += int((merged_ends - merged_starts).sum())
+            yield (
+                name,
+                ';'.join([x[0] for x in exons]),
+                ';'.join([str(x[1] + 1) for x in exons]),
+                ';'.join([str(x[2]) for x in exons]),
+                ';'.join([x[3] for x in exons]),
+                length
+            )
+
+
+class Counts(object):
+    '''
+    The per-gene counts and the summary of one column (primary or deduplicated)
+    '''
+    def __init__(self, num_meta_features):
+        self.counts = [0] * num_meta_features
+        self.summary = dict([(row, 0) for row in SUMMARY_ROWS])
+
+    def add(self, status, meta=None):
+        self.summary[status] += 1
+        if meta is not None:
+            self.counts[meta] += 1
+
+
+def get_commandline_args():
+    parser = argparse.ArgumentParser(description='Counts primary and deduplicated reads per gene in one pass'
+        ' over a duplicate-marked BAM.')
+    parser.add_argument('-i', '--input', required=True, dest=INPUT_BAM,
+        help='The (primary-filtered) BAM, with duplicates marked but not removed.')
+    parser.add_argument('-a', '--annotation', required=True, dest=ANNOTATION,
+        help='The GTF, SAF or compiled annotation index.')
+    parser.add_argument('-F', '--format', required=False, dest=ANNOTATION_FORMAT, default=GTF, choices=[GTF, SAF],
+        help='The format of the annotation, if it is not an annotation index (default: %s).' % GTF)
+    parser.add_argument('-s', '--strand', required=False, dest=STRAND_OPTION, default='0', choices=['0', '1', '2'],
+        help='As featureCounts: 0 (unstranded), 1 (stranded) or 2 (reversely stranded).')
+    parser.add_argument('-p', '--primary-output', required=True, dest=PRIMARY_OUTPUT,
+        help='Path for the counts of all the reads.')
+    parser.add_argument('-d', '--dedup-output', required=True, dest=DEDUP_OUTPUT,
+        help='Path for the counts of the reads not marked as duplicates.')
+    parser.add_argument('-l', '--label', required=False, dest=LABEL, default=None,
+        help='The name of the count column (default: the path of the BAM, as featureCounts).')
+    args = parser.parse_args()
+    return vars(args)
+
+
+def merge_genes(raw_genes):
+    '''
+    Merges the exons of each gene.  `raw_genes` is a list of dicts, as from
+    annotation_index.read_gtf_genes.  Returns a list of Gene
+    '''
+    genes = []
+    for g in raw_genes:
+        starts, ends = merge_intervals(g['starts'], g['ends'])
+        genes.append(Gene(g['gene_name'], g['chrom'], g['strand'], starts, ends))
+    return genes
+
+
+def read_saf_genes(saf_path):
+    '''
+    Reads a SAF file (GeneID, Chr, Start, End, Strand; 1-based, inclusive) into the
+    same structure as annotation_index.read_gtf_genes
+    '''
+    genes = {}
+    order = []
+    with open_text(saf_path) as fin:
+        for line in fin:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 5 or fields[0] == 'GeneID' or line.startswith('#'):
+                continue
+            key = (fields[0], fields[1], fields[4])
+            gene = genes.get(key)
+            if gene is None:
+                gene = {'gene_name': fields[0], 'chrom': fields[1], 'strand': fields[4], 'starts': [], 'ends': []}
+                genes[key] = gene
+                order.append(key)
+            gene['starts'].append(int(fields[2]) - 1)
+            gene['ends'].append(int(fields[3]))
+    return [genes[key] for key in order]
+
+
+def load_genes(annotation, annotation_format):
+    '''
+    Returns a list of Gene from an annotation index, SAF or GTF
+    '''
+    if is_annotation_index(annotation):
+        index = AnnotationIndex.load(annotation)
+        names = index.gene_names
+        genes = []
+        for i in range(index.num_genes):
+            starts, ends = index.gene_exons(i)
+            genes.append(Gene(names[i], index.gene_chrom(i), index.gene_strand(i), starts, ends))
+        return genes
+    if annotation_format == SAF:
+        return merge_genes(read_saf_genes(annotation))
+    return merge_genes(read_gtf_genes(annotation))
+
+
+def get_read_strand(read, strand_option):
+    '''
+    The strand of the gene a read must overlap, or None if unstranded
+    '''
+    if strand_option == '0':
+        return None
+    forward = not read.is_reverse
+    if strand_option == '2':
+        forward = not forward
+    return '+' if forward else '-'
+
+
+def assign(read, index, strand_option):
+    '''
+    Returns (status, meta-feature or None) for a read, following featureCounts' defaults
+    '''
+    if read.is_unmapped:
+        return (UNMAPPED, None)
+    if read.flag & SECONDARY_FLAG or (read.has_tag('NH') and read.get_tag('NH') > 1):
+        return (MULTIMAPPING, None)
+    found = set()
+    index.overlapping(read.reference_name, read.get_blocks(), get_read_strand(read, strand_option), found)
+    if len(found) == 0:
+        return (NO_FEATURES, None)
+    if len(found) > 1:
+        return (AMBIGUITY, None)
+    return (ASSIGNED, found.pop())
+
+
+def count_reads(input_bam, index, strand_option):
+    '''
+    Returns the Counts of (all the reads, the reads not marked as duplicates)
+    '''
+    primary = Counts(len(index.meta_names))
+    dedup = Counts(len(index.meta_names))
+    with pysam.AlignmentFile(input_bam, 'rb', threads=2) as bam:
+        for read in bam:
+            status, meta = assign(read, index, strand_option)
+            primary.add(status, meta)
+            if not read.flag & DUPLICATE_FLAG:
+                dedup.add(status, meta)
+    return primary, dedup
+
+
+def write_counts(counts, index, output_path, label, command):
+    with open(output_path, 'w') as fout:
+        fout.write('# Program:featureCounts %s; Command:%s\n' % (FEATURECOUNTS_VERSION, command))
+        fout.write('\t'.join(COUNT_COLUMNS + [label]) + '\n')
+        for meta, feature in enumerate(index.meta_features()):
+            fout.write('%s\t%s\t%s\t%s\t%s\t%d\t%d\n' % (feature + (counts.counts[meta],)))
+    with open(output_path + SUMMARY_SUFFIX, 'w') as fout:
+        fout.write('Status\t%s\n' % label)
+        for row in SUMMARY_ROWS:
+            fout.write('%s\t%d\n' % (row, counts.summary[row]))
+
+
+if __name__ == '__main__':
+    arg_dict = get_commandline_args()
+    input_bam = arg_dict[INPUT_BAM]
+    label = arg_dict[LABEL] if arg_dict[LABEL] else input_bam
+    command = ' '.join(['"%s"' % x for x in [os.path.basename(sys.argv[0])] + sys.argv[1:]])
+
+    perf = Instrumentation('dual_quantify.py', label=os.path.basename(input_bam))
+    with perf.phase('load annotations'):
+        index = FeatureIndex(load_genes(arg_dict[ANNOTATION], arg_dict[ANNOTATION_FORMAT]))
+    with perf.phase('count'):
+        primary, dedup = count_reads(input_bam, index, arg_dict[STRAND_OPTION])
+    with perf.phase('write'):
+        write_counts(primary, index, arg_dict[PRIMARY_OUTPUT], label, command)
+        write_counts(dedup, index, arg_dict[DEDUP_OUTPUT], label, command)
+    perf.write()
+
+    print('Assigned %d of %d reads (%d of %d not marked as duplicates) to %d genes.' % (
+        primary.summary[ASSIGNED], sum(primary.summary.values()),
+        dedup.summary[ASSIGNED], sum(dedup.summary.values()),
+        len(index.meta_names)))
@@ -0,0 +1,183 @@
+'''
+A single-pass, streaming validator for gzipped FASTQ files.
+
+Previously, the pre-check decompressed each FASTQ several times (gzip -t,
+fastQValidator, and zcat | head).  Here we decompress the file exactly once
+and, in that same pass, check:
+  - the integrity of the gzip stream (CRC/length checks, truncation)
+  - the 4-line structure of each FASTQ record
+  - that the sequence and quality strings have consistent lengths
+  - that the (optional) header on the "+" line matches the "@" header
+  - that reads do not exceed a maximum length (e.g. non-Illumina reads)
+
+Memory use is constant: we only ever hold a single record plus a fixed-size
+read buffer.
+'''
+
+import gzip
+import io
+import zlib
+
+# reads longer than this are not typical for Illumina
+MAX_READ_LENGTH = 300
+
+# The maximum number of structural errors we report before we stop
+# checking records.  We do not want to dump an enormous message
+# for a file that is badly malformed.
+MAX_ERRORS = 20
+
+# No legitimate FASTQ line should approach this.  Guards against
+# unbounded memory use if we are handed a file with no newlines.
+MAX_LINE_LENGTH = 100000
+
+# size of the buffer used when reading the decompressed stream
+READ_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Permitted characters.  Similar to fastQValidator, we allow IUPAC
+# codes in addition to ACGTN, and '.' for a missing base.
+VALID_BASES = b'ACGTNacgtnRYKMSWBDHVrykmswbdhv.'
+VALID_QUALITIES = bytes(range(33, 127))
+
+
+class FastqValidationResult(object):
+    '''
+    A simple object carrying the outcome of a validation pass.
+    '''
+    def __init__(self):
+        self.errors = []
+        self.num_records = 0
+        self.max_read_length = 0
+        self.long_read_error = False
+
+
+def _read_line(stream):
+    '''
+    Reads a single line (without the trailing newline) from the binary
+    stream.  Returns None at the end of the stream.  Raises a ValueError
+    if the line exceeds MAX_LINE_LENGTH.
+    '''
+    line = stream.readline(MAX_LINE_LENGTH)
+    if not line:
+        return None
+    if line.endswith(b'\n'):
+        line = line[:-1]
+        if line.endswith(b'\r'):
+            line = line[:-1]
+    elif len(line) == MAX_LINE_LENGTH:
+        raise ValueError('A line exceeded %d characters' % MAX_LINE_LENGTH)
+    return line
+
+
+def _decode(b):
+    return b.decode('utf-8', errors='replace')
+
+
+def check_record(header, seq, plus, qual, record_num, fastq_name):
+    '''
+    Checks a single FASTQ record.  Returns a list of error strings, which
+    is empty if the record was fine.
+    '''
+    errors = []
+    location = 'Fastq file (%s), record %d' % (fastq_name, record_num)
+    if not header.startswith(b'@'):
+        errors.append('%s: the header line did not start with "@" (found "%s").' % (location, _decode(header[:50])))
+    elif len(header) == 1:
+        errors.append('%s: the header line had no read identifier.' % location)
+    if len(seq) == 0:
+        errors.append('%s: the sequence was empty.' % location)
+    elif seq.translate(None, VALID_BASES):
+        errors.append('%s: the sequence contained invalid characters (%s).' % (location, _decode(seq.translate(None, VALID_BASES)[:10])))
+    if not plus.startswith(b'+'):
+        errors.append('%s: the third line did not start with "+" (found "%s").' % (location, _decode(plus[:50])))
+    elif (len(plus) > 1) and (plus[1:] != header[1:]):
+        errors.append('%s: the header on the "+" line did not match the "@" header line.' % location)
+    if len(qual) != len(seq):
+        errors.append('%s: the sequence had length %d, but the quality string had length %d.' % (location, len(seq), len(qual)))
+    if qual.translate(None, VALID_QUALITIES):
+        errors.append('%s: the quality string contained characters outside of the valid range.' % location)
+    return errors
+
+
+def validate_stream(stream, fastq_name, max_read_length=MAX_READ_LENGTH, max_errors=MAX_ERRORS, result=None):
+    '''
+    Validates the FASTQ records in a binary, decompressed stream.  The stream
+    only needs to implement readline(limit) and read(size).
+
+    Returns a FastqValidationResult.  Note that decompression errors raised by the
+    underlying stream are NOT caught here; see validate_fastq.  If `result` is
+    given, it is filled in-place so that partial results survive such an error.
+    '''
+    if result is None:
+        result = FastqValidationResult()
+    while True:
+        header = _read_line(stream)
+        if header is None:
+            break
+
+        # tolerate blank lines at the very end of the file
+        if len(header) == 0:
+            trailing = _read_line(stream)
+            if trailing is None:
+                break
+            result.errors.append('Fastq file (%s) had an unexpected blank line after record %d.' % (fastq_name, result.num_records))
+            header = trailing
+
+        seq = _read_line(stream)
+        plus = _read_line(stream)
+        qual = _read_line(stream)
+        result.num_records += 1
+        if qual is None:
+            result.errors.append('Fastq file (%s) ended with an incomplete record (record %d).' % (fastq_name, result.num_records))
+            break
+
+        result.errors.extend(check_record(header, seq, plus, qual, result.num_records, fastq_name))
+
+        read_length = len(seq)
+        if read_length > result.max_read_length:
+            result.max_read_length = read_length
+
+        # as before, report at most one "long read" error per fastq
+        if (read_length > max_read_length) and (not result.long_read_error):
+            result.long_read_error = True
+            result.errors.append('Fastq file (%s) had a read of length %d, '
+                'which is too long for a typical Illumina read.  Failing file.' % (fastq_name, read_length))
+
+        if len(result.errors) >= max_errors:
+            result.errors = result.errors[:max_errors]
+            result.errors.append('Fastq file (%s) had at least %d errors.  Stopped checking records.' % (fastq_name, max_errors))
+            # keep decompressing so that we still verify the integrity of the gzip stream
+            while stream.read(READ_BUFFER_SIZE):
+                pass
+            break
+
+    if result.num_records == 0 and len(result.errors) == 0:
+        result.errors.append('Fastq file (%s) did not contain any reads.' % fastq_name)
+    return result
+
+
+def open_fastq_stream(fastq_path):
+    '''
+    Returns a buffered, binary stream of the decompressed FASTQ
+    '''
+    return io.BufferedReader(gzip.open(fastq_path, 'rb'), buffer_size=READ_BUFFER_SIZE)
+
+
+def validate_fastq(fastq_path, max_read_length=MAX_READ_LENGTH, max_errors=MAX_ERRORS, stream=None):
+    '''
+    Validates a gzipped FASTQ in a single streaming pass.  Returns
+    a FastqValidationResult whose `errors` attribute is a list of error strings.
+
+    `stream` may be used to supply an alternative decompressed stream.
+    If None, the file is opened with the standard gzip module.
+    '''
+    result = FastqValidationResult()
+    try:
+        if stream is None:
+            stream = open_fastq_stream(fastq_path)
+        with stream:
+            validate_stream(stream, fastq_path, max_read_length, max_errors, result=result)
+    except (OSError, EOFError, zlib.error) as ex:
+        result.errors.append('The gzip-compressed fastq file (%s) was corrupted or not in gzip format: %s' % (fastq_path, ex))
+    except ValueError as ex:
+        result.errors.append('Fastq file (%s) was not formatted correctly: %s' % (fastq_path, ex))
+    return result
@@ -1,13 +1,18 @@
 #!/usr/bin/python3
 
-import subprocess as sp
 import json
 import argparse
+import numpy as np
 import pandas as pd
 import sys
 import os
+from concurrent.futures import ProcessPoolExecutor
 from jinja2 import Environment, FileSystemLoader
 
+import tool_versions
+import r_session_info
+import instrumentation
+
 # some variables for common reference.
 # many refer to keys set in the json file of
 # config variables
@@ -23,6 +28,15 @@ GENOME = 'genome'
 NC_FILE_SUFFIX = 'normalized_counts_file_suffix'
 VERSUS_SEP = 'versus_sep'
 ADJ_PVAL = 'adj_pval'
+LFC_THRESHOLD = 'lfc_threshold'
+PERFORMANCE_LOGS = 'performance_logs'
+
+# the columns of the DESeq2 output needed for summarizing the contrasts
+DESEQ_SUMMARY_COLUMNS = ['padj', 'log2FoldChange']
+
+# additional thresholds at which we count the differentially expressed genes
+SUMMARY_PADJ_THRESHOLDS = [0.1, 0.05, 0.01, 0.001]
+SUMMARY_LFC_THRESHOLDS = [0.0, 1.0, 2.0]
 
 
 class InputDisplay(object):
@@ -52,12 +66,41 @@ class ContrastDisplay(object):
         exp_condition, 
         up_counts, 
         down_counts,
-        contrast_name):
+        contrast_name,
+        lfc_thresholds=None,
+        threshold_rows=None):
         self.base_condition = base_condition
         self.exp_condition = exp_condition
         self.up_counts = up_counts
         self.down_counts = down_counts
         self.contrast_name = contrast_name
+        self.lfc_thresholds = lfc_thresholds if lfc_thresholds else []
+        self.threshold_rows = threshold_rows if threshold_rows else []
+
+
+class PerformanceDisplay(object):
+    '''
+    Summarizes a single phase of a script across all of its runs
+    (e.g. one per sample or contrast).
+    '''
+    def __init__(self, script, phase, runs, mean_wall_time, max_wall_time, max_cpu_time, max_rss_mb):
+        self.script = script
+        self.phase = phase
+        self.runs = runs
+        self.mean_wall_time = mean_wall_time
+        self.max_wall_time = max_wall_time
+        self.max_cpu_time = max_cpu_time
+        self.max_rss_mb = max_rss_mb
+
+
+class ThresholdRow(object):
+    '''
+    Holds the (up, down) counts for a single adjusted p-value 
+    threshold, one pair per log2 fold-change threshold.
+    '''
+    def __init__(self, padj_threshold, counts):
+        self.padj_threshold = padj_threshold
+        self.counts = counts
 
 
 def get_jinja_template(template_path):
@@ -80,74 +123,133 @@ def create_annotation_objects(annotation_file):
     return [AnnotationDisplay(r['sample'], r['condition']) for i,r in df.iterrows()]
 
 
-def run_cmd(cmd, return_stderr=False):
+def get_versions():
     '''
-    Runs a command through the shell
+    Gets the tool versions from the cached version manifest.  Tools are
+    only run if they are missing from (or have changed since) the manifest.
     '''
-    p = sp.Popen(cmd, shell=True, stderr=sp.PIPE, stdout=sp.PIPE)
-    stdout, stderr = p.communicate()
-    if return_stderr:
-        return stderr.decode('utf-8')
-    return stdout.decode('utf-8')
+    return tool_versions.get_versions()
 
+def count_by_thresholds(padj, lfc, padj_thresholds, lfc_thresholds):
+    '''
+    Counts the up- and down-regulated genes for every combination of thresholds
+    in a single vectorized pass.  A gene is counted as up-regulated at (p, l) if
+    padj <= p and log2FoldChange > l (and likewise for down with < -l).
 
-def get_versions():
+    Returns two integer arrays (up, down) of shape (len(padj_thresholds), len(lfc_thresholds))
+    '''
+    padj_thresholds = np.asarray(padj_thresholds, dtype=np.float64)
+    lfc_thresholds = np.asarray(lfc_thresholds, dtype=np.float64)
+    # comparisons with NaN (e.g. genes filtered by DESeq2) are simply False
+    with np.errstate(invalid='ignore'):
+        sig = (padj[:,None] <= padj_thresholds[None,:]).astype(np.int64)
+        up = (lfc[:,None] > lfc_thresholds[None,:]).astype(np.int64)
+        down = (lfc[:,None] < -lfc_thresholds[None,:]).astype(np.int64)
+    return (sig.T.dot(up), sig.T.dot(down))
+
+
+def summarize_contrast(f, versus_sep, padj_thresholds, lfc_thresholds):
     '''
-    Runs the command to get the versions
+    Reads only the needed columns of a single DESeq2 output table and counts
+    the differentially expressed genes at each pair of thresholds
     '''
-    star_version_str = run_cmd('STAR --version')
-    samtools_version_str = run_cmd('samtools --version')
-    fc_version_str = run_cmd('featureCounts -v', return_stderr=True)
-    multiqc_version_str = run_cmd('multiqc --version')
-    fastqc_version_str = run_cmd('fastqc --version')
-    rseqc_version_str = run_cmd('pip3 freeze | grep RSeQC')
-    picard_md_str = run_cmd('java -jar /opt/software/picard/picard.jar MarkDuplicates --version', return_stderr=True)
-    
-    # post-process these to extract just the version number:
-    star_version = star_version_str.strip().split('_')[1]
-    samtools_version = samtools_version_str.split('\n')[0].split(' ')[1]
-    fc_version = fc_version_str.strip().split(' ')[-1]
-    multiqc_version = multiqc_version_str.strip().split(',')[-1].split(' ')[-1]
-    fastqc_version = fastqc_version_str.strip().split(" ")[-1]
-    rseqc_version = rseqc_version_str.strip().split('==')[1]
-    picard_md_version = picard_md_str.strip().split(' ')[-1]
-
-    d = {}
-    d['star_version'] = star_version
-    d['samtools_version'] = samtools_version
-    d['featurecounts_version'] = fc_version
-    d['multiqc_version'] = multiqc_version
-    d['fastqc_version'] = fastqc_version
-    d['rseqc_version'] = rseqc_version
-    d['picard_mark_duplicates_version'] = picard_md_version
-    return d
-
-def summarize_contrasts(deseq_outputs, versus_sep, adj_pval_threshold):
-    '''
-    Parses through the contrasts and extracts summary info
+    # f is the filename, e.g. A_versus_B.deseq.tsv (or something like that)
+    # the base and experimental condition are separated by `versus_sep`, which
+    # we show as '_versus_' above.  The first (A) is considered the experimental
+    # condition.
+    contrast_name = os.path.basename(f).split('.')[0]
+    experimental, base = contrast_name.split(versus_sep)
+    df = pd.read_csv(f, 
+        sep='\t', 
+        usecols=DESEQ_SUMMARY_COLUMNS, 
+        dtype=dict((c, np.float64) for c in DESEQ_SUMMARY_COLUMNS)
+    )
+    up, down = count_by_thresholds(df['padj'].values, 
+        df['log2FoldChange'].values, 
+        padj_thresholds, 
+        lfc_thresholds
+    )
+    return (base, experimental, contrast_name, up, down)
+
+
+def summarize_contrasts(deseq_outputs, versus_sep, adj_pval_threshold, lfc_threshold=None, workers=None):
+    '''
+    Parses through the contrasts (concurrently) and extracts summary info.  In
+    addition to the up/down counts at the chosen adjusted p-value threshold, each
+    summary has the counts at several adjusted p-value and log2 fold-change thresholds.
     '''
+    padj_thresholds = sorted(set(SUMMARY_PADJ_THRESHOLDS + [adj_pval_threshold]), reverse=True)
+    lfc_thresholds = set(SUMMARY_LFC_THRESHOLDS + [0.0])
+    if lfc_threshold is not None:
+        lfc_thresholds.add(lfc_threshold)
+    lfc_thresholds = sorted(lfc_thresholds)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(deseq_outputs))
+    args = (versus_sep, padj_thresholds, lfc_thresholds)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(summarize_contrast, f, *args) for f in deseq_outputs]
+            results = [x.result() for x in futures]
+    else:
+        results = [summarize_contrast(f, *args) for f in deseq_outputs]
+
+    # the counts shown in the main table: padj at the chosen threshold and any change
+    i = padj_thresholds.index(adj_pval_threshold)
+    j = lfc_thresholds.index(0.0)
     summary_list = []
-    for f in deseq_outputs:
-        # f is the filename, e.g. A_versus_B.deseq.tsv (or something like that)
-        # the base and experimental condition are separated by `versus_sep`, which
-        # we show as '_versus_' above.  The first (A) is considered the experimental
-        # condition.
-        contrast_name = os.path.basename(f).split('.')[0]
-        experimental, base = contrast_name.split(versus_sep)
-        df = pd.read_csv(f, sep='\t')
-        sig = df.loc[df['padj'] <= adj_pval_threshold]
-        up_count = pd.np.sum(sig['log2FoldChange'] > 0)
-        down_count = pd.np.sum(sig['log2FoldChange'] < 0)
-        c = ContrastDisplay(base, experimental, up_count, down_count, contrast_name)
+    for base, experimental, contrast_name, up, down in results:
+        threshold_rows = [ThresholdRow(p, list(zip(up[k].tolist(), down[k].tolist()))) 
+            for k, p in enumerate(padj_thresholds)]
+        c = ContrastDisplay(base, 
+            experimental, 
+            int(up[i,j]), 
+            int(down[i,j]), 
+            contrast_name,
+            lfc_thresholds=lfc_thresholds,
+            threshold_rows=threshold_rows
+        )
         summary_list.append(c)
     return summary_list
-    
+
+def summarize_performance(records):
+    '''
+    Aggregates the per-phase performance records (see instrumentation.py) by
+    script and phase, in the order they were first seen.  Each script also
+    gets a 'total' row.  Returns a list of PerformanceDisplay
+    '''
+    phases = {}
+    order = []
+    for record in records:
+        rows = record['phases'] + [dict(record['total'], phase='total')]
+        for row in rows:
+            key = (record['script'], row['phase'])
+            if key not in phases:
+                phases[key] = []
+                order.append(key)
+            phases[key].append(row)
+    summary = []
+    for script, phase in order:
+        rows = phases[(script, phase)]
+        wall_times = [r['wall_time'] for r in rows]
+        summary.append(PerformanceDisplay(script, 
+            phase, 
+            len(rows),
+            sum(wall_times) / len(wall_times),
+            max(wall_times),
+            max(r['cpu_time'] for r in rows),
+            max(r['max_rss_mb'] for r in rows)
+        ))
+    return summary
+
 def get_r_environment():
     '''
-    Gets the sessionInfo for all bioc packages
+    Gets the sessionInfo for all bioc packages as a dict.  This is read from
+    the snapshot captured when the image was built, so R is only started if
+    the R library has changed since.
     '''
-    cmd = 'R -e "library(\'DESeq2\'); sessionInfo();"'
-    return run_cmd(cmd)
+    return r_session_info.get_session_info()
 
 
 def parse_input():
@@ -161,6 +263,8 @@ def parse_input():
     parser.add_argument('-o', required=True, dest=OUTPUT)
     parser.add_argument('-j', required=True, dest=CFG)
     parser.add_argument('-r1', required=True, dest=R1, nargs='+')
+    parser.add_argument('-p', required=False, dest=PERFORMANCE_LOGS, nargs='*', default=[],
+        help='Performance records (JSON) written by the other pipeline scripts.')
 
     args = parser.parse_args()
     return vars(args)
@@ -183,15 +287,19 @@ if __name__ == '__main__':
     arg_dict = parse_input()
     output_file = arg_dict.pop(OUTPUT)
     input_template_path = arg_dict.pop(TEMPLATE)
+    performance_logs = arg_dict.pop(PERFORMANCE_LOGS)
+    perf = instrumentation.Instrumentation('generate_report.py')
 
-    # get all the software versions:
-    versions_dict = get_versions()
+    with perf.phase('versions'):
+        # get all the software versions:
+        versions_dict = get_versions()
 
-    # get the info about R/Bioc we used:
-    session_info = get_r_environment()
+        # get the info about R/Bioc we used:
+        session_info = get_r_environment()
 
-    # get a list of objects for showing the sample annotations:
-    annotations_object_list = create_annotation_objects(arg_dict[ANNOTATIONS])
+    with perf.phase('parse inputs'):
+        # get a list of objects for showing the sample annotations:
+        annotations_object_list = create_annotation_objects(arg_dict[ANNOTATIONS])
 
     # parse the json file which has additional variables
     j = json.load(open(arg_dict[CFG]))
@@ -205,11 +313,19 @@ if __name__ == '__main__':
         file_display.append(ipd)
 
     # get info about the contrasts performed:
-    contrast_display_list = summarize_contrasts(
-        arg_dict[DESEQ_OUTPUT], 
-        j[VERSUS_SEP], 
-        float(j[ADJ_PVAL])
-    )
+    with perf.phase('summarize contrasts'):
+        contrast_display_list = summarize_contrasts(
+            arg_dict[DESEQ_OUTPUT], 
+            j[VERSUS_SEP], 
+            float(j[ADJ_PVAL]),
+            float(j[LFC_THRESHOLD])
+        )
+
+    # the performance of the other scripts, and of this one so far:
+    performance_records = instrumentation.load_records(performance_logs)
+    if performance_records:
+        performance_records.append(perf.to_dict())
+    performance_display = summarize_performance(performance_records)
 
     # get the suffix for the deseq files:
     deseq_suffix = '.'.join(arg_dict[DESEQ_OUTPUT][0].split('.')[1:])
@@ -221,11 +337,15 @@ if __name__ == '__main__':
     context.update(j)
     
     context[ANNOTATIONS] = os.path.basename(context[ANNOTATIONS])
-    context.update({'session_info': session_info})
+    context.update({'r_session': session_info})
+    context.update({'session_info': session_info['session_info_text'] if session_info else ''})
     context.update({'annotation_objs': annotations_object_list})
     context.update({'file_display': file_display})
     context.update({'contrast_display': contrast_display_list})
     context.update({'deseq2_output_file_suffix': deseq_suffix})
+    context.update({'performance': performance_display})
 
     # fill and write the completed report:
-    fill_template(context, input_template_path, output_file)
+    with perf.phase('render'):
+        fill_template(context, input_template_path, output_file)
+    perf.write()
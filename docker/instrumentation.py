@@ -0,0 +1,145 @@
+'''
+Lightweight per-phase instrumentation for the pipeline's python scripts.
+
+Each script creates an Instrumentation and wraps its phases, e.g.
+
+    perf = Instrumentation('make_dge_plots.py', label=contrast_name)
+    with perf.phase('scatter plots'):
+        ...
+    perf.write()
+
+For each phase we record the wall time, the CPU time (of the process and of any
+child processes it has waited for, e.g. process pools) and the peak RSS so far.
+Note that the peak RSS is a high-water mark for the whole process, so it is
+non-decreasing across the phases of a single script.
+
+The records are only written if a path is given, or set by the PERFORMANCE_LOG
+environment variable.  generate_report.py aggregates them into the
+"Pipeline performance" section of the report.
+'''
+
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+PERFORMANCE_LOG_ENV = 'PERFORMANCE_LOG'
+RECORD_FORMAT_VERSION = 1
+
+# ru_maxrss is in kilobytes on Linux, but bytes on macOS
+MAXRSS_TO_MB = 1.0 / (1024 * 1024) if sys.platform == 'darwin' else 1.0 / 1024
+
+
+def get_cpu_time():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + child_usage.ru_utime + child_usage.ru_stime
+
+
+def get_max_rss_mb():
+    '''
+    The peak RSS of this process or (separately) of its largest child
+    '''
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return max(self_usage.ru_maxrss, child_usage.ru_maxrss) * MAXRSS_TO_MB
+
+
+class PhaseRecord(object):
+    def __init__(self, name, wall_time, cpu_time, max_rss_mb):
+        self.name = name
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.max_rss_mb = max_rss_mb
+
+    def to_dict(self):
+        return {
+            'phase': self.name,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'max_rss_mb': self.max_rss_mb
+        }
+
+
+class Instrumentation(object):
+    '''
+    Collects the PhaseRecords of a single run of a script.  `label` distinguishes
+    runs of the same script (e.g. the contrast or sample).
+    '''
+    def __init__(self, script, label=None, output_path=None):
+        self.script = script
+        self.label = label
+        self.output_path = output_path if output_path else os.environ.get(PERFORMANCE_LOG_ENV)
+        self.phases = []
+        self.start_wall = time.time()
+        self.start_cpu = get_cpu_time()
+
+    @contextmanager
+    def phase(self, name):
+        wall = time.time()
+        cpu = get_cpu_time()
+        try:
+            yield
+        finally:
+            self.phases.append(PhaseRecord(name, time.time() - wall, get_cpu_time() - cpu, get_max_rss_mb()))
+
+    def instrument(self, name):
+        '''
+        A decorator which records each call of the function as a phase
+        '''
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def to_dict(self):
+        return {
+            'format_version': RECORD_FORMAT_VERSION,
+            'script': self.script,
+            'label': self.label,
+            'host': platform.node(),
+            'cpu_count': os.cpu_count(),
+            'phases': [p.to_dict() for p in self.phases],
+            'total': {
+                'wall_time': time.time() - self.start_wall,
+                'cpu_time': get_cpu_time() - self.start_cpu,
+                'max_rss_mb': get_max_rss_mb()
+            }
+        }
+
+    def write(self):
+        '''
+        Writes the JSON record, if there is somewhere to write it.  Failing to write
+        the record should never fail the script itself.
+        '''
+        if not self.output_path:
+            return
+        try:
+            with open(self.output_path, 'w') as fout:
+                json.dump(self.to_dict(), fout, indent=2)
+        except (OSError, IOError) as ex:
+            sys.stderr.write('Could not write the performance record to %s: %s\n' % (self.output_path, ex))
+
+
+def load_records(paths):
+    '''
+    Reads the JSON records written by Instrumentation.write.  Unreadable
+    records are skipped.
+    '''
+    records = []
+    for path in paths:
+        try:
+            with open(path) as fin:
+                record = json.load(fin)
+        except (OSError, IOError, ValueError):
+            continue
+        if record.get('format_version') == RECORD_FORMAT_VERSION:
+            records.append(record)
+    return records
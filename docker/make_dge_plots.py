@@ -1,6 +1,9 @@
 import argparse
 import sys
 import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -8,11 +11,26 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import seaborn as sns
+from PIL import Image
+from PyPDF2 import PdfFileMerger
 from bokeh.plotting import figure, output_file, save
 from bokeh.models import ColumnDataSource, HoverTool
 
+from count_matrix_sidecar import read_count_matrix
+from instrumentation import Instrumentation
+
 sns.set_style('darkgrid')
 
+# the number of gene panels drawn on each page of the scatter plot matrix
+GENES_PER_PAGE = 30
+
+# For the interactive volcano plot, non-significant genes are binned on a 
+# VOLCANO_GRID_BINS x VOLCANO_GRID_BINS grid and at most VOLCANO_POINTS_PER_BIN
+# are kept in each bin.
+VOLCANO_GRID_BINS = 100
+VOLCANO_POINTS_PER_BIN = 10
+MIN_PLOTTED_PADJ = 1e-300
+
 def get_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', 
@@ -67,17 +85,25 @@ def get_arguments():
         help= 'The experimental condition'
     )
 
+    parser.add_argument('-j',
+        dest='num_jobs',
+        default=os.cpu_count() or 1,
+        type=int,
+        help= 'The number of processes used for rendering figures (default: %(default)s)'
+    )
+
     args = parser.parse_args()
     return vars(args)
 
 
-def jitter(n, mid, delta=0.2):
-    return delta*np.random.random(n)-0.5*delta + mid
+def jitter(n, mid, delta=0.2, random_state=np.random):
+    return delta*random_state.random_sample(n)-0.5*delta + mid
 
 
-def make_scatter_plot_matrix(dge_df, nc, annotations, nmax, padj_threshold, contrast_id, output_dir):
+def make_scatter_plot_matrix(dge_df, nc, annotations, nmax, padj_threshold, contrast_id, output_dir, num_jobs=1):
     '''
-    This makes a scatter plot for the top genes
+    This makes a scatter plot for the top genes.  The panels are split into pages
+    which are rendered in up to `num_jobs` processes.
     '''
 
     unique_conditions = annotations['condition'].unique()
@@ -116,47 +142,161 @@ def make_scatter_plot_matrix(dge_df, nc, annotations, nmax, padj_threshold, cont
         fig.savefig(os.path.join(output_dir, '%s.scatter_plot.png' % contrast_id), bbox_inches='tight')
         plt.close()
         return
-    nrows = int(np.ceil(N/ncols))
-    fig, axarray = plt.subplots(nrows=nrows, ncols=ncols, figsize=(20,5*nrows))
-    for i in range(N):
+
+    # gather all the requested values in a single vectorized slice
+    top_rows = dge_df.iloc[:N]
+    values = nc.loc[top_rows['Gene'].values]
+    group1_values = values[group1_samples].values
+    group2_values = values[group2_samples].values
+    titles = ['%s (p=%.2e, p-adj=%.2e)' % x for x in zip(top_rows['Gene'], top_rows['pvalue'], top_rows['padj'])]
+
+    pages = []
+    for start in range(0, N, GENES_PER_PAGE):
+        stop = min(N, start + GENES_PER_PAGE)
+        pages.append(ScatterPage(
+            len(pages),
+            group1_values[start:stop], 
+            group2_values[start:stop], 
+            titles[start:stop], 
+            group1_name, 
+            group2_name, 
+            ncols
+        ))
+
+    pdf_path = os.path.join(output_dir, '%s.scatter_plot.pdf' % contrast_id)
+    png_path = os.path.join(output_dir, '%s.scatter_plot.png' % contrast_id)
+    render_scatter_pages(pages, pdf_path, png_path, num_jobs)
+
+
+class ScatterPage(object):
+    '''
+    Carries the data needed to draw one page of the scatter plot matrix.
+    '''
+    def __init__(self, page_num, group1_values, group2_values, titles, group1_name, group2_name, ncols):
+        self.page_num = page_num
+        self.group1_values = group1_values
+        self.group2_values = group2_values
+        self.titles = titles
+        self.group1_name = group1_name
+        self.group2_name = group2_name
+        self.ncols = ncols
+
+
+def draw_scatter_page(page):
+    '''
+    Draws a single page of the scatter plot matrix and returns the figure
+    '''
+    plt.rcParams['font.family'] = 'serif'
+    plt.rcParams['font.size'] = 14
+
+    # seed by page so the jitter does not depend on which worker draws the page
+    random_state = np.random.RandomState(page.page_num)
+
+    ncols = page.ncols
+    n = len(page.titles)
+    nrows = int(np.ceil(n/ncols))
+    fig, axarray = plt.subplots(nrows=nrows, ncols=ncols, figsize=(20,5*nrows), squeeze=False)
+    for i in range(n):
         r = i // ncols
         c = i % ncols
         ax = axarray[r,c]
-        dge_row = dge_df.iloc[i]
-        gene_name = dge_row['Gene']
-        counts = nc.loc[gene_name]
-        group1_counts = counts[group1_samples]
-        group2_counts = counts[group2_samples]
+        group1_counts = page.group1_values[i]
+        group2_counts = page.group2_values[i]
         ax.scatter(
-            jitter(group1_counts.shape[0], 0.0),
+            jitter(group1_counts.shape[0], 0.0, random_state=random_state),
             group1_counts,
             alpha=0.5,
             s=100
         )
         ax.scatter(
-            jitter(group2_counts.shape[0], 1.0),
+            jitter(group2_counts.shape[0], 1.0, random_state=random_state),
             group2_counts,
             alpha=0.5,
             s=100
         )
         ax.set_xticks([0,1])
         ax.set_xlim([-0.25, 1.25])
-        ax.set_xticklabels([group1_name, group2_name])
-        ax.set_title('%s (p=%.2e, p-adj=%.2e)' % (gene_name, dge_row['pvalue'], dge_row['padj']))
+        ax.set_xticklabels([page.group1_name, page.group2_name])
+        ax.set_title(page.titles[i])
 
     # now remove any excess empty axes:
-    total_axes = nrows*ncols
-    if total_axes > N:
-        index = N
-        while index < total_axes:
-            r = index // ncols
-            c = index % ncols
-            fig.delaxes(axarray[r,c])
-            index += 1
+    for index in range(n, nrows*ncols):
+        fig.delaxes(axarray[index // ncols, index % ncols])
 
     plt.tight_layout()
-    fig.savefig(os.path.join(output_dir, '%s.scatter_plot.pdf' % contrast_id), bbox_inches='tight')
-    fig.savefig(os.path.join(output_dir, '%s.scatter_plot.png' % contrast_id), bbox_inches='tight')
+    return fig
+
+
+def save_scatter_page(page, pdf_path, png_path):
+    '''
+    Draws the page once and saves it as both a PDF and a PNG
+    '''
+    fig = draw_scatter_page(page)
+    fig.savefig(pdf_path, bbox_inches='tight')
+    fig.savefig(png_path, bbox_inches='tight')
+    plt.close(fig)
+    return (pdf_path, png_path)
+
+
+def merge_pdf_pages(page_paths, pdf_path):
+    '''
+    Concatenates the single-page PDFs into one (multi-page) PDF
+    '''
+    merger = PdfFileMerger()
+    for p in page_paths:
+        merger.append(p)
+    with open(pdf_path, 'wb') as fout:
+        merger.write(fout)
+    merger.close()
+
+
+def stitch_png_pages(page_paths, png_path):
+    '''
+    Stacks the PNG pages vertically into a single image
+    '''
+    images = [Image.open(p) for p in page_paths]
+    width = max([im.size[0] for im in images])
+    height = sum([im.size[1] for im in images])
+    stitched = Image.new('RGBA', (width, height), (255, 255, 255, 255))
+    y = 0
+    for im in images:
+        stitched.paste(im, (0, y))
+        y += im.size[1]
+    stitched.save(png_path)
+
+
+def render_scatter_pages(pages, pdf_path, png_path, num_jobs):
+    '''
+    Renders the pages in a pool of processes.  Each page is drawn once, by a single
+    worker, and saved as both a PDF and a PNG page.  The pages are then merged into
+    the multi-page PDF and stacked into a single image.
+    '''
+    if len(pages) == 1:
+        pdf_page_paths = [pdf_path]
+        png_page_paths = [png_path]
+        tmp_dir = None
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        pdf_page_paths = [os.path.join(tmp_dir, 'page%d.pdf' % p.page_num) for p in pages]
+        png_page_paths = [os.path.join(tmp_dir, 'page%d.png' % p.page_num) for p in pages]
+
+    try:
+        if num_jobs > 1 and len(pages) > 1:
+            with ProcessPoolExecutor(max_workers=min(num_jobs, len(pages))) as pool:
+                futures = [pool.submit(save_scatter_page, page, pdf_page_path, png_page_path)
+                    for page, pdf_page_path, png_page_path in zip(pages, pdf_page_paths, png_page_paths)]
+                for f in futures:
+                    f.result()
+        else:
+            for page, pdf_page_path, png_page_path in zip(pages, pdf_page_paths, png_page_paths):
+                save_scatter_page(page, pdf_page_path, png_page_path)
+
+        if tmp_dir is not None:
+            merge_pdf_pages(pdf_page_paths, pdf_path)
+            stitch_png_pages(png_page_paths, png_path)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
 
 
 def make_volcano_plot(dge_df, padj_threshold, contrast_id, output_dir):
@@ -181,31 +321,72 @@ def make_volcano_plot(dge_df, padj_threshold, contrast_id, output_dir):
     fig.savefig(os.path.join(output_dir, '%s.volcano_plot.png' % contrast_id), bbox_inches='tight')
 
 
-def interactive_volcano(dge_df, padj_threshold, contrast_id, output_dir):
+def decimate_points(x, y, n_bins=VOLCANO_GRID_BINS, max_per_bin=VOLCANO_POINTS_PER_BIN, seed=0):
     '''
-    Makes a dynamic plot using Bokeh
+    Bins the (x, y) plane into an n_bins x n_bins grid and keeps every point
+    in sparsely-populated bins, but at most `max_per_bin` (randomly chosen) points
+    in the dense bins.  Returns a boolean mask of the points to keep.
     '''
+    n = x.shape[0]
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+
+    def to_bin(v):
+        vmin = v.min()
+        span = v.max() - vmin
+        if span == 0:
+            return np.zeros(n, dtype=np.int64)
+        return np.minimum(((v - vmin) / span * n_bins).astype(np.int64), n_bins - 1)
 
-    # split the data to sig and insig:
-    sig_row_idx = dge_df['padj'] <= padj_threshold
-    sig_rows = dge_df.loc[sig_row_idx]
-    unsig_rows = dge_df.loc[~sig_row_idx]
-
-    # subsample the insignificant ones so we don't send too much to the front-end
-    fraction = 0.1
-    n_sample = int(unsig_rows.shape[0]*fraction)
-    keep_idx = np.random.permutation(~sig_row_idx)[:n_sample]
-    unsig_rows = unsig_rows.loc[keep_idx]
-
-    # extract the data and make a ColumnDataSource for Bokeh
-    sig_x_vals = sig_rows['log2FoldChange'].values
-    unsig_x_vals = unsig_rows['log2FoldChange'].values
-    padj_vals = sig_rows['padj'].values
-    sig_y_vals = -np.log10(sig_rows['padj'].values)
-    unsig_y_vals = -np.log10(unsig_rows['padj'].values)
-    sig_gene_names = sig_rows['Gene'].values
-    sig_source = ColumnDataSource(data=dict(x=sig_x_vals, y=sig_y_vals, gene=sig_gene_names, padj=padj_vals))
-    unsig_source = ColumnDataSource(data=dict(x=unsig_x_vals, y=unsig_y_vals))
+    bin_id = to_bin(x) * n_bins + to_bin(y)
+
+    # sort by bin, in random order within each bin, then rank each point within its bin
+    random_key = np.random.RandomState(seed).random_sample(n)
+    order = np.lexsort((random_key, bin_id))
+    sorted_bins = bin_id[order]
+    is_first = np.ones(n, dtype=bool)
+    is_first[1:] = sorted_bins[1:] != sorted_bins[:-1]
+    first_position = np.maximum.accumulate(np.where(is_first, np.arange(n), 0))
+    rank = np.arange(n) - first_position
+
+    keep = np.zeros(n, dtype=bool)
+    keep[order[rank < max_per_bin]] = True
+    return keep
+
+
+def interactive_volcano(dge_df, padj_threshold, contrast_id, output_dir):
+    '''
+    Makes a dynamic plot using Bokeh.  All the significant genes are shown, but the
+    non-significant genes are decimated so that dense regions of the plot do
+    not send too many points to the front-end.
+    '''
+    x_vals = dge_df['log2FoldChange'].values
+    padj_vals = dge_df['padj'].values
+
+    # padj of zero would give an infinite y-value
+    y_vals = -np.log10(np.clip(padj_vals, MIN_PLOTTED_PADJ, None))
+
+    # split the data to sig and insig.  Genes without an adjusted p-value
+    # (e.g. filtered by DESeq2) cannot be placed on the plot.
+    finite = np.isfinite(x_vals) & np.isfinite(y_vals)
+    sig_row_idx = finite & (padj_vals <= padj_threshold)
+    unsig_row_idx = np.where(finite & ~sig_row_idx)[0]
+    keep = decimate_points(x_vals[unsig_row_idx], y_vals[unsig_row_idx])
+    unsig_row_idx = unsig_row_idx[keep]
+
+    # make ColumnDataSources for Bokeh.  Float32 arrays are compactly 
+    # encoded (as base64) in the HTML.  We keep the full precision for the adjusted
+    # p-values since they can be smaller than a float32 can hold.
+    sig_source = ColumnDataSource(data=dict(
+        x=x_vals[sig_row_idx].astype(np.float32), 
+        y=y_vals[sig_row_idx].astype(np.float32), 
+        gene=dge_df['Gene'].values[sig_row_idx].tolist(), 
+        padj=padj_vals[sig_row_idx].astype(np.float64)
+    ))
+    unsig_source = ColumnDataSource(data=dict(
+        x=x_vals[unsig_row_idx].astype(np.float32), 
+        y=y_vals[unsig_row_idx].astype(np.float32)
+    ))
 
     # behavior of the hover:
     hover = HoverTool(
@@ -235,28 +416,34 @@ def interactive_volcano(dge_df, padj_threshold, contrast_id, output_dir):
 
 if __name__ == '__main__':
     args = get_arguments()
-    dg_table = pd.read_table(args['dg_table'])
-    nc_table = pd.read_table(args['counts_table'], index_col=0)
-    annotations = pd.read_table(args['sample_annotations'], header=None, names=['sample', 'condition'])
+    perf = Instrumentation('make_dge_plots.py', label=args['contrast_id'])
+    with perf.phase('read inputs'):
+        dg_table = pd.read_table(args['dg_table'])
+        nc_table = read_count_matrix(args['counts_table'])
+        annotations = pd.read_table(args['sample_annotations'], header=None, names=['sample', 'condition'])
     
     # subset the annotations for this contrast:
     conditions = np.array([args['base_condition'], args['experimental_condition']])
     annotations = annotations.loc[annotations.condition.isin(conditions)]
     
-    make_scatter_plot_matrix(
-        dg_table, 
-        nc_table, 
-        annotations, 
-        args['num_genes'], 
-        args['padj_threshold'],
-        args['contrast_id'],
-        args['output_dir']
-    )
+    with perf.phase('scatter plots'):
+        make_scatter_plot_matrix(
+            dg_table, 
+            nc_table, 
+            annotations, 
+            args['num_genes'], 
+            args['padj_threshold'],
+            args['contrast_id'],
+            args['output_dir'],
+            args['num_jobs']
+        )
 
     #make_volcano_plot(dg_table, args['padj_threshold'], contrast_id, output_dir)
-    interactive_volcano(
-        dg_table, 
-        args['padj_threshold'],
-        args['contrast_id'],
-        args['output_dir']
-    )
+    with perf.phase('volcano plot'):
+        interactive_volcano(
+            dg_table, 
+            args['padj_threshold'],
+            args['contrast_id'],
+            args['output_dir']
+        )
+    perf.write()
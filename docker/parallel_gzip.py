@@ -0,0 +1,386 @@
+'''
+A multi-core decompression layer for gzipped FASTQ files.
+
+BGZF files (and, more generally, gzip files composed of many concatenated
+members) can be inflated in parallel since each member is independent.
+We split the compressed file into spans which begin on member boundaries, inflate
+the spans in a pool of worker threads (zlib releases the GIL while inflating), and
+hand the decompressed data back to the caller in the original order.
+
+- For BGZF, the member boundaries are given exactly by the BSIZE field of each
+  block header, so we can walk the blocks without inflating anything.
+- For other multi-member gzip files, we search for the gzip magic bytes and
+  confirm each candidate by test-inflating a few bytes.  If a candidate turns out
+  to be spurious (the preceding span does not end cleanly), we fall back to
+  serial decompression from the start of that span, so the output is always correct.
+- A plain, single-member gzip file cannot be split.  This falls back to the
+  standard, single-threaded gzip module.
+
+Throughput is tracked in a DecompressionStats object so that we can size the
+pre-check tasks.
+'''
+
+import collections
+import gzip
+import io
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+GZIP_MAGIC = b'\x1f\x8b\x08'
+FEXTRA = 4
+
+# tells zlib to expect a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# The target size (in compressed bytes) of the spans handed to the workers.
+# BGZF blocks are at most 64KB, so each span holds many blocks.
+SPAN_SIZE = 4 * 1024 * 1024
+
+# If we cannot find a member boundary within this many bytes, the file is either
+# a single-member gzip or has very large members.  Either way, we decompress serially.
+MAX_SPAN_SIZE = 64 * 1024 * 1024
+
+# number of compressed bytes we test-inflate to confirm a candidate member boundary
+VERIFY_BYTES = 1024
+
+# size of reads in the serial path
+SERIAL_READ_SIZE = 4 * 1024 * 1024
+
+BGZF = 'bgzf'
+MULTI_MEMBER = 'multi-member gzip'
+SINGLE_MEMBER = 'single-member gzip'
+SERIAL = 'serial'
+
+
+class DecompressionStats(object):
+    '''
+    Carries information about a decompression pass, including the
+    throughput achieved per core.
+    '''
+    def __init__(self):
+        self.mode = None
+        self.workers = 1
+        self.compressed_bytes = 0
+        self.decompressed_bytes = 0
+        self.parallel_spans = 0
+        self.serial_fallback_offset = None
+        self.busy_seconds = 0.0
+        self.wall_seconds = 0.0
+
+    def throughput(self):
+        '''
+        Overall decompressed MB per wall-clock second
+        '''
+        if self.wall_seconds <= 0:
+            return 0.0
+        return self.decompressed_bytes / 1e6 / self.wall_seconds
+
+    def throughput_per_core(self):
+        '''
+        Decompressed MB per second of time a core actually spent inflating
+        '''
+        if self.busy_seconds <= 0:
+            return 0.0
+        return self.decompressed_bytes / 1e6 / self.busy_seconds
+
+    def summary(self):
+        s = ('Decompression of %.1f MB (%.1f MB inflated) in %s mode with %d worker(s): '
+            '%.2f s wall, %.1f MB/s overall, %.1f MB/s per core.') % (
+            self.compressed_bytes / 1e6,
+            self.decompressed_bytes / 1e6,
+            self.mode,
+            self.workers,
+            self.wall_seconds,
+            self.throughput(),
+            self.throughput_per_core()
+        )
+        if self.serial_fallback_offset is not None:
+            s += '  Fell back to serial decompression at byte offset %d.' % self.serial_fallback_offset
+        return s
+
+
+def _bgzf_block_size(buf, pos):
+    '''
+    Returns the total size of the BGZF block starting at `pos` in `buf`.
+    Returns None if `buf` does not hold the complete header and -1 if the header
+    is not a BGZF block header.
+    '''
+    if len(buf) < pos + 12:
+        return None
+    if (buf[pos:pos+3] != GZIP_MAGIC) or not (buf[pos+3] & FEXTRA):
+        return -1
+    xlen = struct.unpack('<H', buf[pos+10:pos+12])[0]
+    if len(buf) < pos + 12 + xlen:
+        return None
+    i = pos + 12
+    end = i + xlen
+    while i + 4 <= end:
+        si1, si2, slen = struct.unpack('<BBH', buf[i:i+4])
+        if (si1 == 66) and (si2 == 67) and (slen == 2):
+            return struct.unpack('<H', buf[i+4:i+6])[0] + 1
+        i += 4 + slen
+    return -1
+
+
+def detect_format(filepath):
+    '''
+    Inspects the first gzip header of the file.  Returns BGZF if the file
+    is BGZF-compressed, MULTI_MEMBER if it is some other gzip file (which may or may not
+    have multiple members), and None if it is not recognizable as gzip.
+    '''
+    with open(filepath, 'rb') as fin:
+        head = fin.read(1024)
+    if head[:3] != GZIP_MAGIC:
+        return None
+    # a truncated header (None) is left to the decompressor to report
+    size = _bgzf_block_size(head, 0)
+    if (size is not None) and (size > 0):
+        return BGZF
+    return MULTI_MEMBER
+
+
+def _looks_like_member(buf, pos):
+    '''
+    Checks whether a gzip member plausibly begins at `pos`.  We test-inflate a
+    small number of bytes since the magic bytes alone can occur by chance.
+    '''
+    if buf[pos+3] & 0xE0:
+        # reserved flag bits must be zero
+        return False
+    try:
+        zlib.decompressobj(GZIP_WBITS).decompress(buf[pos:pos+VERIFY_BYTES], 1)
+    except zlib.error:
+        return False
+    return True
+
+
+def _iter_bgzf_spans(fin):
+    '''
+    Yields (offset, data) tuples where `data` holds one or more complete BGZF blocks.
+    If a non-BGZF block is encountered, yields (offset, None) to indicate that the
+    remainder of the file must be decompressed serially.
+    '''
+    offset = 0
+    pending = b''
+    while True:
+        chunk = fin.read(SPAN_SIZE)
+        buf = pending + chunk
+        if not chunk:
+            if buf:
+                yield (offset, buf)
+            return
+        pos = 0
+        while True:
+            size = _bgzf_block_size(buf, pos)
+            if size == -1:
+                if pos > 0:
+                    yield (offset, buf[:pos])
+                yield (offset + pos, None)
+                return
+            if (size is None) or (pos + size > len(buf)):
+                break
+            pos += size
+        if pos > 0:
+            yield (offset, buf[:pos])
+            offset += pos
+        pending = buf[pos:]
+
+
+def _iter_member_spans(fin):
+    '''
+    Yields (offset, data) tuples where `data` holds (what we believe to be) one or
+    more complete gzip members.  If no member boundary can be found within MAX_SPAN_SIZE,
+    yields (offset, None) to indicate that the remainder of the file must be
+    decompressed serially.
+    '''
+    offset = 0
+    pending = b''
+    while True:
+        chunk = fin.read(SPAN_SIZE)
+        buf = pending + chunk
+        if not chunk:
+            if buf:
+                yield (offset, buf)
+            return
+        search_from = SPAN_SIZE
+        cut = -1
+        while search_from < len(buf):
+            candidate = buf.find(GZIP_MAGIC, search_from)
+            if (candidate == -1) or (candidate + VERIFY_BYTES > len(buf)):
+                break
+            if _looks_like_member(buf, candidate):
+                cut = candidate
+                break
+            search_from = candidate + 1
+        if cut > 0:
+            yield (offset, buf[:cut])
+            offset += cut
+            pending = buf[cut:]
+        elif len(buf) >= MAX_SPAN_SIZE:
+            yield (offset, None)
+            return
+        else:
+            pending = buf
+
+
+def _inflate_span(data):
+    '''
+    Inflates all the gzip members contained in `data`.  Returns a tuple of the
+    decompressed bytes (None if the final member was incomplete) and the time spent.
+    '''
+    start = time.time()
+    output = []
+    d = zlib.decompressobj(GZIP_WBITS)
+    remaining = data
+    while True:
+        output.append(d.decompress(remaining))
+        if not d.eof:
+            return (None, time.time() - start)
+        remaining = d.unused_data
+        if not remaining.strip(b'\x00'):
+            # gzip permits trailing zero padding
+            break
+        d = zlib.decompressobj(GZIP_WBITS)
+    return (b''.join(output), time.time() - start)
+
+
+def _iter_serial(filepath, offset, stats):
+    '''
+    Decompresses the file from `offset` onwards using the standard gzip module.
+    '''
+    with open(filepath, 'rb') as fin:
+        fin.seek(offset)
+        with gzip.GzipFile(fileobj=fin, mode='rb') as gz:
+            while True:
+                start = time.time()
+                chunk = gz.read(SERIAL_READ_SIZE)
+                stats.busy_seconds += time.time() - start
+                if not chunk:
+                    return
+                stats.decompressed_bytes += len(chunk)
+                yield chunk
+
+
+def _iter_parallel(filepath, mode, workers, stats):
+    '''
+    Yields decompressed chunks in file order while the spans are inflated
+    in a pool of worker threads.
+    '''
+    with open(filepath, 'rb') as fin:
+        spans = _iter_bgzf_spans(fin) if mode == BGZF else _iter_member_spans(fin)
+        pool = ThreadPoolExecutor(max_workers=workers)
+        queue = collections.deque()
+        fallback_offset = None
+        try:
+            exhausted = False
+            while True:
+                # keep a bounded number of spans in flight
+                while (not exhausted) and (len(queue) < 2 * workers):
+                    try:
+                        offset, data = next(spans)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if data is None:
+                        queue.append((offset, None))
+                        exhausted = True
+                    else:
+                        queue.append((offset, pool.submit(_inflate_span, data)))
+                if not queue:
+                    break
+                offset, future = queue.popleft()
+                if future is None:
+                    fallback_offset = offset
+                    break
+                inflated, elapsed = future.result()
+                stats.busy_seconds += elapsed
+                if inflated is None:
+                    # either the file is truncated or the span did not end on a
+                    # member boundary.  The serial path handles both correctly.
+                    fallback_offset = offset
+                    break
+                stats.parallel_spans += 1
+                stats.decompressed_bytes += len(inflated)
+                yield inflated
+        finally:
+            for offset, future in queue:
+                if future is not None:
+                    future.cancel()
+            pool.shutdown(wait=True)
+
+    if fallback_offset is not None:
+        stats.serial_fallback_offset = fallback_offset
+        if (fallback_offset == 0) and (mode == MULTI_MEMBER):
+            stats.mode = SINGLE_MEMBER
+        for chunk in _iter_serial(filepath, fallback_offset, stats):
+            yield chunk
+
+
+def iter_decompressed(filepath, workers=None, stats=None):
+    '''
+    Yields the decompressed contents of the gzip file, in order, as a series of
+    byte chunks.  If `stats` is given, it should be a DecompressionStats instance
+    which is updated as decompression proceeds.
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if stats is None:
+        stats = DecompressionStats()
+    start = time.time()
+    mode = detect_format(filepath)
+    stats.compressed_bytes = os.path.getsize(filepath)
+    stats.workers = workers
+    try:
+        if (mode is None) or (workers < 2):
+            stats.mode = SERIAL
+            stats.workers = 1
+            chunks = _iter_serial(filepath, 0, stats)
+        else:
+            stats.mode = mode
+            chunks = _iter_parallel(filepath, mode, workers, stats)
+        for chunk in chunks:
+            yield chunk
+    finally:
+        stats.wall_seconds = time.time() - start
+
+
+class ChunkReader(io.RawIOBase):
+    '''
+    Presents an iterator of byte chunks as a readable, raw binary stream
+    '''
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = memoryview(b'')
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._pos >= len(self._buffer):
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+            self._pos = 0
+        n = min(len(b), len(self._buffer) - self._pos)
+        b[:n] = self._buffer[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
+        super(ChunkReader, self).close()
+
+
+def open_decompressed(filepath, workers=None, stats=None, buffer_size=SERIAL_READ_SIZE):
+    '''
+    Returns a buffered, binary stream of the decompressed file.
+    Decompression uses up to `workers` threads.
+    '''
+    chunks = iter_decompressed(filepath, workers=workers, stats=stats)
+    return io.BufferedReader(ChunkReader(chunks), buffer_size=buffer_size)
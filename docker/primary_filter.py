@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+'''
+Filters a coordinate-sorted BAM (e.g. from STAR) in a single pass:
+
+  - drops the alignments with any of the excluded flags (by default 0x100, the
+    secondary alignments; equivalent to `samtools view -b -F 0x0100`)
+  - writes the filtered BAM with multi-threaded compression, indexing it on the fly
+  - optionally builds the index of the *input* BAM from the same pass
+  - collects flag and MAPQ statistics of the input
+
+which replaces reading the BAM once to filter it and again for each index.
+'''
+
+import argparse
+import json
+import sys
+
+import pysam
+
+from bam_stream import BaiBuilder, IndexedBamWriter
+from instrumentation import Instrumentation
+
+INPUT_BAM = 'input_bam'
+OUTPUT_BAM = 'output_bam'
+OUTPUT_INDEX = 'output_index'
+INPUT_INDEX = 'input_index'
+STATS_OUTPUT = 'stats_output'
+EXCLUDE_FLAGS = 'exclude_flags'
+THREADS = 'threads'
+
+DEFAULT_EXCLUDE_FLAGS = 0x100
+DEFAULT_THREADS = 4
+
+# the flags counted in the statistics (as in samtools flagstat)
+FLAG_NAMES = [
+    (0x100, 'secondary'),
+    (0x800, 'supplementary'),
+    (0x400, 'duplicates'),
+    (0x200, 'qc_fail'),
+    (0x4, 'unmapped')
+]
+
+
+class FilterStats(object):
+    def __init__(self):
+        self.total = 0
+        self.kept = 0
+        self.flag_counts = dict([(name, 0) for flag, name in FLAG_NAMES])
+        self.mapq_counts = {}
+
+    def add(self, read, kept):
+        self.total += 1
+        flag = read.flag
+        for f, name in FLAG_NAMES:
+            if flag & f:
+                self.flag_counts[name] += 1
+        # MAPQ of the primary, mapped alignments, i.e. one per mapped read
+        if not flag & 0x904:
+            mapq = read.mapping_quality
+            self.mapq_counts[mapq] = self.mapq_counts.get(mapq, 0) + 1
+        if kept:
+            self.kept += 1
+
+    def to_dict(self):
+        primary_mapped = sum(self.mapq_counts.values())
+        return {
+            'total': self.total,
+            'kept': self.kept,
+            'removed': self.total - self.kept,
+            'flags': self.flag_counts,
+            'primary_mapped': primary_mapped,
+            'mapq': dict([(str(k), v) for k, v in sorted(self.mapq_counts.items())])
+        }
+
+
+def get_commandline_args():
+    parser = argparse.ArgumentParser(description='Filters a BAM, writing the filtered BAM, its index and statistics in one pass.')
+    parser.add_argument('-i', '--input', required=True, dest=INPUT_BAM,
+        help='The coordinate-sorted input BAM.')
+    parser.add_argument('-o', '--output', required=True, dest=OUTPUT_BAM,
+        help='Path for the filtered BAM.')
+    parser.add_argument('-x', '--index', required=False, dest=OUTPUT_INDEX, default=None,
+        help='Path for the index of the filtered BAM (default: <output>.bai)')
+    parser.add_argument('-u', '--input-index', required=False, dest=INPUT_INDEX, default=None,
+        help='If given, also write the index of the input BAM here.')
+    parser.add_argument('-s', '--stats', required=False, dest=STATS_OUTPUT, default=None,
+        help='Path for the JSON of flag and MAPQ statistics.')
+    parser.add_argument('-F', '--exclude-flags', required=False, dest=EXCLUDE_FLAGS, default=DEFAULT_EXCLUDE_FLAGS,
+        type=lambda x: int(x, 0),
+        help='Drop alignments with any of these flags (default: 0x%x).' % DEFAULT_EXCLUDE_FLAGS)
+    parser.add_argument('-t', '--threads', required=False, dest=THREADS, type=int, default=DEFAULT_THREADS,
+        help='Number of compression threads (default: %d).' % DEFAULT_THREADS)
+    args = parser.parse_args()
+    return vars(args)
+
+
+def filter_bam(input_bam, output_bam, output_index, exclude_flags, threads, input_index=None):
+    '''
+    Returns (FilterStats, exit code of the writer)
+    '''
+    stats = FilterStats()
+    with pysam.AlignmentFile(input_bam, 'rb', threads=2) as bam:
+        if bam.header.to_dict().get('HD', {}).get('SO') != 'coordinate':
+            raise Exception('The BAM %s is not sorted by coordinate.' % input_bam)
+        writer = IndexedBamWriter(output_bam, output_index, bam, threads=threads)
+        builder = BaiBuilder(bam.nreferences) if input_index else None
+        start_offset = bam.tell()
+        for read in bam:
+            kept = not read.flag & exclude_flags
+            if kept:
+                writer.write(read)
+            stats.add(read, kept)
+            if builder is not None:
+                end_offset = bam.tell()
+                builder.add(read, start_offset, end_offset)
+                start_offset = end_offset
+        returncode = writer.close()
+    if builder is not None:
+        builder.write(input_index)
+    return stats, returncode
+
+
+if __name__ == '__main__':
+    arg_dict = get_commandline_args()
+    output_index = arg_dict[OUTPUT_INDEX] if arg_dict[OUTPUT_INDEX] else arg_dict[OUTPUT_BAM] + '.bai'
+
+    perf = Instrumentation('primary_filter.py', label=arg_dict[INPUT_BAM])
+    with perf.phase('filter and index'):
+        stats, returncode = filter_bam(
+            arg_dict[INPUT_BAM],
+            arg_dict[OUTPUT_BAM],
+            output_index,
+            arg_dict[EXCLUDE_FLAGS],
+            arg_dict[THREADS],
+            arg_dict[INPUT_INDEX]
+        )
+    perf.write()
+
+    summary = stats.to_dict()
+    print('Kept %d of %d alignments (%d secondary, %d supplementary, %d unmapped)' % (
+        summary['kept'], summary['total'], summary['flags']['secondary'],
+        summary['flags']['supplementary'], summary['flags']['unmapped']))
+    if arg_dict[STATS_OUTPUT]:
+        with open(arg_dict[STATS_OUTPUT], 'w') as fout:
+            json.dump(summary, fout, indent=2)
+
+    if returncode != 0:
+        sys.stderr.write('Writing the filtered BAM %s failed (samtools exit code %d).' % (arg_dict[OUTPUT_BAM], returncode))
+        sys.exit(1)
@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+'''
+Captures the R sessionInfo() (with DESeq2 loaded) once and caches it as JSON.
+
+Starting R and loading DESeq2 just to print sessionInfo() adds considerable
+time to each report.  Instead, we capture it once per image/environment and
+store it in a structured form (R version, platform, attached packages and their
+versions, etc.) alongside the original text.
+
+The cache is invalidated if the R library tree changes.  The key is a hash over
+the R executable and the DESCRIPTION file (path, size and modification time) of every
+installed package in the library paths reported by R.  Computing the key does not
+require starting R.
+
+The snapshot is created when the Docker image is built:
+    r_session_info.py -o /opt/software/r_session_info.json
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess as sp
+import tempfile
+
+DEFAULT_CACHE_PATH = os.environ.get('R_SESSION_INFO_CACHE', '/opt/software/r_session_info.json')
+CACHE_FORMAT_VERSION = 1
+R_EXECUTABLE = 'R'
+CAPTURE_TIMEOUT = 600 # seconds
+
+# The R code used to capture the session.  The output path is passed as a trailing argument.
+CAPTURE_SCRIPT = '''
+suppressMessages(library(DESeq2))
+si <- sessionInfo()
+pkg_info <- function(pkgs) unname(lapply(pkgs, function(p) list(package=p$Package, version=p$Version)))
+output_path <- commandArgs(TRUE)[1]
+jsonlite::write_json(list(r_version=si$R.version$version.string,
+                          platform=si$platform,
+                          running=si$running,
+                          base_packages=I(si$basePkgs),
+                          attached_packages=pkg_info(si$otherPkgs),
+                          loaded_namespaces=pkg_info(si$loadedOnly),
+                          lib_paths=I(.libPaths()),
+                          session_info_text=paste(capture.output(print(si)), collapse='\\n')),
+                     output_path,
+                     auto_unbox=T)
+'''
+
+
+def find_r_executable():
+    path = shutil.which(R_EXECUTABLE)
+    if path is None:
+        return None
+    return os.path.realpath(path)
+
+
+def compute_library_key(r_executable, lib_paths):
+    '''
+    Returns a hash identifying the R installation and its library tree
+    '''
+    h = hashlib.sha256()
+    st = os.stat(r_executable)
+    h.update(('%s\t%d\t%d\n' % (r_executable, st.st_size, st.st_mtime)).encode('utf-8'))
+    for lib_path in sorted(lib_paths):
+        if not os.path.isdir(lib_path):
+            continue
+        for pkg in sorted(os.listdir(lib_path)):
+            description = os.path.join(lib_path, pkg, 'DESCRIPTION')
+            try:
+                st = os.stat(description)
+            except OSError:
+                continue
+            h.update(('%s\t%d\t%d\n' % (description, st.st_size, st.st_mtime)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def capture_session_info(r_executable):
+    '''
+    Starts R and returns the structured session info as a dict
+    '''
+    fd, tmp_path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        cmd = [r_executable, '--slave', '--no-save', '--no-restore', '-e', CAPTURE_SCRIPT, '--args', tmp_path]
+        p = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
+        stdout, stderr = p.communicate(timeout=CAPTURE_TIMEOUT)
+        if p.returncode != 0:
+            raise Exception('Failed to capture the R session info: %s' % stderr.decode('utf-8', errors='replace'))
+        with open(tmp_path) as fin:
+            return json.load(fin)
+    finally:
+        os.remove(tmp_path)
+
+
+def load_cache(cache_path):
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with open(cache_path) as fin:
+            j = json.load(fin)
+    except ValueError:
+        return None
+    if j.get('format_version') != CACHE_FORMAT_VERSION:
+        return None
+    return j
+
+
+def write_cache(cache_path, snapshot):
+    '''
+    Writes the snapshot.  Since the cache typically lives in the image,
+    failing to (re)write it is not an error.
+    '''
+    tmp_path = cache_path + '.tmp.%d' % os.getpid()
+    try:
+        with open(tmp_path, 'w') as fout:
+            json.dump(snapshot, fout, indent=2)
+        os.rename(tmp_path, cache_path)
+    except (OSError, IOError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def is_current(snapshot, r_executable):
+    '''
+    Checks whether the cached snapshot still matches the R installation
+    '''
+    if (snapshot is None) or (r_executable is None):
+        return False
+    if snapshot.get('r_executable') != r_executable:
+        return False
+    key = compute_library_key(r_executable, snapshot['session']['lib_paths'])
+    return key == snapshot.get('library_key')
+
+
+def get_session_info(cache_path=DEFAULT_CACHE_PATH, refresh=False):
+    '''
+    Returns the structured session info (a dict).  R is only started if the cached
+    snapshot is missing or out of date.  If R cannot be found, the cached snapshot
+    is returned as-is (or None if there is none).
+    '''
+    snapshot = load_cache(cache_path)
+    r_executable = find_r_executable()
+    if (not refresh) and is_current(snapshot, r_executable):
+        return snapshot['session']
+    if r_executable is None:
+        return snapshot['session'] if snapshot else None
+
+    session = capture_session_info(r_executable)
+    snapshot = {
+        'format_version': CACHE_FORMAT_VERSION,
+        'r_executable': r_executable,
+        'library_key': compute_library_key(r_executable, session['lib_paths']),
+        'session': session
+    }
+    write_cache(cache_path, snapshot)
+    return session
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Captures (or refreshes) the cached R session info.')
+    parser.add_argument('-o', '--output',
+        dest='cache_path',
+        default=DEFAULT_CACHE_PATH,
+        help='Path to the snapshot (default: %(default)s)'
+    )
+    parser.add_argument('-f', '--force',
+        dest='refresh',
+        action='store_true',
+        help='Re-capture the session info even if the snapshot is current.'
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    session = get_session_info(args.cache_path, refresh=args.refresh)
+    if session is None:
+        print('Could not capture the R session info: R was not found.')
+    else:
+        print(session['session_info_text'])
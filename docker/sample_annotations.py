@@ -0,0 +1,139 @@
+'''
+Reads and validates the two-column sample annotation sheet (sample name and
+condition), as used by both the precheck and the reformatting task.
+
+Delimited (csv/tsv) files are streamed with the csv module.  pandas (and an Excel
+engine) are only imported if the sheet is an Excel file, since importing them
+dominates the runtime of these small tasks.
+'''
+
+import csv
+
+SAMPLE = 'sample'
+CONDITION = 'condition'
+COL_NAMES = [SAMPLE, CONDITION]
+
+TSV = 'tsv'
+CSV = 'csv'
+EXCEL_EXTENSIONS = ['xlsx', 'xls']
+DELIMITERS = {TSV: '\t', CSV: ','}
+FORMAT_DESCRIPTIONS = {TSV: 'tab-delimited', CSV: 'comma-separated'}
+EXCEL_DESCRIPTION = 'MS Excel'
+
+GENERIC_PROBLEM_MESSAGE = '''A problem occurred when trying to parse your annotation
+        file, which was inferred to be in %s format.
+        Please ensure it follows our expected formatting.'''
+
+
+class SampleAnnotations(object):
+    '''
+    The parsed annotations, as a list of (sample, condition) tuples
+    in the order of the file.
+    '''
+    def __init__(self, rows):
+        self.rows = rows
+
+    @property
+    def samples(self):
+        return [s for s, c in self.rows]
+
+    @property
+    def conditions(self):
+        return [c for s, c in self.rows]
+
+    def subset(self, samples):
+        '''
+        Returns the annotations for the given samples (matched case-insensitively)
+        '''
+        samples = set([x.lower() for x in samples])
+        return SampleAnnotations([(s, c) for s, c in self.rows if s.lower() in samples])
+
+    def groups(self):
+        '''
+        Returns a dict mapping each condition to its list of samples
+        '''
+        d = {}
+        for s, c in self.rows:
+            d.setdefault(c, []).append(s)
+        return d
+
+    def write_tsv(self, output_path):
+        '''
+        Writes the annotations as a tab-delimited file without a header
+        '''
+        with open(output_path, 'w') as fout:
+            for row in self.rows:
+                fout.write('\t'.join(row) + '\n')
+
+
+def get_file_extension(annotation_filepath):
+    return annotation_filepath.split('.')[-1].lower()
+
+
+def read_delimited_rows(annotation_filepath, delimiter):
+    '''
+    Returns the rows of a delimited file as lists of strings
+    '''
+    # utf-8-sig drops the byte order mark that Excel writes at the start of a CSV
+    with open(annotation_filepath, encoding='utf-8-sig', newline='') as fin:
+        return [row for row in csv.reader(fin, delimiter=delimiter)]
+
+
+def read_excel_rows(annotation_filepath):
+    '''
+    Returns the rows of the first sheet of an Excel file as lists of strings.
+    Blank cells are returned as empty strings.
+    '''
+    import pandas as pd
+    df = pd.read_excel(annotation_filepath, header=None, dtype=object)
+    rows = []
+    for values in df.itertuples(index=False):
+        row = []
+        for x in values:
+            if pd.isnull(x):
+                row.append('')
+            elif isinstance(x, float) and x.is_integer():
+                # e.g. a sample named 1 is read as 1.0
+                row.append(str(int(x)))
+            else:
+                row.append(str(x))
+        rows.append(row)
+    return rows
+
+
+def read_annotations(annotation_filepath):
+    '''
+    Tries to parse the annotation file.  Returns a tuple of a SampleAnnotations
+    instance (None if there were problems) and a list of error messages.
+    '''
+    file_extension = get_file_extension(annotation_filepath)
+    try:
+        if file_extension in DELIMITERS:
+            description = FORMAT_DESCRIPTIONS[file_extension]
+            rows = read_delimited_rows(annotation_filepath, DELIMITERS[file_extension])
+        elif file_extension in EXCEL_EXTENSIONS:
+            description = EXCEL_DESCRIPTION
+            rows = read_excel_rows(annotation_filepath)
+        else:
+            return (None, ['Your annotation file did not have the expected extension.  We found an extension of "%s", but expected one of: csv, tsv, or Excel.' % file_extension])
+    except Exception as ex:
+        return (None, [GENERIC_PROBLEM_MESSAGE % description])
+
+    # drop any completely empty rows:
+    rows = [row for row in rows if any(x.strip() for x in row)]
+    if len(rows) == 0:
+        return (None, [GENERIC_PROBLEM_MESSAGE % description])
+
+    num_columns = max(len(row) for row in rows)
+    if num_columns < 2:
+        return (None,
+                ['The file extension of the annotation file was %s, but the'
+                ' file reader parsed %d column(s).  Please check your annotation file.  Could it have the wrong file extension?' % (file_extension, num_columns)])
+
+    # in case the client put extra columns that are blank, just keep the first two.
+    # Then check for missing values in partially filled rows:
+    rows = [(row + ['', ''])[:2] for row in rows]
+    if any((not s.strip()) or (not c.strip()) for s, c in rows):
+        return (None, ['There were missing inputs in the annotation table.  Look for blank cells in particular.'])
+
+    return (SampleAnnotations([(s.strip(), c.strip()) for s, c in rows]), [])
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+'''
+Aligns several single-end samples in turn with STAR, loading the genome only once.
+
+The genome is loaded into shared memory (--genomeLoad LoadAndExit), each sample
+is aligned against it (--genomeLoad LoadAndKeep) and the genome is removed at
+the end, even if an alignment fails.  For projects with many small libraries,
+loading the genome otherwise dominates the alignment time.
+
+Note that STAR cannot insert the GTF junctions on the fly, nor run its 2-pass
+mode, with a shared genome.  The shared-memory mode therefore relies on the
+junctions already in the index.  With --no-shared-memory, each sample is instead
+aligned exactly as by the single-sample task (2-pass, with the GTF), which still
+saves extracting the index per sample.
+
+The outputs are named as by the single-sample task (e.g.
+<sample>.Aligned.sortedByCoord.out.bam) and their paths are listed, in the
+order of the input fastqs, in the manifest files (see MANIFESTS) so the
+workflow can read them as arrays.  The per-sample timing, including the time
+each sample spent loading/attaching the genome and its share of the initial
+load, is written to batch_alignment_timing.tsv.
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from instrumentation import Instrumentation
+import star_driver
+
+GENOME_DIR = 'genome_dir'
+R1_FILES = 'r1_files'
+THREADS = 'threads'
+GTF = 'gtf'
+NO_SHARED_MEMORY = 'no_shared_memory'
+BAM_SORT_RAM_GB = 'bam_sort_ram_gb'
+TIMING_OUTPUT = 'timing_output'
+
+R1_SUFFIX = '_R1.fastq.gz'
+DEFAULT_TIMING_OUTPUT = 'batch_alignment_timing.tsv'
+BYTES_PER_GB = 1024 ** 3
+
+# the outputs of each sample, as named by STAR given the prefix "<sample>."
+SORTED_BAM = 'Aligned.sortedByCoord.out.bam'
+RUN_LOG = 'Log.out'
+FINAL_LOG = 'Log.final.out'
+UNMAPPED = 'Unmapped.out.mate1'
+STAR_METRICS = 'star_metrics.jsonl'
+
+# maps each output to the manifest listing it
+MANIFESTS = [
+    (SORTED_BAM, 'sorted_bams.txt'),
+    (RUN_LOG, 'run_logs.txt'),
+    (FINAL_LOG, 'final_logs.txt'),
+    (UNMAPPED, 'unmapped_mate1s.txt')
+]
+
+# fields of Log.final.out giving when the job started, mapping started and the job finished.
+# The time between the first two was spent loading (or attaching to) the genome.
+STARTED_JOB = 'Started job on'
+STARTED_MAPPING = 'Started mapping on'
+FINISHED = 'Finished on'
+LOG_TIMESTAMP_FORMAT = '%b %d %H:%M:%S'
+
+TIMING_HEADER = ['sample', 'genome_load_seconds', 'mapping_seconds', 'wall_seconds', 'amortized_shared_load_seconds']
+
+
+class SampleTiming(object):
+    def __init__(self, sample_name, wall_time, genome_load_time, mapping_time):
+        self.sample_name = sample_name
+        self.wall_time = wall_time
+        self.genome_load_time = genome_load_time
+        self.mapping_time = mapping_time
+
+
+def get_commandline_args():
+    parser = argparse.ArgumentParser(description='Aligns several samples with STAR, loading the genome once.')
+    parser.add_argument('-d', '--genome-dir', required=True, dest=GENOME_DIR,
+        help='The directory of the (extracted) STAR index.')
+    parser.add_argument('-r1', required=True, nargs='+', dest=R1_FILES,
+        help='The fastq files, named <sample>%s' % R1_SUFFIX)
+    parser.add_argument('-t', '--threads', required=False, type=int, dest=THREADS, default=None,
+        help='Maximum number of threads for STAR.  By default, the CPUs available to the container.')
+    parser.add_argument('-g', '--gtf', required=False, dest=GTF, default=None,
+        help='The GTF, for inserting junctions on the fly.  Only used with --no-shared-memory.')
+    parser.add_argument('--no-shared-memory', action='store_true', dest=NO_SHARED_MEMORY,
+        help='Do not share the genome; align each sample as the single-sample task does.')
+    parser.add_argument('--bam-sort-ram', required=False, type=float, dest=BAM_SORT_RAM_GB, default=None,
+        help='RAM (in GB) for sorting the BAM.  By default, what the container has left after the genome.')
+    parser.add_argument('-o', '--timing', required=False, dest=TIMING_OUTPUT, default=DEFAULT_TIMING_OUTPUT,
+        help='Path for the per-sample timing (default: %s)' % DEFAULT_TIMING_OUTPUT)
+    args = parser.parse_args()
+    arg_dict = vars(args)
+    if arg_dict[NO_SHARED_MEMORY] and arg_dict[GTF] is None:
+        parser.error('A GTF (-g) is required with --no-shared-memory.')
+    return arg_dict
+
+
+def get_sample_name(r1_path):
+    # as in the WDL: basename(r1_fastq, "_R1.fastq.gz")
+    name = os.path.basename(r1_path)
+    if name.endswith(R1_SUFFIX):
+        name = name[:-len(R1_SUFFIX)]
+    return name
+
+
+def run_star(args):
+    '''
+    Runs STAR with the given arguments, raising if it fails
+    '''
+    command = ['STAR'] + args
+    print(' '.join(command))
+    sys.stdout.flush()
+    subprocess.check_call(command)
+
+
+def run_sized_star(args, sample_name, max_threads):
+    '''
+    Runs STAR for a sample through star_driver.py, which sizes the threads and
+    sort RAM to the container and records the throughput in <sample>.star_metrics.jsonl
+    '''
+    with open('%s.%s' % (sample_name, STAR_METRICS), 'w') as metrics_out:
+        returncode = star_driver.run_star(['STAR'] + args, metrics_out, max_threads=max_threads)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, 'STAR')
+
+
+def get_shared_genome_args(genome_dir, genome_load):
+    return ['--genomeDir', genome_dir, '--genomeLoad', genome_load]
+
+
+def get_sample_args(r1_path, sample_name, genome_dir):
+    return [
+        '--readFilesIn', r1_path,
+        '--genomeDir', genome_dir,
+        '--outFileNamePrefix', '%s.' % sample_name,
+        '--readFilesCommand', 'zcat',
+        '--outFilterType', 'BySJout',
+        '--outSAMtype', 'BAM', 'SortedByCoordinate',
+        '--outReadsUnmapped', 'Fastx'
+    ]
+
+
+def parse_log_times(final_log_path):
+    '''
+    Returns the seconds spent (loading the genome, mapping) from the Log.final.out,
+    or (None, None) if they are not found.
+    '''
+    stamps = {}
+    try:
+        with open(final_log_path) as fin:
+            for line in fin:
+                contents = line.split('|')
+                if len(contents) == 2 and contents[0].strip() in (STARTED_JOB, STARTED_MAPPING, FINISHED):
+                    stamps[contents[0].strip()] = datetime.strptime(contents[1].strip(), LOG_TIMESTAMP_FORMAT)
+    except (IOError, OSError, ValueError):
+        return (None, None)
+    if not all([k in stamps for k in (STARTED_JOB, STARTED_MAPPING, FINISHED)]):
+        return (None, None)
+    load_time = (stamps[STARTED_MAPPING] - stamps[STARTED_JOB]).total_seconds()
+    mapping_time = (stamps[FINISHED] - stamps[STARTED_MAPPING]).total_seconds()
+    return (load_time, mapping_time)
+
+
+def align_sample(r1_path, genome_dir, threads, gtf, shared, bam_sort_ram_gb):
+    sample_name = get_sample_name(r1_path)
+    args = get_sample_args(r1_path, sample_name, genome_dir)
+    if shared:
+        args += ['--genomeLoad', 'LoadAndKeep']
+    else:
+        args += ['--twopassMode', 'Basic', '--sjdbGTFfile', gtf]
+    if bam_sort_ram_gb is not None:
+        args += ['--limitBAMsortRAM', str(int(bam_sort_ram_gb * BYTES_PER_GB))]
+    start = time.time()
+    run_sized_star(args, sample_name, threads)
+    wall_time = time.time() - start
+    load_time, mapping_time = parse_log_times('%s.%s' % (sample_name, FINAL_LOG))
+    return SampleTiming(sample_name, wall_time, load_time, mapping_time)
+
+
+def write_manifests(sample_names):
+    for output, manifest in MANIFESTS:
+        with open(manifest, 'w') as fout:
+            for s in sample_names:
+                fout.write('%s.%s\n' % (s, output))
+
+
+def format_seconds(x):
+    return 'NA' if x is None else '%.1f' % x
+
+
+def write_timing(timings, shared_load_time, output_path):
+    amortized = shared_load_time / float(len(timings)) if len(timings) > 0 else 0.0
+    with open(output_path, 'w') as fout:
+        fout.write('\t'.join(TIMING_HEADER) + '\n')
+        for t in timings:
+            fout.write('\t'.join([
+                t.sample_name,
+                format_seconds(t.genome_load_time),
+                format_seconds(t.mapping_time),
+                format_seconds(t.wall_time),
+                format_seconds(amortized)
+            ]) + '\n')
+    print('Shared genome load: %.1fs, amortized over %d samples: %.1fs per sample.' % (shared_load_time, len(timings), amortized))
+
+
+if __name__ == '__main__':
+    arg_dict = get_commandline_args()
+    genome_dir = arg_dict[GENOME_DIR]
+    r1_files = arg_dict[R1_FILES]
+    shared = not arg_dict[NO_SHARED_MEMORY]
+
+    sample_names = [get_sample_name(f) for f in r1_files]
+    if len(set(sample_names)) != len(sample_names):
+        sys.stderr.write('The sample names (from the fastq filenames) are not unique.')
+        sys.exit(1)
+
+    perf = Instrumentation('star_batch_align.py', label='%d samples' % len(r1_files))
+    timings = []
+    shared_load_time = 0.0
+    err_list = []
+    try:
+        if shared:
+            start = time.time()
+            with perf.phase('load genome'):
+                run_star(get_shared_genome_args(genome_dir, 'LoadAndExit') + ['--outFileNamePrefix', 'genome_load.'])
+            shared_load_time = time.time() - start
+        for r1_path in r1_files:
+            with perf.phase('align %s' % get_sample_name(r1_path)):
+                timings.append(align_sample(r1_path, genome_dir, arg_dict[THREADS], arg_dict[GTF],
+                    shared, arg_dict[BAM_SORT_RAM_GB]))
+    except subprocess.CalledProcessError as ex:
+        err_list.append('STAR failed (exit code %d) while aligning the batch.' % ex.returncode)
+    finally:
+        if shared:
+            # always release the shared memory, which would otherwise outlive this task
+            with perf.phase('remove genome'):
+                try:
+                    run_star(get_shared_genome_args(genome_dir, 'Remove') + ['--outFileNamePrefix', 'genome_remove.'])
+                except subprocess.CalledProcessError:
+                    err_list.append('Could not remove the shared genome from memory.')
+
+    write_timing(timings, shared_load_time, arg_dict[TIMING_OUTPUT])
+    perf.write()
+
+    if len(err_list) > 0:
+        sys.stderr.write('#####'.join(err_list)) # the 5-hash delimiter since some stderr messages can be multiline
+        sys.exit(1) # need this to trigger Cromwell to fail
+
+    write_manifests(sample_names)
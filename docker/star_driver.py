@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+'''
+Runs STAR sized to the container it actually runs in.
+
+The number of threads (--runThreadN) and the RAM for sorting the BAM
+(--limitBAMsortRAM) are derived from the cgroup CPU quota and memory limit
+(see container_resources.py), unless they are given explicitly.  While STAR
+runs, its Log.progress.out is tailed and each update is written as a JSON line
+of throughput metrics, so that a mis-sized run is visible right away rather
+than when it fails or finishes.  The peak memory and CPU time of STAR are recorded
+by the instrumentation (see instrumentation.py), e.g. for calibrating the resource
+models (see resource_planner.py).
+
+    star_driver.py -m sample.star_metrics.jsonl -- STAR --genomeDir index --readFilesIn ...
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from container_resources import detect_resources, CGROUP_ROOT
+from instrumentation import Instrumentation
+
+METRICS_OUTPUT = 'metrics_output'
+MAX_THREADS = 'max_threads'
+POLL_INTERVAL = 'poll_interval'
+CGROUP_ROOT_ARG = 'cgroup_root'
+COMMAND = 'command'
+
+DEFAULT_POLL_INTERVAL = 30
+BYTES_PER_GB = 1024 ** 3
+
+# Memory not available for sorting: a fixed reserve plus a per-thread share
+# (read buffers, the chimeric/junction structures, etc.)
+RESERVED_BYTES = 2 * BYTES_PER_GB
+RESERVED_BYTES_PER_THREAD = 256 * 1024 * 1024
+MIN_BAM_SORT_BYTES = 1 * BYTES_PER_GB
+
+# the files of the STAR index which are loaded into memory
+GENOME_FILES = ['Genome', 'SA', 'SAindex']
+
+# below this, the alignment is likely starved (e.g. swapping, or more threads than CPUs)
+LOW_READS_PER_HOUR_PER_THREAD = 3e6
+
+PROGRESS_LOG = 'Log.progress.out'
+
+
+class StarSettings(object):
+    '''
+    The derived STAR settings and any warnings about them
+    '''
+    def __init__(self, threads, bam_sort_bytes, genome_bytes, resources, warnings):
+        self.threads = threads
+        self.bam_sort_bytes = bam_sort_bytes
+        self.genome_bytes = genome_bytes
+        self.resources = resources
+        self.warnings = warnings
+
+    def to_dict(self):
+        d = {
+            'threads': self.threads,
+            'bam_sort_bytes': self.bam_sort_bytes,
+            'genome_bytes': self.genome_bytes,
+            'warnings': self.warnings
+        }
+        d.update(self.resources.to_dict())
+        return d
+
+
+def get_commandline_args():
+    parser = argparse.ArgumentParser(description='Runs STAR with threads and sort RAM sized to the container.')
+    parser.add_argument('-m', '--metrics', required=False, dest=METRICS_OUTPUT, default=None,
+        help='Path for the JSON lines of sizing and throughput metrics.')
+    parser.add_argument('-t', '--max-threads', required=False, type=int, dest=MAX_THREADS, default=None,
+        help='An upper bound on the derived number of threads, e.g. the CPUs requested by the task.')
+    parser.add_argument('-p', '--poll', required=False, type=float, dest=POLL_INTERVAL, default=DEFAULT_POLL_INTERVAL,
+        help='Seconds between reads of the progress log (default: %d).' % DEFAULT_POLL_INTERVAL)
+    parser.add_argument('--cgroup-root', required=False, dest=CGROUP_ROOT_ARG, default=CGROUP_ROOT,
+        help=argparse.SUPPRESS)
+    parser.add_argument(COMMAND, nargs=argparse.REMAINDER,
+        help='The STAR command (after "--").')
+    args = parser.parse_args()
+    arg_dict = vars(args)
+    if len(arg_dict[COMMAND]) > 0 and arg_dict[COMMAND][0] == '--':
+        arg_dict[COMMAND] = arg_dict[COMMAND][1:]
+    if len(arg_dict[COMMAND]) == 0:
+        parser.error('The STAR command is required.')
+    return arg_dict
+
+
+def get_option(command, option):
+    '''
+    The (first) value of a STAR option in the command, or None
+    '''
+    if option in command:
+        i = command.index(option)
+        if i + 1 < len(command):
+            return command[i + 1]
+    return None
+
+
+def get_genome_bytes(genome_dir):
+    total = 0
+    if genome_dir is None:
+        return total
+    for f in GENOME_FILES:
+        path = os.path.join(genome_dir, f)
+        if os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+
+def size_star(genome_dir, resources, requested_threads=None, requested_sort_bytes=None, max_threads=None):
+    '''
+    Derives the threads and BAM sort RAM from the container's resources.
+    Explicitly requested values are kept, but checked.  Returns a StarSettings
+    '''
+    warnings = []
+    threads = resources.cpus
+    if max_threads is not None:
+        threads = min(threads, max_threads)
+    if requested_threads is not None:
+        threads = requested_threads
+        if threads > resources.cpus:
+            warnings.append('STAR was asked for %d threads, but only %d CPUs are available (%s).'
+                % (threads, resources.cpus, resources.cpu_source))
+
+    genome_bytes = get_genome_bytes(genome_dir)
+    if resources.memory_bytes is None:
+        available = None
+    else:
+        available = resources.memory_bytes - genome_bytes - RESERVED_BYTES - RESERVED_BYTES_PER_THREAD * threads
+
+    if requested_sort_bytes is not None:
+        sort_bytes = requested_sort_bytes
+        if available is not None and sort_bytes > available:
+            warnings.append('STAR was given %.1f GB for sorting, but only about %.1f GB remain after loading the genome.'
+                % (sort_bytes / float(BYTES_PER_GB), available / float(BYTES_PER_GB)))
+    elif available is None:
+        # no known limit, so leave STAR its default
+        sort_bytes = None
+    else:
+        sort_bytes = max(available, MIN_BAM_SORT_BYTES)
+        if available < MIN_BAM_SORT_BYTES:
+            warnings.append('The memory limit (%.1f GB) leaves little room beyond the %.1f GB genome; sorting the BAM may fail.'
+                % (resources.memory_bytes / float(BYTES_PER_GB), genome_bytes / float(BYTES_PER_GB)))
+    return StarSettings(threads, sort_bytes, genome_bytes, resources, warnings)
+
+
+def apply_settings(command, settings):
+    '''
+    Returns the STAR command with the derived settings added, where not already given
+    '''
+    command = list(command)
+    if get_option(command, '--runThreadN') is None:
+        command += ['--runThreadN', str(settings.threads)]
+    if settings.bam_sort_bytes is not None and get_option(command, '--limitBAMsortRAM') is None:
+        command += ['--limitBAMsortRAM', str(int(settings.bam_sort_bytes))]
+    return command
+
+
+def parse_progress_line(line):
+    '''
+    Parses a line of STAR's Log.progress.out, e.g.
+        Feb 20 14:41:21    103.4      1723456     75    90.1%    74.3 ...
+    Returns a dict, or None for the header and other lines
+    '''
+    fields = line.split()
+    if len(fields) < 8:
+        return None
+    try:
+        reads_per_hour = float(fields[3]) * 1e6
+        reads_processed = int(fields[4])
+        unique_pct = float(fields[6].rstrip('%'))
+    except ValueError:
+        return None
+    return {
+        'time': ' '.join(fields[:3]),
+        'reads_per_hour': reads_per_hour,
+        'reads_processed': reads_processed,
+        'mapped_unique_pct': unique_pct
+    }
+
+
+class ProgressMonitor(object):
+    '''
+    Follows STAR's progress log, writing each new update as a metrics record
+    '''
+    def __init__(self, progress_path, threads, metrics_out=None):
+        self.progress_path = progress_path
+        self.threads = threads
+        self.metrics_out = metrics_out
+        self.offset = 0
+        self.start = time.time()
+        self.warned = False
+        self.last = None
+        self.num_updates = 0
+
+    def poll(self):
+        if not os.path.exists(self.progress_path):
+            return
+        with open(self.progress_path) as fin:
+            fin.seek(self.offset)
+            lines = fin.readlines()
+            # only consume complete lines
+            if len(lines) > 0 and not lines[-1].endswith('\n'):
+                lines = lines[:-1]
+            self.offset += sum([len(l) for l in lines])
+        for line in lines:
+            record = parse_progress_line(line)
+            if record is not None:
+                self.report(record)
+
+    def report(self, record):
+        record['metric'] = 'star_progress'
+        record['elapsed_seconds'] = round(time.time() - self.start, 1)
+        record['reads_per_hour_per_thread'] = record['reads_per_hour'] / self.threads
+        self.last = record
+        self.num_updates += 1
+        print('STAR progress: %d reads, %.1fM reads/hour (%.1fM per thread), %.1f%% uniquely mapped' % (
+            record['reads_processed'],
+            record['reads_per_hour'] / 1e6,
+            record['reads_per_hour_per_thread'] / 1e6,
+            record['mapped_unique_pct']
+        ))
+        # the first update includes STAR's start-up, so it is not representative
+        if self.num_updates > 1 and record['reads_per_hour_per_thread'] < LOW_READS_PER_HOUR_PER_THREAD and not self.warned:
+            print('WARNING: STAR throughput is low for %d threads; the task may be under-provisioned.' % self.threads)
+            self.warned = True
+        write_metric(self.metrics_out, record)
+        sys.stdout.flush()
+
+
+def write_metric(metrics_out, record):
+    if metrics_out is not None:
+        metrics_out.write(json.dumps(record, sort_keys=True) + '\n')
+        metrics_out.flush()
+
+
+def run_star(command, metrics_out=None, poll_interval=DEFAULT_POLL_INTERVAL, cgroup_root=CGROUP_ROOT, max_threads=None):
+    '''
+    Sizes and runs the STAR command, reporting its progress.  Returns STAR's exit code.
+    '''
+    settings = size_star(
+        get_option(command, '--genomeDir'),
+        detect_resources(cgroup_root),
+        requested_threads=int(get_option(command, '--runThreadN')) if get_option(command, '--runThreadN') else None,
+        requested_sort_bytes=int(get_option(command, '--limitBAMsortRAM')) if get_option(command, '--limitBAMsortRAM') else None,
+        max_threads=max_threads
+    )
+    command = apply_settings(command, settings)
+
+    print('STAR sizing: %d threads (%d CPUs from %s), %s for sorting (memory limit %s from %s, genome %.1f GB)' % (
+        settings.threads,
+        settings.resources.cpus,
+        settings.resources.cpu_source,
+        'default' if settings.bam_sort_bytes is None else '%.1f GB' % (settings.bam_sort_bytes / float(BYTES_PER_GB)),
+        'unknown' if settings.resources.memory_bytes is None else '%.1f GB' % (settings.resources.memory_bytes / float(BYTES_PER_GB)),
+        settings.resources.memory_source,
+        settings.genome_bytes / float(BYTES_PER_GB)
+    ))
+    for w in settings.warnings:
+        print('WARNING: %s' % w)
+    sizing = settings.to_dict()
+    sizing['metric'] = 'star_sizing'
+    write_metric(metrics_out, sizing)
+    print(' '.join(command))
+    sys.stdout.flush()
+
+    prefix = get_option(command, '--outFileNamePrefix') or './'
+    monitor = ProgressMonitor(prefix + PROGRESS_LOG, settings.threads, metrics_out)
+    process = subprocess.Popen(command)
+    while process.poll() is None:
+        try:
+            process.wait(timeout=poll_interval)
+        except subprocess.TimeoutExpired:
+            pass
+        monitor.poll()
+    monitor.poll()
+    if monitor.last is not None:
+        summary = dict(monitor.last)
+        summary['metric'] = 'star_summary'
+        summary['wall_seconds'] = round(time.time() - monitor.start, 1)
+        summary['returncode'] = process.returncode
+        write_metric(metrics_out, summary)
+    return process.returncode
+
+
+if __name__ == '__main__':
+    arg_dict = get_commandline_args()
+    metrics_out = open(arg_dict[METRICS_OUTPUT], 'w') if arg_dict[METRICS_OUTPUT] else None
+    # labeled by the fastq, so the record can be matched to the size of its input
+    reads = get_option(arg_dict[COMMAND], '--readFilesIn')
+    perf = Instrumentation('star_driver.py', label=os.path.basename(reads) if reads else None)
+    with perf.phase('align'):
+        returncode = run_star(arg_dict[COMMAND], metrics_out, arg_dict[POLL_INTERVAL], arg_dict[CGROUP_ROOT_ARG], arg_dict[MAX_THREADS])
+    perf.write()
+    if metrics_out is not None:
+        metrics_out.close()
+    sys.exit(returncode)
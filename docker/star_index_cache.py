@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+'''
+Manages a node-local cache of extracted STAR indexes, so that the samples
+aligned on the same node do not each extract the (~30 GB) index tarball.
+
+The extracted indexes are kept under a shared cache directory, keyed by a
+fingerprint of the tarball's content.  File locks ensure that concurrent
+samples extract a given index only once, and that an index is not evicted
+while a sample is aligning against it.  When the extracted indexes exceed the
+disk budget, the least-recently-used ones are evicted.
+
+Typical use is to wrap the aligner, which runs while the index is held:
+
+    star_index_cache.py -t index.tar -c /mnt/star_index_cache -b 100 -l workspace/index -- \\
+        STAR --genomeDir workspace/index ...
+
+If no cache directory is given, the index is simply extracted to the link path,
+as if there were no cache.
+'''
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+TARBALL = 'tarball'
+CACHE_DIR = 'cache_dir'
+BUDGET_GB = 'budget_gb'
+LINK_PATH = 'link_path'
+STATS_OUTPUT = 'stats_output'
+FULL_HASH = 'full_hash'
+COMMAND = 'command'
+
+DEFAULT_BUDGET_GB = 100
+BYTES_PER_GB = 1024 ** 3
+
+# for the (default) sampled fingerprint, we hash the size and this many evenly
+# spaced chunks of the tarball.  Reading all of a 30 GB tarball would cost
+# a good fraction of what we save by not extracting it.
+NUM_FINGERPRINT_CHUNKS = 64
+FINGERPRINT_CHUNK_SIZE = 1024 * 1024
+HASH_BUFFER_SIZE = 8 * 1024 * 1024
+
+# names within the cache directory:
+CACHE_LOCK = '.cache.lock'
+CACHE_STATS = 'cache_stats.json'
+ENTRY_LOCK_SUFFIX = '.lock'  # held exclusively while extracting
+ENTRY_USE_SUFFIX = '.use'  # held (shared) while in use, so it is not evicted
+ENTRY_MARKER_SUFFIX = '.complete'
+ENTRY_TMP_SUFFIX = '.partial'
+
+
+def get_commandline_args():
+    parser = argparse.ArgumentParser(description='Provides an extracted STAR index from a node-local cache.')
+    parser.add_argument('-t', '--tarball', required=True, dest=TARBALL,
+        help='The STAR index tarball.')
+    parser.add_argument('-c', '--cache', required=False, dest=CACHE_DIR, default=None,
+        help='The shared cache directory.  If omitted, the index is extracted without caching.')
+    parser.add_argument('-b', '--budget', required=False, dest=BUDGET_GB, type=float, default=DEFAULT_BUDGET_GB,
+        help='The disk budget of the cache, in GB (default: %d).' % DEFAULT_BUDGET_GB)
+    parser.add_argument('-l', '--link', required=True, dest=LINK_PATH,
+        help='Where to make the extracted index available (a symlink into the cache).')
+    parser.add_argument('-s', '--stats', required=False, dest=STATS_OUTPUT, default=None,
+        help='Path for a JSON file of the cache statistics.')
+    parser.add_argument('--full-hash', action='store_true', dest=FULL_HASH,
+        help='Key the cache on the SHA-256 of the entire tarball, rather than a sampled fingerprint.')
+    parser.add_argument(COMMAND, nargs=argparse.REMAINDER,
+        help='The command (after "--") to run while the index is held.')
+    args = parser.parse_args()
+    return vars(args)
+
+
+def fingerprint_tarball(path, full=False):
+    '''
+    Returns a hex digest identifying the content of the tarball
+    '''
+    h = hashlib.sha256()
+    size = os.path.getsize(path)
+    h.update(str(size).encode('ascii'))
+    with open(path, 'rb') as fin:
+        if full:
+            buffer = fin.read(HASH_BUFFER_SIZE)
+            while buffer:
+                h.update(buffer)
+                buffer = fin.read(HASH_BUFFER_SIZE)
+        else:
+            step = max(size // NUM_FINGERPRINT_CHUNKS, FINGERPRINT_CHUNK_SIZE)
+            offset = 0
+            while offset < size:
+                fin.seek(offset)
+                h.update(fin.read(FINGERPRINT_CHUNK_SIZE))
+                offset += step
+            # always include the tail, where the last files of the archive are
+            fin.seek(max(0, size - FINGERPRINT_CHUNK_SIZE))
+            h.update(fin.read(FINGERPRINT_CHUNK_SIZE))
+    return h.hexdigest()
+
+
+def get_directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            fp = os.path.join(root, f)
+            if not os.path.islink(fp):
+                total += os.path.getsize(fp)
+    return total
+
+
+def extract_tarball(tarball, destination):
+    os.makedirs(destination)
+    subprocess.check_call(['tar', '-xf', tarball, '-C', destination])
+
+
+@contextmanager
+def file_lock(path, shared=False, blocking=True):
+    '''
+    Holds a flock on `path` (created if needed).  Yields whether the lock was
+    acquired, which is always True when blocking.
+    '''
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not blocking:
+        operation |= fcntl.LOCK_NB
+    try:
+        try:
+            fcntl.flock(fd, operation)
+            acquired = True
+        except (IOError, OSError):
+            if blocking:
+                raise
+            acquired = False
+        yield acquired
+    finally:
+        os.close(fd)
+
+
+class CacheEntry(object):
+    '''
+    A (possibly not yet extracted) index in the cache.  The `.complete` marker
+    holds the size of the extracted index and its mtime is the last use.
+    '''
+    def __init__(self, cache_dir, key):
+        self.key = key
+        self.path = os.path.join(cache_dir, key)
+        self.lock_path = self.path + ENTRY_LOCK_SUFFIX
+        self.use_path = self.path + ENTRY_USE_SUFFIX
+        self.marker_path = self.path + ENTRY_MARKER_SUFFIX
+
+    def is_complete(self):
+        return os.path.exists(self.marker_path)
+
+    def get_size(self):
+        with open(self.marker_path) as fin:
+            return int(fin.read().strip())
+
+    def get_last_used(self):
+        return os.path.getmtime(self.marker_path)
+
+    def touch(self):
+        os.utime(self.marker_path, None)
+
+    def mark_complete(self, size):
+        with open(self.marker_path, 'w') as fout:
+            fout.write('%d\n' % size)
+
+    def remove(self):
+        os.remove(self.marker_path)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class StarIndexCache(object):
+    def __init__(self, cache_dir, budget_bytes):
+        self.cache_dir = cache_dir
+        self.budget_bytes = budget_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        self.cache_lock_path = os.path.join(cache_dir, CACHE_LOCK)
+        self.stats_path = os.path.join(cache_dir, CACHE_STATS)
+
+    def get_entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(ENTRY_MARKER_SUFFIX):
+                entries.append(CacheEntry(self.cache_dir, name[:-len(ENTRY_MARKER_SUFFIX)]))
+        return entries
+
+    def evict(self, needed_bytes, keep_key):
+        '''
+        Evicts the least-recently-used indexes until `needed_bytes` more fit within
+        the budget.  Indexes held by other samples are skipped.  Must be called
+        with the cache lock held.  Returns the keys of the evicted indexes.
+        '''
+        entries = [e for e in self.get_entries() if e.key != keep_key]
+        used = sum([e.get_size() for e in entries])
+        evicted = []
+        for e in sorted(entries, key=lambda x: x.get_last_used()):
+            if used + needed_bytes <= self.budget_bytes:
+                break
+            with file_lock(e.use_path, blocking=False) as acquired:
+                if acquired:
+                    size = e.get_size()
+                    e.remove()
+                    used -= size
+                    evicted.append(e.key)
+        if used + needed_bytes > self.budget_bytes:
+            print('The index cache in %s exceeds its budget of %.1f GB, since other indexes are in use.'
+                % (self.cache_dir, self.budget_bytes / float(BYTES_PER_GB)))
+        return evicted
+
+    def update_stats(self, run_stats):
+        '''
+        Accumulates the statistics of this run into the cache's statistics.
+        Must be called with the cache lock held.
+        '''
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes_extracted': 0}
+        if os.path.exists(self.stats_path):
+            try:
+                with open(self.stats_path) as fin:
+                    stats.update(json.load(fin))
+            except ValueError:
+                pass
+        stats['hits'] += int(run_stats['hit'])
+        stats['misses'] += int(not run_stats['hit'])
+        stats['evictions'] += len(run_stats['evicted'])
+        stats['bytes_extracted'] += run_stats['bytes_extracted']
+        with open(self.stats_path, 'w') as fout:
+            json.dump(stats, fout, indent=2)
+        return stats
+
+    def ensure(self, tarball, key):
+        '''
+        Makes sure the index of `tarball` is extracted in the cache.  The caller
+        must hold a shared lock on the entry's use_path.
+        Returns (entry, run_stats)
+        '''
+        entry = CacheEntry(self.cache_dir, key)
+        run_stats = {'key': key, 'hit': True, 'evicted': [], 'bytes_extracted': 0, 'extract_time': 0.0}
+        if not entry.is_complete():
+            # only one sample extracts; the others wait here for it to finish
+            with file_lock(entry.lock_path) as acquired:
+                if not entry.is_complete():
+                    run_stats['hit'] = False
+                    with file_lock(self.cache_lock_path):
+                        run_stats['evicted'] = self.evict(os.path.getsize(tarball), key)
+                    start = time.time()
+                    tmp_path = entry.path + ENTRY_TMP_SUFFIX
+                    # clear anything left by an earlier sample which failed mid-extraction
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    extract_tarball(tarball, tmp_path)
+                    os.rename(tmp_path, entry.path)
+                    size = get_directory_size(entry.path)
+                    entry.mark_complete(size)
+                    run_stats['bytes_extracted'] = size
+                    run_stats['extract_time'] = time.time() - start
+        entry.touch()
+        with file_lock(self.cache_lock_path):
+            run_stats['cache'] = self.update_stats(run_stats)
+        return entry, run_stats
+
+
+def make_link(target, link_path):
+    link_dir = os.path.dirname(os.path.abspath(link_path))
+    if not os.path.isdir(link_dir):
+        os.makedirs(link_dir)
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+    os.symlink(os.path.abspath(target), link_path)
+
+
+def run_command(command):
+    if len(command) > 0 and command[0] == '--':
+        command = command[1:]
+    if len(command) == 0:
+        return 0
+    return subprocess.call(command)
+
+
+def write_stats(run_stats, stats_output):
+    if stats_output:
+        with open(stats_output, 'w') as fout:
+            json.dump(run_stats, fout, indent=2)
+
+
+if __name__ == '__main__':
+    arg_dict = get_commandline_args()
+    tarball = arg_dict[TARBALL]
+    link_path = arg_dict[LINK_PATH]
+
+    if arg_dict[CACHE_DIR] is None:
+        # no cache, so extract in place as before
+        extract_tarball(tarball, link_path)
+        write_stats({'hit': False, 'cached': False}, arg_dict[STATS_OUTPUT])
+        sys.exit(run_command(arg_dict[COMMAND]))
+
+    cache = StarIndexCache(arg_dict[CACHE_DIR], int(arg_dict[BUDGET_GB] * BYTES_PER_GB))
+    key = fingerprint_tarball(tarball, full=arg_dict[FULL_HASH])
+
+    # the shared lock on the entry protects it from eviction until the command is done
+    entry_use_path = CacheEntry(cache.cache_dir, key).use_path
+    with file_lock(entry_use_path, shared=True):
+        entry, run_stats = cache.ensure(tarball, key)
+        make_link(entry.path, link_path)
+        print('STAR index cache %s: %s (key %s, %d evicted).  Totals: %d hits, %d misses.' % (
+            cache.cache_dir,
+            'hit' if run_stats['hit'] else 'miss',
+            key[:12],
+            len(run_stats['evicted']),
+            run_stats['cache']['hits'],
+            run_stats['cache']['misses']
+        ))
+        write_stats(run_stats, arg_dict[STATS_OUTPUT])
+        returncode = run_command(arg_dict[COMMAND])
+    sys.exit(returncode)
@@ -0,0 +1,382 @@
+'''
+Native inference of the strandedness of a single-end RNA-seq library.
+
+This replaces RSeQC's ParseBAM.configure_experiment, which rebuilds an interval
+tree from the BED12 on every call and only reads the first N alignments of the
+BAM (i.e. all from the beginning of the first chromosome).  Here we:
+  - build a compact index of the exons (per chromosome and strand) as sorted
+    numpy arrays of merged, non-overlapping intervals
+  - use the BAM index to sample reads from many windows spread across the genome,
+    in proportion to the number of mapped reads on each chromosome
+  - classify the reads in vectorized batches as agreeing (++, --) or disagreeing
+    (+-, -+) with the strand of the exon(s) they overlap
+
+Optionally, the reads can be classified batch-by-batch with a sequential probability
+ratio test (SPRT) after each batch, stopping as soon as the decision between a stranded
+and an unstranded library is settled.
+'''
+
+import bisect
+import itertools
+import math
+import random
+
+import numpy as np
+import pysam
+
+from annotation_index import AnnotationIndex, is_annotation_index, read_bed12_intervals
+
+# number of genomic windows from which reads are sampled
+DEFAULT_NUM_WINDOWS = 200
+
+# number of reads classified together
+BATCH_SIZE = 10000
+
+DEFAULT_SEED = 0
+
+# defaults for the sequential test:
+# - alpha: probability of calling an unstranded library stranded
+# - beta: probability of calling a stranded library unstranded
+# - stranded_fraction: under the "stranded" hypothesis, the fraction of reads
+#   in the majority orientation
+# - batch size: number of reads classified between successive tests
+DEFAULT_SPRT_ALPHA = 1e-5
+DEFAULT_SPRT_BETA = 1e-5
+DEFAULT_STRANDED_FRACTION = 0.75
+SPRT_BATCH_SIZE = 2000
+
+# the sequential test decisions, using the featureCounts strand options
+UNSTRANDED = 0
+STRANDED = 1
+REVERSE_STRANDED = 2
+
+
+class ExonIndex(object):
+    '''
+    For each (chromosome, strand), holds sorted arrays of the starts and ends
+    of the merged exon intervals.
+    '''
+    def __init__(self, intervals):
+        self.intervals = intervals
+
+    @classmethod
+    def from_bed12(cls, bed_path):
+        '''
+        Builds the index from a BED12 file of transcript models
+        '''
+        return cls(read_bed12_intervals(bed_path))
+
+    @classmethod
+    def from_annotation_index(cls, index_path):
+        '''
+        Uses the BED12 intervals of a precompiled (memory-mapped) annotation index
+        '''
+        return cls(AnnotationIndex.load(index_path).bed_intervals())
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Loads either a precompiled annotation index or a BED12 file
+        '''
+        if is_annotation_index(path):
+            return cls.from_annotation_index(path)
+        return cls.from_bed12(path)
+
+    def overlaps(self, chrom, strand, starts, ends):
+        '''
+        Returns a boolean array indicating whether each half-open interval
+        [starts[i], ends[i]) overlaps an exon on the given chromosome and strand
+        '''
+        try:
+            exon_starts, exon_ends = self.intervals[(chrom, strand)]
+        except KeyError:
+            return np.zeros(starts.shape[0], dtype=bool)
+        # the last exon starting before the end of each read.  Since the merged
+        # intervals are disjoint, it is the only candidate for an overlap.
+        idx = np.searchsorted(exon_starts, ends, side='left') - 1
+        valid = idx >= 0
+        result = np.zeros(starts.shape[0], dtype=bool)
+        result[valid] = exon_ends[idx[valid]] > starts[valid]
+        return result
+
+
+class StrandednessCounts(object):
+    '''
+    Tallies the sampled reads.  `agree` are reads on the same strand as the
+    overlapped exon(s) (++ or --) and `disagree` are those on the opposite strand.
+    Reads overlapping exons on both strands are `ambiguous`.
+    '''
+    def __init__(self):
+        self.sampled = 0
+        self.agree = 0
+        self.disagree = 0
+        self.ambiguous = 0
+
+    def overlapping(self):
+        return self.agree + self.disagree + self.ambiguous
+
+    def fractions(self):
+        '''
+        Returns the fractions of the exon-overlapping reads that agree, disagree, and
+        are ambiguous.  These correspond to RSeQC's "++,--", "+-,-+" and "failed to determine"
+        '''
+        total = self.overlapping()
+        if total == 0:
+            return (0.0, 0.0, 0.0)
+        return (self.agree / total, self.disagree / total, self.ambiguous / total)
+
+
+def passes_filters(read, map_qual):
+    return not (read.is_unmapped
+        or read.is_qcfail
+        or read.is_duplicate
+        or read.is_secondary
+        or read.is_supplementary
+        or (read.mapping_quality < map_qual))
+
+
+def choose_windows(bam, num_windows, rng):
+    '''
+    Chooses random (contig, position) windows, with the number on each contig
+    in proportion to its number of mapped reads (from the BAM index).  The windows
+    are returned in file order.
+    '''
+    contigs = []
+    cumulative = []
+    total = 0
+    for stat in bam.get_index_statistics():
+        if stat.mapped > 0:
+            total += stat.mapped
+            contigs.append(stat.contig)
+            cumulative.append(total)
+    if total == 0:
+        return []
+    windows = []
+    for i in range(num_windows):
+        contig = contigs[bisect.bisect_right(cumulative, rng.random() * total)]
+        length = bam.get_reference_length(contig)
+        windows.append((bam.get_tid(contig), contig, rng.randrange(length)))
+    windows.sort()
+    return [(contig, pos) for tid, contig, pos in windows]
+
+
+def get_window_ends(windows):
+    '''
+    Returns, for each of the (sorted) windows, the start of the following window on
+    the same contig (or None for the last).  Limiting each window to this end keeps the
+    windows disjoint, so that no read is sampled twice regardless of the order the
+    windows are visited in.
+    '''
+    ends = []
+    for i, (contig, pos) in enumerate(windows):
+        if (i + 1 < len(windows)) and (windows[i + 1][0] == contig):
+            ends.append(windows[i + 1][1])
+        else:
+            ends.append(None)
+    return ends
+
+
+class WindowCursor(object):
+    '''
+    The reads of a window taken so far, so that the window can be revisited.  Reads
+    are taken in the order bam.fetch() returns them, so the next visit resumes at the
+    start of the last read taken, skipping the reads already seen at that position.
+    '''
+    def __init__(self, contig, start, end):
+        self.contig = contig
+        self.start = start
+        self.end = end
+        self.position = start
+        self.seen_at_position = 0
+        self.exhausted = False
+
+    def take(self, bam, quota, map_qual):
+        '''
+        Yields up to `quota` more reads passing the filters
+        '''
+        n = 0
+        skip = self.seen_at_position
+        for read in bam.fetch(self.contig, self.position):
+            if read.reference_start < self.position:
+                continue
+            if (self.end is not None) and (read.reference_start >= self.end):
+                break
+            if read.reference_start == self.position:
+                if skip > 0:
+                    skip -= 1
+                    continue
+                self.seen_at_position += 1
+            else:
+                self.position = read.reference_start
+                self.seen_at_position = 1
+            if not passes_filters(read, map_qual):
+                continue
+            n += 1
+            yield read
+            if n >= quota:
+                return
+        self.exhausted = True
+
+
+def iter_sampled_reads(bam, sample_size, map_qual, num_windows=DEFAULT_NUM_WINDOWS, seed=DEFAULT_SEED,
+        reads_per_visit=None):
+    '''
+    Yields up to `sample_size` alignments passing the filters, drawn from windows spread
+    across the genome.  A window which runs out of reads (e.g. at the end of a contig)
+    passes its shortfall on to the other windows.
+
+    By default each window is visited once, in file order, for its share of the reads.
+    If `reads_per_visit` is given, the windows are instead visited round-robin (in a random
+    order), taking that many reads from each per round.  Any prefix of the sampled reads
+    (e.g. a batch, when sampling stops early) is then drawn from many loci across the genome.
+    '''
+    rng = random.Random(seed)
+    windows = choose_windows(bam, num_windows, rng)
+    ends = get_window_ends(windows)
+    cursors = [WindowCursor(contig, start, end) for (contig, start), end in zip(windows, ends)]
+    remaining = sample_size
+    if reads_per_visit is None:
+        for i, cursor in enumerate(cursors):
+            quota = int(math.ceil(remaining / (len(cursors) - i)))
+            for read in cursor.take(bam, quota, map_qual):
+                remaining -= 1
+                yield read
+            if remaining <= 0:
+                return
+        return
+
+    rng.shuffle(cursors)
+    while remaining > 0 and len(cursors) > 0:
+        for cursor in cursors:
+            for read in cursor.take(bam, min(reads_per_visit, remaining), map_qual):
+                remaining -= 1
+                yield read
+            if remaining <= 0:
+                return
+        cursors = [c for c in cursors if not c.exhausted]
+
+
+def classify_batch(batch, exon_index, counts):
+    '''
+    Classifies a batch of reads given as a dict mapping the chromosome
+    to lists of (start, end, is_reverse)
+    '''
+    for chrom, (starts, ends, reverse) in batch.items():
+        starts = np.array(starts, dtype=np.int64)
+        ends = np.array(ends, dtype=np.int64)
+        reverse = np.array(reverse, dtype=bool)
+        plus = exon_index.overlaps(chrom, '+', starts, ends)
+        minus = exon_index.overlaps(chrom, '-', starts, ends)
+        only_plus = plus & ~minus
+        only_minus = minus & ~plus
+        counts.agree += int(np.sum((only_plus & ~reverse) | (only_minus & reverse)))
+        counts.disagree += int(np.sum((only_plus & reverse) | (only_minus & ~reverse)))
+        counts.ambiguous += int(np.sum(plus & minus))
+
+
+def classify_reads(reads, exon_index, counts=None, batch_size=BATCH_SIZE):
+    '''
+    Classifies the strand agreement of the reads, in batches.  Returns a
+    StrandednessCounts instance.
+    '''
+    if counts is None:
+        counts = StrandednessCounts()
+    batch = {}
+    n = 0
+    for read in reads:
+        starts, ends, reverse = batch.setdefault(read.reference_name, ([], [], []))
+        starts.append(read.reference_start)
+        ends.append(read.reference_end)
+        reverse.append(read.is_reverse)
+        counts.sampled += 1
+        n += 1
+        if n >= batch_size:
+            classify_batch(batch, exon_index, counts)
+            batch = {}
+            n = 0
+    if n > 0:
+        classify_batch(batch, exon_index, counts)
+    return counts
+
+
+def infer_strandedness(bam_path, exon_index, sample_size, map_qual, num_windows=DEFAULT_NUM_WINDOWS, seed=DEFAULT_SEED,
+        index_path=None):
+    '''
+    Samples reads from the (indexed) BAM file and returns a StrandednessCounts.  The index
+    is looked up next to the BAM unless `index_path` is given.
+    '''
+    with pysam.AlignmentFile(bam_path, 'rb', index_filename=index_path) as bam:
+        reads = iter_sampled_reads(bam, sample_size, map_qual, num_windows, seed)
+        return classify_reads(reads, exon_index)
+
+
+class StrandednessSPRT(object):
+    '''
+    Wald's sequential probability ratio test of an unstranded library (reads agree with the
+    exon strand with probability 0.5) against a stranded one.  Since the stranded alternative
+    is two-sided, we run two one-sided tests, one against a fraction `stranded_fraction`
+    of agreeing reads (STRANDED) and one against that fraction of disagreeing reads
+    (REVERSE_STRANDED), with the error rate alpha split between them.
+    '''
+    def __init__(self, alpha=DEFAULT_SPRT_ALPHA, beta=DEFAULT_SPRT_BETA, stranded_fraction=DEFAULT_STRANDED_FRACTION):
+        if not ((0 < alpha < 1) and (0 < beta < 1)):
+            raise ValueError('The SPRT error rates must be between 0 and 1.')
+        if not (0.5 < stranded_fraction < 1):
+            raise ValueError('The stranded fraction must be between 0.5 and 1.')
+        self.alpha = alpha
+        self.beta = beta
+        self.stranded_fraction = stranded_fraction
+        # per-read log-likelihood ratios for a read in the majority/minority orientation:
+        self.llr_majority = math.log(stranded_fraction / 0.5)
+        self.llr_minority = math.log((1 - stranded_fraction) / 0.5)
+        # the Wald boundaries, with alpha split across the two one-sided tests:
+        self.upper = math.log((1 - beta) / (alpha / 2))
+        self.lower = math.log(beta / (1 - alpha / 2))
+
+    def log_likelihood_ratios(self, n_agree, n_disagree):
+        '''
+        Returns the log-likelihood ratios for the STRANDED and REVERSE_STRANDED
+        hypotheses (each versus unstranded)
+        '''
+        forward = n_agree * self.llr_majority + n_disagree * self.llr_minority
+        reverse = n_disagree * self.llr_majority + n_agree * self.llr_minority
+        return (forward, reverse)
+
+    def decide(self, n_agree, n_disagree):
+        '''
+        Returns STRANDED, REVERSE_STRANDED or UNSTRANDED once the evidence crosses one of the
+        boundaries, or None if more reads are needed.
+        '''
+        forward, reverse = self.log_likelihood_ratios(n_agree, n_disagree)
+        if forward >= self.upper:
+            return STRANDED
+        if reverse >= self.upper:
+            return REVERSE_STRANDED
+        if (forward <= self.lower) and (reverse <= self.lower):
+            return UNSTRANDED
+        return None
+
+
+def infer_strandedness_sequential(bam_path, exon_index, max_sample_size, map_qual, sprt, 
+        batch_size=SPRT_BATCH_SIZE, num_windows=DEFAULT_NUM_WINDOWS, seed=DEFAULT_SEED, index_path=None):
+    '''
+    Samples reads from the (indexed) BAM file in batches, applying the sequential test
+    after each.  Sampling stops once the test reaches a decision or `max_sample_size` reads
+    have been sampled.
+
+    Returns a tuple of (StrandednessCounts, decision), where the decision is None if the
+    test did not reach one.
+    '''
+    counts = StrandednessCounts()
+    decision = None
+    with pysam.AlignmentFile(bam_path, 'rb', index_filename=index_path) as bam:
+        # every batch takes a few reads from each window, so that it spans many loci
+        reads_per_visit = max(1, batch_size // num_windows)
+        reads = iter_sampled_reads(bam, max_sample_size, map_qual, num_windows, seed, reads_per_visit)
+        while decision is None:
+            sampled = counts.sampled
+            classify_reads(itertools.islice(reads, batch_size), exon_index, counts, batch_size)
+            if counts.sampled == sampled:
+                break
+            decision = sprt.decide(counts.agree, counts.disagree)
+    return (counts, decision)
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+
+'''
+Removes the positional duplicates of a coordinate-sorted, single-end BAM, as
+Picard's MarkDuplicates (with REMOVE_DUPLICATES=TRUE) does for unpaired reads,
+but in bounded memory.  With --mark, the duplicates are flagged (0x400) rather
+than removed, e.g. for counting with and without them in one pass (see
+dual_quantify.py).
+
+Reads are duplicates if they share the library, strand and unclipped 5' position
+(including soft and hard clips).  Of each set of duplicates, the read with the
+highest sum of base qualities (counting bases of quality >= 15) is kept; ties go
+to the first read in the file.
+
+The BAM is streamed twice:
+  1. A sliding window of the open 5' positions finds the duplicates.  A position
+     is closed once no later read can reach it: a forward read's 5' end is at most
+     a read length before its start, and a reverse read's 5' end is never before
+     its start.  The duplicates are recorded in a bitset (one bit per read).
+  2. The reads which are not duplicates (or, with --mark, all the reads) are
+     written (compressed by several threads and indexed on the fly, see bam_stream.py).
+
+So the memory is proportional to the largest pileup of reads sharing a 5'
+position, plus one bit per read, rather than to the file.  The metrics are
+written in Picard's DuplicationMetrics format, which MultiQC parses.
+'''
+
+import argparse
+import heapq
+import os
+import sys
+from datetime import datetime
+
+import pysam
+
+from bam_stream import IndexedBamWriter
+from instrumentation import Instrumentation
+
+INPUT_BAM = 'input_bam'
+OUTPUT_BAM = 'output_bam'
+OUTPUT_INDEX = 'output_index'
+METRICS_OUTPUT = 'metrics_output'
+THREADS = 'threads'
+MARK_ONLY = 'mark_only'
+
+DEFAULT_THREADS = 4
+
+DUPLICATE_FLAG = 0x400
+
+# as in Picard's DuplicateScoringStrategy.SUM_OF_BASE_QUALITIES
+MIN_SCORED_BASE_QUALITY = 15
+MAX_SCORE = 32767 // 2
+
+# the window is at least this wide, even if all the reads seen so far are shorter
+MIN_WINDOW = 1000
+
+UNKNOWN_LIBRARY = 'Unknown Library'
+
+# CIGAR operations for clipping
+SOFT_CLIP = 4
+HARD_CLIP = 5
+
+METRICS_COLUMNS = [
+    'LIBRARY',
+    'UNPAIRED_READS_EXAMINED',
+    'READ_PAIRS_EXAMINED',
+    'SECONDARY_OR_SUPPLEMENTARY_RDS',
+    'UNMAPPED_READS',
+    'UNPAIRED_READ_DUPLICATES',
+    'READ_PAIR_DUPLICATES',
+    'READ_PAIR_OPTICAL_DUPLICATES',
+    'PERCENT_DUPLICATION',
+    'ESTIMATED_LIBRARY_SIZE'
+]
+
+
+class Bitset(object):
+    '''
+    A growable set of non-negative integers, one bit each
+    '''
+    def __init__(self):
+        self.bits = bytearray()
+
+    def add(self, i):
+        byte = i >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytearray(byte + 1 - len(self.bits)))
+        self.bits[byte] |= 1 << (i & 7)
+
+    def __contains__(self, i):
+        byte = i >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (i & 7)))
+
+
+class LibraryMetrics(object):
+    def __init__(self, library):
+        self.library = library
+        self.unpaired_reads_examined = 0
+        self.secondary_or_supplementary = 0
+        self.unmapped_reads = 0
+        self.unpaired_read_duplicates = 0
+
+    def percent_duplication(self):
+        if self.unpaired_reads_examined == 0:
+            return 0.0
+        return self.unpaired_read_duplicates / float(self.unpaired_reads_examined)
+
+    def to_row(self):
+        return [
+            self.library,
+            str(self.unpaired_reads_examined),
+            '0',
+            str(self.secondary_or_supplementary),
+            str(self.unmapped_reads),
+            str(self.unpaired_read_duplicates),
+            '0',
+            '0',
+            '%.6f' % self.percent_duplication(),
+            ''
+        ]
+
+
+class DuplicateGroup(object):
+    '''
+    The reads sharing a 5' position; only the ordinals (position in the file) are kept
+    '''
+    def __init__(self):
+        self.best_score = -1
+        self.best = None
+        self.others = []
+
+    def add(self, ordinal, score):
+        if score > self.best_score:
+            if self.best is not None:
+                self.others.append(self.best)
+            self.best_score = score
+            self.best = ordinal
+        else:
+            self.others.append(ordinal)
+
+
+def get_commandline_args():
+    parser = argparse.ArgumentParser(description='Removes positional duplicates from a single-end BAM in bounded memory.')
+    parser.add_argument('-i', '--input', required=True, dest=INPUT_BAM,
+        help='The coordinate-sorted input BAM.')
+    parser.add_argument('-o', '--output', required=True, dest=OUTPUT_BAM,
+        help='Path for the deduplicated BAM.')
+    parser.add_argument('-x', '--index', required=False, dest=OUTPUT_INDEX, default=None,
+        help='Path for the index of the deduplicated BAM (default: <output>.bai)')
+    parser.add_argument('-m', '--metrics', required=True, dest=METRICS_OUTPUT,
+        help='Path for the (Picard-format) duplication metrics.')
+    parser.add_argument('-t', '--threads', required=False, dest=THREADS, type=int, default=DEFAULT_THREADS,
+        help='Number of compression threads (default: %d).' % DEFAULT_THREADS)
+    parser.add_argument('--mark', action='store_true', dest=MARK_ONLY,
+        help='Flag the duplicates rather than removing them.')
+    args = parser.parse_args()
+    return vars(args)
+
+
+def get_libraries(header):
+    '''
+    Maps the read group IDs to their libraries
+    '''
+    return dict([(rg['ID'], rg.get('LB', UNKNOWN_LIBRARY)) for rg in header.to_dict().get('RG', [])])
+
+
+def get_library(read, libraries):
+    if read.has_tag('RG'):
+        return libraries.get(read.get_tag('RG'), UNKNOWN_LIBRARY)
+    return UNKNOWN_LIBRARY
+
+
+def get_unclipped_five_prime(read):
+    '''
+    The unclipped 5' position of the read, as Picard's getUnclippedStart/End
+    '''
+    cigar = read.cigartuples
+    if read.is_reverse:
+        clipped = 0
+        for op, length in reversed(cigar):
+            if op not in (SOFT_CLIP, HARD_CLIP):
+                break
+            clipped += length
+        return read.reference_end - 1 + clipped
+    clipped = 0
+    for op, length in cigar:
+        if op not in (SOFT_CLIP, HARD_CLIP):
+            break
+        clipped += length
+    return read.reference_start - clipped
+
+
+def get_score(read):
+    qualities = read.query_qualities
+    if qualities is None:
+        return 0
+    return min(sum([q for q in qualities if q >= MIN_SCORED_BASE_QUALITY]), MAX_SCORE)
+
+
+class DuplicateFinder(object):
+    '''
+    The first pass: finds the ordinals of the duplicate reads within a sliding window
+    '''
+    def __init__(self):
+        self.duplicates = Bitset()
+        self.groups = {}
+        # heaps of (5' position, key) of the open groups, by strand
+        self.forward_positions = []
+        self.reverse_positions = []
+        self.window = MIN_WINDOW
+        self.max_open_groups = 0
+        self.max_group_size = 0
+
+    def close(self, key):
+        group = self.groups.pop(key)
+        for ordinal in group.others:
+            self.duplicates.add(ordinal)
+        self.max_group_size = max(self.max_group_size, len(group.others) + 1)
+        return len(group.others)
+
+    def advance(self, position):
+        '''
+        Closes the groups no read at or after `position` can join.  Returns the number
+        of duplicates found, by library.
+        '''
+        counts = {}
+        for heap, limit in ((self.forward_positions, position - self.window), (self.reverse_positions, position)):
+            while len(heap) > 0 and heap[0][0] < limit:
+                key = heapq.heappop(heap)[1]
+                counts[key[0]] = counts.get(key[0], 0) + self.close(key)
+        return counts
+
+    def close_all(self):
+        counts = {}
+        for key in list(self.groups.keys()):
+            counts[key[0]] = counts.get(key[0], 0) + self.close(key)
+        self.forward_positions = []
+        self.reverse_positions = []
+        return counts
+
+    def add(self, ordinal, read, library):
+        self.window = max(self.window, read.infer_read_length())
+        position = get_unclipped_five_prime(read)
+        key = (library, read.is_reverse, position)
+        group = self.groups.get(key)
+        if group is None:
+            group = DuplicateGroup()
+            self.groups[key] = group
+            heap = self.reverse_positions if read.is_reverse else self.forward_positions
+            heapq.heappush(heap, (position, key))
+            self.max_open_groups = max(self.max_open_groups, len(self.groups))
+        group.add(ordinal, get_score(read))
+
+
+def find_duplicates(input_bam):
+    '''
+    Returns (the DuplicateFinder, dict of LibraryMetrics)
+    '''
+    finder = DuplicateFinder()
+    metrics = {}
+    with pysam.AlignmentFile(input_bam, 'rb', threads=2) as bam:
+        if bam.header.to_dict().get('HD', {}).get('SO') != 'coordinate':
+            raise Exception('The BAM %s is not sorted by coordinate.' % input_bam)
+        libraries = get_libraries(bam.header)
+        current_reference = None
+        for ordinal, read in enumerate(bam):
+            library = get_library(read, libraries)
+            m = metrics.get(library)
+            if m is None:
+                m = LibraryMetrics(library)
+                metrics[library] = m
+            if read.is_unmapped:
+                m.unmapped_reads += 1
+                continue
+            if read.is_secondary or read.is_supplementary:
+                m.secondary_or_supplementary += 1
+                continue
+            if read.is_paired:
+                raise Exception('Found paired reads in %s, but only single-end reads are supported.' % input_bam)
+            m.unpaired_reads_examined += 1
+
+            if read.reference_id != current_reference:
+                counts = finder.close_all()
+                current_reference = read.reference_id
+            else:
+                counts = finder.advance(read.reference_start)
+            for lib, n in counts.items():
+                metrics[lib].unpaired_read_duplicates += n
+            finder.add(ordinal, read, library)
+        for lib, n in finder.close_all().items():
+            metrics[lib].unpaired_read_duplicates += n
+    return finder, metrics
+
+
+def write_deduplicated(input_bam, output_bam, output_index, duplicates, threads, mark_only=False):
+    '''
+    The second pass: writes the reads which are not duplicates or, if `mark_only`,
+    all the reads with the duplicates flagged (and any previous flags cleared, as
+    Picard does).  Returns the exit code of the writer.
+    '''
+    with pysam.AlignmentFile(input_bam, 'rb', threads=2) as bam:
+        writer = IndexedBamWriter(output_bam, output_index, bam, threads=threads)
+        for ordinal, read in enumerate(bam):
+            if ordinal not in duplicates:
+                if mark_only:
+                    read.flag &= ~DUPLICATE_FLAG
+                writer.write(read)
+            elif mark_only:
+                read.flag |= DUPLICATE_FLAG
+                writer.write(read)
+        return writer.close()
+
+
+def write_metrics(metrics, metrics_path, input_bam, output_bam, mark_only=False):
+    with open(metrics_path, 'w') as fout:
+        # the header mirrors Picard's, which is how MultiQC recognizes the file and names the sample
+        fout.write('## htsjdk.samtools.metrics.StringHeader\n')
+        fout.write('# picard.sam.markduplicates.MarkDuplicates INPUT=[%s] OUTPUT=%s METRICS_FILE=%s REMOVE_DUPLICATES=%s ASSUME_SORTED=true'
+            ' (equivalent metrics written by streaming_dedup.py)\n' % (input_bam, output_bam, metrics_path,
+            'false' if mark_only else 'true'))
+        fout.write('## htsjdk.samtools.metrics.StringHeader\n')
+        fout.write('# Started on: %s\n' % datetime.now().strftime('%a %b %d %H:%M:%S %Y'))
+        fout.write('\n')
+        fout.write('## METRICS CLASS\tpicard.sam.DuplicationMetrics\n')
+        fout.write('\t'.join(METRICS_COLUMNS) + '\n')
+        for library in sorted(metrics):
+            fout.write('\t'.join(metrics[library].to_row()) + '\n')
+        fout.write('\n')
+
+
+if __name__ == '__main__':
+    arg_dict = get_commandline_args()
+    input_bam = arg_dict[INPUT_BAM]
+    output_bam = arg_dict[OUTPUT_BAM]
+    output_index = arg_dict[OUTPUT_INDEX] if arg_dict[OUTPUT_INDEX] else output_bam + '.bai'
+
+    perf = Instrumentation('streaming_dedup.py', label=os.path.basename(input_bam))
+    with perf.phase('find duplicates'):
+        finder, metrics = find_duplicates(input_bam)
+    with perf.phase('write'):
+        returncode = write_deduplicated(input_bam, output_bam, output_index, finder.duplicates, arg_dict[THREADS],
+            arg_dict[MARK_ONLY])
+    write_metrics(metrics, arg_dict[METRICS_OUTPUT], input_bam, output_bam, arg_dict[MARK_ONLY])
+    perf.write()
+
+    total_duplicates = sum([m.unpaired_read_duplicates for m in metrics.values()])
+    print('%s %d duplicates.  At most %d positions were open at once, the largest with %d reads.' % (
+        'Marked' if arg_dict[MARK_ONLY] else 'Removed', total_duplicates, finder.max_open_groups, finder.max_group_size))
+
+    if returncode != 0:
+        sys.stderr.write('Writing the deduplicated BAM %s failed (samtools exit code %d).' % (output_bam, returncode))
+        sys.exit(1)
@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+'''
+Maintains a cached manifest of the versions of the tools used in the pipeline.
+
+Asking each tool for its version means starting STAR, samtools, featureCounts,
+MultiQC, FastQC and Picard (the latter two in a JVM).  Instead, we probe the
+tools once (concurrently) and store the results in a JSON file.  Each entry is keyed
+on the path and modification time of the binary (or jar/script), so an entry is only
+re-probed if the tool itself changes.
+
+The manifest is built when the Docker image is created:
+    tool_versions.py -o /opt/software/tool_versions.json
+'''
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CACHE_PATH = os.environ.get('TOOL_VERSION_CACHE', '/opt/software/tool_versions.json')
+PICARD_JAR = os.environ.get('PICARD_JAR', '/opt/software/picard/picard.jar')
+CACHE_FORMAT_VERSION = 1
+PROBE_TIMEOUT = 120 # seconds
+UNKNOWN_VERSION = 'unknown'
+
+STDOUT = 'stdout'
+STDERR = 'stderr'
+
+# Matches things like 2.6.1d, v0.11.8, 2.18.26-SNAPSHOT
+VERSION_PATTERN = re.compile(r'v?(\d+(?:\.\d+)+[\w\-]*)')
+
+
+class ToolSpec(object):
+    '''
+    Describes how to get the version of a single tool.
+
+    `key_file` is the file whose path and modification time key the
+    cached entry.  If it is not an absolute path, it is looked up on the PATH.
+    '''
+    def __init__(self, name, cmd, stream, key_file, pattern=VERSION_PATTERN):
+        self.name = name
+        self.cmd = cmd
+        self.stream = stream
+        self.key_file = key_file
+        self.pattern = pattern
+
+    def resolve_key_file(self):
+        if os.path.isabs(self.key_file):
+            path = self.key_file if os.path.exists(self.key_file) else None
+        else:
+            path = shutil.which(self.key_file)
+        if path is None:
+            return None
+        return os.path.realpath(path)
+
+    def parse(self, output):
+        m = self.pattern.search(output)
+        if m:
+            return m.group(1)
+        return UNKNOWN_VERSION
+
+
+TOOLS = [
+    ToolSpec('star_version', ['STAR', '--version'], STDOUT, 'STAR'),
+    ToolSpec('samtools_version', ['samtools', '--version'], STDOUT, 'samtools'),
+    ToolSpec('featurecounts_version', ['featureCounts', '-v'], STDERR, 'featureCounts'),
+    ToolSpec('multiqc_version', ['multiqc', '--version'], STDOUT, 'multiqc'),
+    ToolSpec('fastqc_version', ['fastqc', '--version'], STDOUT, 'fastqc'),
+    ToolSpec('rseqc_version', ['pip3', 'show', 'RSeQC'], STDOUT, 'infer_experiment.py',
+        pattern=re.compile(r'Version:\s*(\S+)')),
+    ToolSpec('picard_mark_duplicates_version', ['java', '-jar', PICARD_JAR, 'MarkDuplicates', '--version'],
+        STDERR, PICARD_JAR),
+]
+
+
+def get_cache_key(spec):
+    '''
+    Returns a dict of the path and modification time identifying the installed tool,
+    or None if the tool could not be found.
+    '''
+    path = spec.resolve_key_file()
+    if path is None:
+        return None
+    return {'path': path, 'mtime': os.path.getmtime(path)}
+
+
+def probe_version(spec):
+    '''
+    Runs the tool to get its version
+    '''
+    try:
+        p = sp.Popen(spec.cmd, stdout=sp.PIPE, stderr=sp.PIPE)
+        stdout, stderr = p.communicate(timeout=PROBE_TIMEOUT)
+    except (OSError, sp.TimeoutExpired):
+        return UNKNOWN_VERSION
+    output = stdout if spec.stream == STDOUT else stderr
+    return spec.parse(output.decode('utf-8', errors='replace'))
+
+
+def load_cache(cache_path):
+    '''
+    Returns the cached entries, keyed by the tool name.  Returns an empty dict
+    if there is no usable cache.
+    '''
+    if not os.path.isfile(cache_path):
+        return {}
+    try:
+        with open(cache_path) as fin:
+            j = json.load(fin)
+    except ValueError:
+        return {}
+    if j.get('format_version') != CACHE_FORMAT_VERSION:
+        return {}
+    return j.get('tools', {})
+
+
+def write_cache(cache_path, entries):
+    '''
+    Writes the cache.  Since the cache typically lives in the image,
+    failing to (re)write it is not an error.
+    '''
+    tmp_path = cache_path + '.tmp.%d' % os.getpid()
+    try:
+        with open(tmp_path, 'w') as fout:
+            json.dump({'format_version': CACHE_FORMAT_VERSION, 'tools': entries}, fout, indent=2, sort_keys=True)
+        os.rename(tmp_path, cache_path)
+    except (OSError, IOError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_versions(cache_path=DEFAULT_CACHE_PATH, tools=TOOLS):
+    '''
+    Returns a dict mapping each tool's name to its version.  Only tools that
+    are missing from the cache (or have changed since they were cached) are probed.
+    '''
+    cached = load_cache(cache_path)
+    entries = {}
+    stale = []
+    for spec in tools:
+        key = get_cache_key(spec)
+        entry = cached.get(spec.name)
+        if (key is not None) and (entry is not None) and (entry.get('key') == key):
+            entries[spec.name] = entry
+        else:
+            stale.append((spec, key))
+
+    if stale:
+        with ThreadPoolExecutor(max_workers=len(stale)) as pool:
+            versions = list(pool.map(lambda x: probe_version(x[0]), stale))
+        for (spec, key), version in zip(stale, versions):
+            entries[spec.name] = {'key': key, 'version': version}
+        write_cache(cache_path, entries)
+
+    return dict((name, entry['version']) for name, entry in entries.items())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Builds (or refreshes) the cached tool-version manifest.')
+    parser.add_argument('-o', '--output',
+        dest='cache_path',
+        default=DEFAULT_CACHE_PATH,
+        help='Path to the manifest (default: %(default)s)'
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    versions = get_versions(args.cache_path)
+    for name in sorted(versions):
+        print('%s: %s' % (name, versions[name]))
@@ -1,6 +1,10 @@
 import os
 import json
 
+# optional, precompiled annotation artifacts, in the order of the
+# trailing target_ids in gui.json
+PRECOMPILED_RESOURCES = ['annotation_index', 'saf']
+
 def map_inputs(user, all_data, data_name, id_list):
     '''
     This maps the genome string to the resources needed to run a WDL
@@ -10,6 +14,10 @@ def map_inputs(user, all_data, data_name, id_list):
     unmapped_data is a string giving the genome
     id_list is a list of the WDL input names.  The order is given in the gui.json
     file.
+
+    If the genome has a precompiled annotation index and SAF file (see
+    docker/annotation_index.py), those are mapped to the remaining (optional)
+    inputs so that the workflow does not re-parse the GTF and BED12 for each sample.
     '''
     unmapped_data = all_data[data_name]
     genome_choice = unmapped_data
@@ -22,5 +30,8 @@ def map_inputs(user, all_data, data_name, id_list):
     d[id_list[1]] = j[genome_choice]['star_index']
     d[id_list[2]] = j[genome_choice]['gtf']
     d[id_list[3]] = j[genome_choice]['bed_annotations']
+    for input_id, key in zip(id_list[4:], PRECOMPILED_RESOURCES):
+        if key in j[genome_choice]:
+            d[input_id] = j[genome_choice][key]
     return d 
 
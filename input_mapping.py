@@ -1,6 +1,11 @@
-from base.models import Resource
 import os
 
+from resource_resolver import resolve_resources
+from resource_planner import plan_resources, ResourcePlanException
+
+# the name of the gui.json input element giving the genome
+GENOME_CHOICE = 'genome_choice'
+
 def map_inputs(user, all_data, data_name, id_list):
     '''
     `user` is a User instance (or subclass).  This gives us
@@ -20,18 +25,39 @@ def map_inputs(user, all_data, data_name, id_list):
     to.  Note that the ordering is important.  Make sure the logic below
     matches the order in gui.json 
 
+    In addition to the fastq paths, we return the runtime resources (cpu,
+    memory, disk) of the per-sample tasks, as predicted from the sizes of the
+    fastq files and the chosen genome by resource_planner.py
+
     '''
     unmapped_data = all_data[data_name]
     r1_suffix = '_R1.fastq.gz'
     r1_path_list = []
-    for pk in unmapped_data:
-        r = Resource.objects.get(pk=pk)
-        if (r.owner == user) or (user.is_staff):
-            if r.path.endswith(r1_suffix):
-                r1_path_list.append(r.path)
-            else:
-                print('Skipping %s' % r.path)
+    r1_size_list = []
+
+    # resolve all the Resources at once, which raises if any do not belong to the user
+    for r in resolve_resources(user, unmapped_data):
+        if r.path.endswith(r1_suffix):
+            r1_path_list.append(r.path)
+            r1_size_list.append(r.size)
         else:
-            raise Exception('The user %s is not the owner of Resource with primary key %s.' % (user, pk))
-    
-    return {id_list[0]:r1_path_list}
+            print('Skipping %s' % r.path)
+
+    d = {id_list[0]:r1_path_list}
+    d.update(plan_task_resources(all_data, r1_size_list, id_list[0]))
+    return d
+
+def plan_task_resources(all_data, r1_size_list, r1_input_id):
+    '''
+    Returns the WDL input overrides for the task resources.  If they cannot be
+    planned, the tasks simply keep their default resources.
+    '''
+    genome = all_data.get(GENOME_CHOICE)
+    if genome is None:
+        return {}
+    workflow_name = r1_input_id.split('.')[0]
+    try:
+        return plan_resources(r1_size_list, genome, workflow_name=workflow_name)
+    except ResourcePlanException as ex:
+        print('Could not plan the task resources: %s' % ex)
+        return {}
@@ -0,0 +1,305 @@
+'''
+Predicts the runtime resources (cpu, memory and disk) of the per-sample WDL tasks
+from the sizes of the input fastq files and the chosen genome.
+
+Each resource of each task is modeled as a linear function of the size of the
+(largest) fastq and of the genome's STAR index:
+    intercept + per_fastq_gb * fastq_gb + per_index_gb * star_index_gb
+which is then multiplied by a headroom factor, rounded up and clamped to [min, max].
+The models live in resource_models.json and can be re-calibrated from recorded
+stage metrics (see `calibrate`), e.g. the performance logs that the pipeline's
+scripts write (see docker/instrumentation.py) together with the input sizes:
+    resource_planner.py calibrate -g <genome> -s fastq_sizes.txt *.performance.json
+where fastq_sizes.txt has a line "<bytes> <path>" per fastq, as written by
+`du -b` or `gsutil du`.
+
+All samples are processed by the same scattered calls, so the tasks are sized
+for the largest fastq.  The predictions are returned as WDL input overrides, e.g.
+    {"SingleEndRnaSeqAndDgeWorkflow.align_memory_gb": 38, ...}
+which the runtime sections of the tasks read (falling back to their defaults if absent).
+'''
+
+import argparse
+import json
+import math
+import os
+
+MODELS_FILE = 'resource_models.json'
+MODELS_FORMAT_VERSION = 1
+WORKFLOW_NAME = 'SingleEndRnaSeqAndDgeWorkflow'
+BYTES_PER_GB = 1024 ** 3
+
+# the model terms:
+INTERCEPT = 'intercept'
+PER_FASTQ_GB = 'per_fastq_gb'
+PER_INDEX_GB = 'per_index_gb'
+MIN = 'min'
+MAX = 'max'
+
+# the terms of the compute model, which estimates the total work of a run:
+BYTES_PER_READ = 'bytes_per_read'
+CORE_HOURS_PER_MILLION_READS = 'core_hours_per_million_reads'
+CORE_HOURS_PER_SAMPLE = 'core_hours_per_sample'
+CORE_HOURS_PER_INDEX_GB = 'core_hours_per_index_gb'
+
+# the scripts whose performance logs measure a modeled task, and the input
+# they are labeled with
+PERFORMANCE_RECORD_VERSION = 1
+SCRIPT_TASKS = {
+    'star_driver.py': 'perform_align',
+    'check_fastq.py': 'assert_valid_fastq'
+}
+MB_PER_GB = 1024.0
+
+# maps each (task, resource) to the workflow input which overrides it
+WDL_INPUTS = {
+    ('perform_align', 'cpu'): 'align_cpu',
+    ('perform_align', 'memory_gb'): 'align_memory_gb',
+    ('perform_align', 'disk_gb'): 'align_disk_gb',
+    ('picard_deduplicate', 'memory_gb'): 'dedup_memory_gb',
+    ('picard_deduplicate', 'disk_gb'): 'dedup_disk_gb',
+    ('samtools', 'disk_gb'): 'bam_disk_gb',
+    ('assert_valid_fastq', 'memory_gb'): 'fastq_check_memory_gb',
+    ('assert_valid_fastq', 'disk_gb'): 'fastq_check_disk_gb'
+}
+
+
+class ResourcePlanException(Exception):
+    pass
+
+
+def get_models_path():
+    this_directory = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(this_directory, MODELS_FILE)
+
+
+def load_models(models_path=None):
+    if models_path is None:
+        models_path = get_models_path()
+    with open(models_path) as fin:
+        models = json.load(fin)
+    if models.get('format_version') != MODELS_FORMAT_VERSION:
+        raise ResourcePlanException('Unexpected format for the resource models in %s' % models_path)
+    return models
+
+
+def predict(model, fastq_gb, index_gb, headroom):
+    '''
+    Evaluates a single resource model.  Returns an integer.
+    '''
+    value = model.get(INTERCEPT, 0.0) \
+        + model.get(PER_FASTQ_GB, 0.0) * fastq_gb \
+        + model.get(PER_INDEX_GB, 0.0) * index_gb
+    value = int(math.ceil(value * headroom))
+    if MIN in model:
+        value = max(value, int(model[MIN]))
+    if MAX in model:
+        value = min(value, int(model[MAX]))
+    return value
+
+
+def plan_resources(fastq_sizes, genome, models=None, workflow_name=WORKFLOW_NAME):
+    '''
+    `fastq_sizes` is a list of the fastq file sizes, in bytes.  `genome` is
+    one of the keys of genome_resources.json (and resource_models.json).
+
+    Returns a dict of WDL input overrides.  If the sizes are unknown, returns an
+    empty dict so that the tasks keep their defaults.
+    '''
+    if models is None:
+        models = load_models()
+    known_sizes = [s for s in fastq_sizes if s]
+    if len(known_sizes) == 0:
+        return {}
+    index_gb = get_index_gb(models, genome)
+    fastq_gb = max(known_sizes) / float(BYTES_PER_GB)
+    headroom = models.get('headroom', 1.0)
+
+    overrides = {}
+    for (task, resource), input_name in sorted(WDL_INPUTS.items(), key=lambda x: x[1]):
+        model = models['tasks'].get(task, {}).get(resource)
+        if model is not None:
+            overrides['%s.%s' % (workflow_name, input_name)] = predict(model, fastq_gb, index_gb, headroom)
+    return overrides
+
+
+def get_index_gb(models, genome):
+    try:
+        return models['genomes'][genome]['star_index_gb']
+    except KeyError:
+        raise ResourcePlanException('There is no resource model for the genome "%s"' % genome)
+
+
+def estimate_reads(fastq_size, models):
+    '''
+    The approximate number of reads in a (gzipped) fastq of `fastq_size` bytes
+    '''
+    return fastq_size / float(models['compute'][BYTES_PER_READ])
+
+
+def estimate_core_hours(fastq_size, genome, models=None):
+    '''
+    Estimates the core-hours needed to process a single sample, given the size
+    of its fastq in bytes.  Each sample pays a fixed cost (mostly loading the
+    genome index) plus a cost proportional to its number of reads.
+    '''
+    if models is None:
+        models = load_models()
+    compute = models['compute']
+    index_gb = get_index_gb(models, genome)
+    million_reads = estimate_reads(fastq_size, models) / 1e6
+    return compute[CORE_HOURS_PER_SAMPLE] \
+        + compute[CORE_HOURS_PER_INDEX_GB] * index_gb \
+        + compute[CORE_HOURS_PER_MILLION_READS] * million_reads
+
+
+def fit_line(x, y):
+    '''
+    Least-squares fit of y = a + b*x, with the slope constrained to be non-negative.
+    Returns (a, b)
+    '''
+    n = len(x)
+    mean_x = sum(x) / float(n)
+    mean_y = sum(y) / float(n)
+    sxx = sum((xi - mean_x) ** 2 for xi in x)
+    if sxx == 0:
+        return (mean_y, 0.0)
+    b = max(0.0, sum((xi - mean_x) * (yi - mean_y) for xi, yi in zip(x, y)) / sxx)
+    return (mean_y - b * mean_x, b)
+
+
+def calibrate(models, records):
+    '''
+    Re-fits the intercept and fastq slope of the models from recorded stage metrics.
+    Each record is a dict with the keys:
+        task, genome, fastq_gb, and any of the modeled resources (e.g. memory_gb, disk_gb, cpu)
+    giving the peak usage observed for that task.  The genome term of each model is kept
+    as-is.  After the fit, the intercept is raised so that no observation exceeds the
+    prediction (before the headroom is applied).
+
+    Returns the number of resource models that were updated.
+    '''
+    grouped = {}
+    for r in records:
+        index_gb = models['genomes'].get(r.get('genome'), {}).get('star_index_gb', 0.0)
+        for resource in r:
+            key = (r['task'], resource)
+            if key in WDL_INPUTS:
+                grouped.setdefault(key, []).append((float(r['fastq_gb']), index_gb, float(r[resource])))
+
+    updated = 0
+    for (task, resource), observations in grouped.items():
+        model = models['tasks'].setdefault(task, {}).setdefault(resource, {})
+        per_index_gb = model.get(PER_INDEX_GB, 0.0)
+        x = [o[0] for o in observations]
+        y = [o[2] - per_index_gb * o[1] for o in observations]
+        intercept, slope = fit_line(x, y)
+        max_residual = max(yi - (intercept + slope * xi) for xi, yi in zip(x, y))
+        model[INTERCEPT] = round(intercept + max(0.0, max_residual), 3)
+        model[PER_FASTQ_GB] = round(slope, 3)
+        updated += 1
+    return updated
+
+
+def is_performance_record(record):
+    return ('script' in record) and (record.get('format_version') == PERFORMANCE_RECORD_VERSION)
+
+
+def convert_performance_record(record, fastq_sizes, genome):
+    '''
+    Converts a performance log (from docker/instrumentation.py) into a calibration
+    record, or returns None if it does not measure a modeled task or the size of its
+    input is unknown.  `fastq_sizes` maps the fastq file names to their sizes in bytes.
+
+    The peak RSS gives memory_gb.  The CPU model is not calibrated: the CPU time over
+    the wall time is bounded by the CPUs allocated, so fitting it could only ever shrink
+    the allocation.  Disk usage is not recorded.
+    '''
+    task = SCRIPT_TASKS.get(record['script'])
+    size = fastq_sizes.get(record.get('label'))
+    if (task is None) or (size is None):
+        return None
+    total = record['total']
+    return {
+        'task': task,
+        'genome': genome,
+        'fastq_gb': size / float(BYTES_PER_GB),
+        'memory_gb': total['max_rss_mb'] / MB_PER_GB
+    }
+
+
+def read_fastq_sizes(path):
+    '''
+    Reads lines of "<bytes> <path>" (as from `du -b` or `gsutil du`) into a dict
+    mapping the file name to its size
+    '''
+    sizes = {}
+    with open(path) as fin:
+        for line in fin:
+            fields = line.split()
+            if len(fields) >= 2:
+                sizes[os.path.basename(fields[-1])] = int(fields[0])
+    return sizes
+
+
+def read_records(paths, fastq_sizes=None, genome=None):
+    '''
+    Reads stage metrics from JSON files, each holding a single record or a list of them.
+    Performance logs are converted (see convert_performance_record), which needs the
+    fastq sizes and the genome; those not measuring a modeled task are skipped.
+    '''
+    records = []
+    for path in paths:
+        with open(path) as fin:
+            j = json.load(fin)
+        for record in (j if isinstance(j, list) else [j]):
+            if is_performance_record(record):
+                if fastq_sizes is None or genome is None:
+                    raise ResourcePlanException('The fastq sizes and the genome are needed to calibrate'
+                        ' from the performance log %s' % path)
+                record = convert_performance_record(record, fastq_sizes, genome)
+                if record is None:
+                    continue
+            records.append(record)
+    return records
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Plans (or calibrates) the runtime resources of the WDL tasks.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    plan_parser = subparsers.add_parser('plan', help='Writes WDL input overrides for the given fastq files.')
+    plan_parser.add_argument('-g', '--genome', required=True, help='The genome, as in genome_resources.json')
+    plan_parser.add_argument('-o', '--output', required=True, help='Path for the JSON of input overrides.')
+    plan_parser.add_argument('-m', '--models', help='Path to the resource models (default: %s)' % MODELS_FILE)
+    plan_parser.add_argument('fastqs', nargs='+')
+
+    calibrate_parser = subparsers.add_parser('calibrate', help='Re-fits the resource models from recorded stage metrics.')
+    calibrate_parser.add_argument('-m', '--models', help='Path to the resource models (default: %s)' % MODELS_FILE)
+    calibrate_parser.add_argument('-g', '--genome', help='The genome of the recorded runs, as in genome_resources.json')
+    calibrate_parser.add_argument('-s', '--sizes', help='The sizes of the fastqs of the recorded runs, as lines of "<bytes> <path>".')
+    calibrate_parser.add_argument('records', nargs='+', help='JSON files of stage metrics, or the performance logs of runs.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    models_path = args.models if args.models else get_models_path()
+    models = load_models(models_path)
+    if args.command == 'plan':
+        sizes = [os.path.getsize(f) for f in args.fastqs]
+        overrides = plan_resources(sizes, args.genome, models)
+        with open(args.output, 'w') as fout:
+            json.dump(overrides, fout, indent=2, sort_keys=True)
+    elif args.command == 'calibrate':
+        fastq_sizes = read_fastq_sizes(args.sizes) if args.sizes else None
+        records = read_records(args.records, fastq_sizes, args.genome)
+        n = calibrate(models, records)
+        # note what the models were last fitted on
+        models['calibration'] = {
+            'num_records': len(records),
+            'genomes': sorted(set([r.get('genome') for r in records if r.get('genome')]))
+        }
+        with open(models_path, 'w') as fout:
+            json.dump(models, fout, indent=4, sort_keys=True)
+        print('Updated %d resource models in %s' % (n, models_path))
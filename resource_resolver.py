@@ -0,0 +1,40 @@
+'''
+Resolves the primary keys sent by the file choosers in gui.json into Resource
+instances, checking that the user may use them.  Shared by the input mapping
+handlers (input_mapping.py and single_file_input_mapping.py).
+
+All of the primary keys are resolved with a single query, so submitting many
+files does not cost a database round-trip per file.
+'''
+from base.models import Resource
+
+
+def resolve_resources(user, pk_list, resource_model=Resource):
+    '''
+    `pk_list` is a list of Resource primary keys.  Returns the corresponding
+    Resource instances in the same order.
+
+    Raises an Exception listing ALL of the primary keys which do not exist
+    or which are not owned by the user (unless the user is staff).
+    '''
+    resources = resource_model.objects.in_bulk(pk_list)
+
+    # in_bulk keys by the primary key value, which may not be of the same type
+    # as the values sent by the frontend (e.g. strings)
+    resources = dict([(str(pk), r) for pk, r in resources.items()])
+
+    missing_pks = [pk for pk in pk_list if str(pk) not in resources]
+    if user.is_staff:
+        foreign_pks = []
+    else:
+        foreign_pks = [pk for pk in pk_list if str(pk) in resources and resources[str(pk)].owner != user]
+
+    err_list = []
+    if len(missing_pks) > 0:
+        err_list.append('There are no Resources with primary keys: %s.' % ', '.join([str(pk) for pk in missing_pks]))
+    if len(foreign_pks) > 0:
+        err_list.append('The user %s is not the owner of the Resources with primary keys: %s.' % (user, ', '.join([str(pk) for pk in foreign_pks])))
+    if len(err_list) > 0:
+        raise Exception(' '.join(err_list))
+
+    return [resources[str(pk)] for pk in pk_list]
@@ -1,6 +1,7 @@
-from base.models import Resource
 import os
 
+from resource_resolver import resolve_resources
+
 def map_inputs(user, all_data, data_name, id_list):
     '''
     `user` is a User instance (or subclass).  This gives us
@@ -23,6 +24,5 @@ def map_inputs(user, all_data, data_name, id_list):
     '''
     unmapped_data = all_data[data_name]
     resource_pk = unmapped_data
-    r = Resource.objects.get(pk=resource_pk)
-    if (r.owner == user) or (user.is_staff):
-        return {id_list[0]:r.path}
+    r = resolve_resources(user, [resource_pk])[0]
+    return {id_list[0]:r.path}